@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark header detection in generate_renlei.py.
+
+Compares the old three-search detection (re_part / re_chapter / re_front,
+each scanning the whole block) with the combined single-pass detector.
+Uses the real 人類大歷史 source if present, otherwise a synthetic book of
+long CJK blocks. Both detectors must agree on every block.
+
+Usage:
+    python3 scripts/benchmark_headers.py [--blocks N] [--repeat N]
+"""
+
+import argparse
+import os
+import re
+import time
+
+import generate_renlei
+
+# The original per-block patterns, kept here as the baseline
+LEGACY_PART = re.compile(r'<h1[^>]*><span class="num">([^<]+)</span>([^<]+)</h1>', re.IGNORECASE)
+LEGACY_CHAPTER = re.compile(r'<h2[^>]*><span class="num">([^<]+)</span>((?:(?!</h2>).)+)</h2>', re.IGNORECASE)
+LEGACY_FRONT = re.compile(r'<h1[^>]*>(?!<span)([^<]+)</h1>', re.IGNORECASE)
+
+
+def legacy_detect(block):
+    match_part = LEGACY_PART.search(block)
+    match_chapter = LEGACY_CHAPTER.search(block)
+    match_front = LEGACY_FRONT.search(block)
+    if match_part:
+        return f"{match_part.group(1)} {match_part.group(2)}", True
+    if match_chapter:
+        return f"{match_chapter.group(1)} {match_chapter.group(2)}", False
+    if match_front:
+        return match_front.group(1), False
+    return None, False
+
+
+def synthetic_blocks(count):
+    """Builds a large book: mostly long header-less blocks, some chapter starts."""
+    paragraph = '<p class="calibre2">' + '人類的歷史始於認知革命，' * 40 + '</p>\n'
+    blocks = []
+    for i in range(count):
+        body = paragraph * 60
+        if i % 25 == 0:
+            header = f'<h1 class="p"><span class="num">第{i // 25 + 1}部</span>認知革命</h1>\n'
+        elif i % 5 == 0:
+            header = f'<h2 class="p1"><span class="num">第{i:02d}章</span>人類：<span class="i">一種</span>也沒什麼特別的動物</h2>\n'
+        else:
+            header = ''
+        blocks.append(f'<div class="calibre" id="calibre_link-{i}">\n{header}{body}</div>\n')
+    return blocks
+
+
+def source_blocks():
+    with open(generate_renlei.SOURCE_FILE, 'r', encoding='utf-8') as f:
+        content = f.read()
+    body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
+    body = body_match.group(1) if body_match else content
+    parts = re.split(r'(<div class="calibre"[^>]*>)', body)
+    return [parts[i] + parts[i + 1] for i in range(1, len(parts) - 1, 2)]
+
+
+def bench(label, detect, blocks, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [detect(block) for block in blocks]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {label:<10} {best * 1000:9.1f} ms")
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--blocks', type=int, default=2000, help="synthetic block count")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per detector (best is kept)")
+    args = parser.parse_args()
+
+    if os.path.exists(generate_renlei.SOURCE_FILE):
+        print(f"Using source {generate_renlei.SOURCE_FILE}")
+        blocks = source_blocks()
+    else:
+        print(f"Source not found, using {args.blocks} synthetic blocks")
+        blocks = synthetic_blocks(args.blocks)
+
+    size_mb = sum(len(b.encode('utf-8')) for b in blocks) / (1024 * 1024)
+    print(f"{len(blocks)} blocks, {size_mb:.1f} MB")
+
+    legacy_time, legacy_results = bench("legacy", legacy_detect, blocks, args.repeat)
+    combined_time, combined_results = bench("combined", generate_renlei.HEADER_DETECTOR, blocks, args.repeat)
+
+    mismatches = sum(1 for a, b in zip(legacy_results, combined_results) if a != b)
+    if mismatches:
+        print(f"Warning: {mismatches} blocks detected differently")
+    else:
+        print("Detectors agree on all blocks.")
+    print(f"Speedup: {legacy_time / combined_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
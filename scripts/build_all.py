@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Build every book listed in the README's "Supported Books" table.
+
+The table is the book registry: each row names a generator script, its theme
+and its output directory. Books are built concurrently in a process pool
+(at most --jobs at a time). Books that share an output directory (several
+write to dist/) are built one after another in the same worker, in table
+order, exactly as running the scripts by hand would leave them.
+
+With --watch, the books are then rebuilt as their inputs change. Each
+output directory is watched for the last book written to it (the one it
+ends up holding):
+- the generator script, ebook_engine or the source index.html changed:
+  the book is rebuilt, and only the output files whose content changed are
+  replaced (EBOOK_HELPER_SYNC_OUTPUT);
+- the theme, the source's style.css or images changed: just those files
+  are copied into the output, and sw.js is refreshed. (With
+  EBOOK_HELPER_SHARED_ASSETS set the theme is stored under a hashed name,
+  so a theme change rebuilds the book instead.)
+
+Usage:
+    python3 scripts/build_all.py [--jobs N] [--only NAME ...] [--list] [--watch]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import re
+import runpy
+import subprocess
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ebook_engine import (SHARED_ASSETS_ENV, SYNC_ENV, WORKERS_ENV, refresh_service_worker, sync_file,
+                          watch)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+README_FILE = os.path.join(PROJECT_ROOT, 'README.md')
+ENGINE_DIR = os.path.join(SCRIPT_DIR, 'ebook_engine')
+
+REGISTRY_HEADING = '## Supported Books'
+
+
+def load_registry(readme_path=README_FILE):
+    """
+    Parses the Supported Books table into a list of dicts with
+    book, script, theme and output keys, in table order.
+    """
+    with open(readme_path, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+
+    try:
+        start = lines.index(REGISTRY_HEADING)
+    except ValueError:
+        raise SystemExit(f"Could not find '{REGISTRY_HEADING}' in {readme_path}")
+
+    books = []
+    for line in lines[start + 1:]:
+        if line.startswith('#'):
+            break
+        if not line.startswith('|'):
+            if books:
+                break
+            continue
+        cells = [cell.strip() for cell in line.strip().strip('|').split('|')]
+        if len(cells) < 4 or cells[0] == 'Book' or set(cells[0]) <= set('-: '):
+            continue
+        # Cells look like `generate_site.py`; strip the backticks
+        script, theme, output = (cell.strip('`') for cell in cells[1:4])
+        books.append({
+            "book": cells[0],
+            "script": script,
+            "theme": theme,
+            "output": output.rstrip('/'),
+        })
+    return books
+
+
+def build_book(entry):
+    """
+    Runs one generator script in this process, capturing its output.
+    Returns (entry, status, seconds, log).
+    """
+    script_path = os.path.join(SCRIPT_DIR, entry["script"])
+    log = io.StringIO()
+    start = time.perf_counter()
+    status = "ok"
+    # The script sees its own name and no arguments, as when run by hand
+    saved_argv = sys.argv
+    sys.argv = [script_path]
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            runpy.run_path(script_path, run_name='__main__')
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                status = "failed"
+        except Exception:
+            traceback.print_exc()
+            status = "failed"
+        finally:
+            sys.argv = saved_argv
+    elapsed = time.perf_counter() - start
+    text = log.getvalue()
+    # The generators print an error and return when their source is missing
+    if status == "ok" and re.search(r'Error: Source file not found', text):
+        status = "skipped"
+    return entry, status, elapsed, text
+
+
+def init_worker(block_workers):
+    """
+    Pool initializer: the per-block process pools of the books built at the
+    same time share the CPUs (unless EBOOK_HELPER_WORKERS is already set).
+    """
+    os.environ.setdefault(WORKERS_ENV, str(block_workers))
+
+
+def build_group(entries):
+    """Builds books that share an output directory, in order."""
+    return [build_book(entry) for entry in entries]
+
+
+def book_inputs(entry):
+    """
+    The files a book's output depends on, read from its generator's
+    settings (SOURCE_FILE, IMAGES_DIR_NAME, ...). Returns
+    (rebuild_paths, copies): a change to any rebuild path needs the
+    generator to run again, while copies are (source, path in the output)
+    pairs that are copied over as they are.
+    """
+    script_path = os.path.join(SCRIPT_DIR, entry["script"])
+    # Runs the module body only (settings and templates), not main()
+    settings = runpy.run_path(script_path, run_name='__inputs__')
+    engine_files = sorted(
+        os.path.join(ENGINE_DIR, name) for name in os.listdir(ENGINE_DIR) if name.endswith('.py')
+    )
+    rebuild = [script_path] + engine_files
+    copies = []
+    theme_path = os.path.join(SCRIPT_DIR, entry["theme"])
+    if os.environ.get(SHARED_ASSETS_ENV):
+        # Pages link to the stored theme by its content hash
+        rebuild.append(theme_path)
+    else:
+        copies.append((theme_path, entry["theme"]))
+
+    source_file = settings.get('SOURCE_FILE')
+    if source_file:
+        source_dir = os.path.dirname(source_file)
+        images_name = settings.get('IMAGES_DIR_NAME') or settings.get('IMAGES_DIR') or 'images'
+        rebuild.append(source_file)
+        copies.append((os.path.join(source_dir, 'style.css'), 'style.css'))
+        copies.append((os.path.join(source_dir, images_name), images_name))
+    return rebuild, copies
+
+
+def copy_changes(copies, changed, output_dir):
+    """Copies (or deletes) changed copy inputs in output_dir. Returns the file count."""
+    count = 0
+    for path in changed:
+        for source, target in copies:
+            if path == source:
+                destination = os.path.join(output_dir, target)
+            elif path.startswith(source + os.sep):
+                destination = os.path.join(output_dir, target, os.path.relpath(path, source))
+            else:
+                continue
+            if os.path.exists(path):
+                sync_file(path, destination)
+            elif os.path.exists(destination):
+                os.remove(destination)
+            count += 1
+    return count
+
+
+def watch_books(books, interval):
+    """Rebuilds or updates books as their inputs change, until Ctrl-C."""
+    # Only the last book written to an output directory shows up in it
+    owners = {}
+    for b in books:
+        owners[b["output"]] = b
+
+    watched = []
+    for entry in owners.values():
+        rebuild, copies = book_inputs(entry)
+        watched.append((entry, set(rebuild), copies))
+        print(f"  {entry['script']} -> {entry['output']}/")
+
+    def on_change(changed):
+        for entry, rebuild, copies in watched:
+            output_dir = os.path.join(PROJECT_ROOT, entry["output"])
+            if rebuild.intersection(changed):
+                print(f"{entry['script']}: source or code changed, rebuilding...")
+                env = dict(os.environ, **{SYNC_ENV: '1'})
+                start = time.perf_counter()
+                result = subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, entry["script"])],
+                                        env=env, cwd=PROJECT_ROOT, capture_output=True, text=True)
+                elapsed = time.perf_counter() - start
+                if result.returncode != 0:
+                    print(f"  [failed] ({elapsed:.1f}s)")
+                    lines = (result.stdout + result.stderr).strip().splitlines()
+                else:
+                    print(f"  [ok] ({elapsed:.1f}s)")
+                    # Just the summary of what changed in the output
+                    lines = [line for line in result.stdout.splitlines() if line.startswith("Updated ")]
+                for line in lines:
+                    print(f"      {line}")
+                continue
+            count = copy_changes(copies, changed, output_dir)
+            if count:
+                refresh_service_worker(output_dir)
+                print(f"{entry['script']}: copied {count} changed files into {entry['output']}/")
+
+    paths = sorted(set().union(*(rebuild for _, rebuild, _ in watched),
+                               (source for _, _, copies in watched for source, _ in copies)))
+    watch(paths, on_change, interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build all books listed in README.md concurrently.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="maximum number of books built at the same time (default: CPU count)")
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+                        help="only build books whose script or output directory contains NAME")
+    parser.add_argument('--list', action='store_true', help="print the registry and exit")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print each generator's output")
+    parser.add_argument('--watch', action='store_true',
+                        help="after building, rebuild or update books whenever their inputs change")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="polling interval in seconds when inotify is unavailable (default: 1)")
+    args = parser.parse_args()
+
+    books = load_registry()
+    if args.only:
+        books = [b for b in books if any(name in b["script"] or name in b["output"] for name in args.only)]
+
+    if args.list:
+        for b in books:
+            print(f"{b['script']:<32} {b['output'] + '/':<24} {b['book']}")
+        return
+
+    if not books:
+        print("No books to build.")
+        return
+
+    # Group by output directory so two books never write the same dist/ at once
+    groups = {}
+    for b in books:
+        groups.setdefault(b["output"], []).append(b)
+
+    jobs = max(1, min(args.jobs, len(groups)))
+    print(f"Building {len(books)} books in {len(groups)} output directories with {jobs} workers...")
+
+    results = []
+    wall_start = time.perf_counter()
+    # Each book's own block pool gets its share of the CPUs, so --jobs
+    # bounds the total number of processes rather than the number of pools
+    block_workers = max(1, (os.cpu_count() or 1) // jobs)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(block_workers,)) as pool:
+        futures = [pool.submit(build_group, group) for group in groups.values()]
+        for future in as_completed(futures):
+            for entry, status, elapsed, log in future.result():
+                print(f"  [{status}] {entry['script']} ({elapsed:.1f}s)")
+                if args.verbose or status == "failed":
+                    for line in log.rstrip().splitlines():
+                        print(f"      {line}")
+                results.append((entry, status, elapsed))
+    wall = time.perf_counter() - wall_start
+
+    # Combined summary in registry order
+    order = {b["script"]: i for i, b in enumerate(books)}
+    results.sort(key=lambda r: order[r[0]["script"]])
+    print()
+    print(f"{'Script':<32} {'Output':<24} {'Status':<8} {'Time':>7}")
+    for entry, status, elapsed in results:
+        print(f"{entry['script']:<32} {entry['output'] + '/':<24} {status:<8} {elapsed:6.1f}s")
+    total = sum(r[2] for r in results)
+    print(f"\nWall time {wall:.1f}s for {total:.1f}s of builds ({jobs} workers).")
+
+    if args.watch:
+        print("\nWatching:")
+        watch_books(books, args.interval)
+        return
+
+    if any(status == "failed" for _, status, _ in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Check ebook_engine.split_blocks against the re.split() splitter it replaced.
+
+The generators used to split the body with
+re.split(r'(<div class="calibre"[^>]*>)') and glue each opener to the text
+after it. split_blocks() must give the same blocks wherever the container
+divs are not nested (every Calibre export seen so far). Where they are
+nested, or an opener sits inside a comment, it is expected to differ: it
+keeps the inner div inside its block instead of cutting the block there.
+
+It also checks 人類大歷史's header detector (generate_renlei.HEADER_DETECTOR),
+which scans only the start of each block in one pass, against the three
+separate full-block searches it replaced (benchmark_headers.legacy_detect):
+a header past HEADER_SCAN_LIMIT, or one hidden inside an earlier match, is
+found by the old searches only.
+
+Runs a set of sample bodies, plus any HTML files given on the command line
+(e.g. a Calibre export's index.html). Exits with status 1 if a sample that
+should match does not.
+
+Usage:
+    python3 scripts/check_blocks.py [path/to/index.html ...]
+"""
+
+import argparse
+import re
+import sys
+
+import benchmark_headers
+import generate_renlei
+from ebook_engine import split_blocks
+
+# The opener patterns the generators split with
+CALIBRE = r'<div class="calibre"[^>]*>'
+CALIBRE_ID = r'<div class="calibre" id="[^"]+">'
+SICHOU = r'<div class="(?:p-text|p-cover)"[^>]*>'
+CALIBRE_LINK = r'<div[^>]+id="calibre_link-\d+"[^>]*>'
+OPENERS = [CALIBRE, CALIBRE_ID, SICHOU, CALIBRE_LINK]
+
+# (name, opener, body, same) -- same is False where split_blocks should differ
+SAMPLES = [
+    ("flat", CALIBRE, '<div class="calibre" id="calibre_link-1"><p class="p-text">一</p></div>\n'
+                      '<div class="calibre" id="calibre_link-2"><h2>二</h2><p>text</p></div>\n', True),
+    ("flat, by id", CALIBRE_LINK, '<div class="calibre1" id="calibre_link-1"><p>一</p></div>\n'
+                                  '<div class="calibre1" id="calibre_link-2"><p>二</p></div>\n', True),
+    ("leading text", CALIBRE_ID, '<p>cover</p>\n<div class="calibre" id="calibre_link-3"><p>a</p></div>', True),
+    ("no opener", CALIBRE, '<p>just a paragraph</p>', True),
+    ("empty last block", CALIBRE, '<div class="calibre" id="calibre_link-4"></div>'
+                                  '<div class="calibre" id="calibre_link-5">', True),
+    ("other divs inside", CALIBRE, '<div class="calibre" id="calibre_link-6"><div class="note"><p>n</p></div>'
+                                   '<div class="figure"/></div>\n'
+                                   '<div class="calibre" id="calibre_link-7"><p>b</p></div>', True),
+    ("sichou classes", SICHOU, '<div class="p-cover"><img src="images/00001.jpeg"/></div>'
+                               '<div class="p-text"><h1>第一章</h1><div class="note">注</div></div>', True),
+    ("stray end tag", CALIBRE, '</div><div class="calibre" id="calibre_link-8"><p>a</p></div></div>'
+                               '<div class="calibre" id="calibre_link-9"><p>b</p></div>', True),
+    ("nested container", CALIBRE, '<div class="calibre" id="calibre_link-10"><p>outer</p>'
+                                  '<div class="calibre" id="calibre_link-11"><p>inner</p></div>'
+                                  '<p>outer, after the inner div</p></div>\n'
+                                  '<div class="calibre" id="calibre_link-12"><p>next</p></div>', False),
+    ("opener in a comment", CALIBRE_ID, '<div class="calibre" id="calibre_link-13"><p>a</p>'
+                                        '<!-- <div class="calibre" id="calibre_link-14"> --></div>', False),
+]
+
+# (name, block, same) for the header detector
+HEADER_SAMPLES = [
+    ("chapter", '<div class="calibre"><h2 class="p1"><span class="num">第01章</span>人類：'
+                '<span class="i">一種</span>也沒什麼特別的動物</h2><p>正文</p></div>', True),
+    ("part before chapter", '<div class="calibre"><h2 class="p1"><span class="num">第01章</span>人類</h2>\n'
+                            '<h1 class="p"><span class="num">第一部</span>認知革命</h1></div>', True),
+    ("front matter", '<div class="calibre"><h1 class="calibre3">誌謝</h1><p>正文</p></div>', True),
+    ("no header", '<div class="calibre"><p>正文</p></div>', True),
+    ("past the scan limit", '<div class="calibre">' + '<p>正文</p>' * generate_renlei.HEADER_SCAN_LIMIT
+                            + '<h1 class="calibre3">誌謝</h1></div>', False),
+    ("inside a chapter title", '<div class="calibre"><h2 class="p1"><span class="num">第01章</span>人類'
+                               '<h1 class="p"><span class="num">第一部</span>認知革命</h1></h2></div>', False),
+]
+
+
+def legacy_split(text, opener):
+    """The re.split() loop the generators used before split_blocks."""
+    parts = re.split(f'({opener})', text)
+    return [parts[i] + parts[i + 1] for i in range(1, len(parts) - 1, 2)]
+
+
+def compare(name, text, openers, expect_same):
+    """Compares both splitters on text with each opener; returns False on a mismatch."""
+    ok = True
+    for opener in openers:
+        legacy = legacy_split(text, opener)
+        blocks = split_blocks(text, opener)
+        # Either way the blocks must cover the text from the first opener on
+        if blocks and ''.join(blocks) != text[text.index(blocks[0]):]:
+            ok = False
+            print(f"  {name}: blocks from {opener} do not add up to the body")
+        if legacy == blocks:
+            if not expect_same:
+                print(f"  {name}: {opener} gives the same blocks ({len(blocks)}); expected a difference")
+            continue
+        if expect_same:
+            ok = False
+            print(f"  {name}: MISMATCH with {opener}: {len(legacy)} blocks before, {len(blocks)} now")
+        else:
+            print(f"  {name}: differs as expected with {opener}: {len(legacy)} blocks before, "
+                  f"{len(blocks)} now")
+    return ok
+
+
+def compare_headers(name, blocks, expect_same):
+    """
+    Compares the header detector with the full-block searches on each block;
+    returns False on an unexpected mismatch.
+    """
+    legacy = [benchmark_headers.legacy_detect(block) for block in blocks]
+    detected = [generate_renlei.HEADER_DETECTOR(block) for block in blocks]
+    legacy_count = sum(1 for title, _ in legacy if title)
+    detected_count = sum(1 for title, _ in detected if title)
+    differing = [i for i, (a, b) in enumerate(zip(legacy, detected)) if a != b]
+    if not differing:
+        if not expect_same:
+            print(f"  {name}: headers agree ({detected_count}); expected a difference")
+        elif len(blocks) > 1:
+            print(f"  {name}: {detected_count} headers in {len(blocks)} blocks, as in full blocks")
+        return True
+    label = "differ as expected" if not expect_same else "MISMATCH"
+    print(f"  {name}: headers {label}: {legacy_count} in full blocks, {detected_count} detected")
+    for i in differing[:5]:
+        print(f"    block {i}: {legacy[i][0]!r} in the full block, {detected[i][0]!r} detected")
+    return not expect_same
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sources', nargs='*', help="HTML files to check as well (no nesting expected)")
+    args = parser.parse_args()
+
+    failures = 0
+    print(f"Checking {len(SAMPLES)} samples")
+    for name, opener, text, expect_same in SAMPLES:
+        if not compare(name, text, [opener], expect_same):
+            failures += 1
+    print(f"Checking {len(HEADER_SAMPLES)} header samples")
+    for name, block, expect_same in HEADER_SAMPLES:
+        if not compare_headers(name, [block], expect_same):
+            failures += 1
+
+    for path in args.sources:
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
+        print(f"Checking {path}")
+        body = body_match.group(1) if body_match else content
+        if not compare(path, body, OPENERS, True):
+            failures += 1
+        if not compare_headers(path, split_blocks(body, generate_renlei.BLOCK_OPENER), True):
+            failures += 1
+
+    if failures:
+        print(f"{failures} samples failed the check")
+        sys.exit(1)
+    print("split_blocks matches re.split() wherever the containers are not nested, "
+          "and the header detector matches the full-block searches.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+Shared building blocks for the ebook site generators in scripts/.
+
+The generate_*.py scripts import from here (scripts/ is on sys.path when
+they are run as `python3 scripts/generate_xxx.py`).
+"""
+
+from .anchors import FragmentLinker, compile_anchor_scanner, iter_chapter_starts
+from .archive import pack_site, write_bundle
+from .assets import AssetSync, start_asset_sync
+from .blocks import iter_block_spans, split_blocks
+from .cache import BlockCache
+from .epub import EpubBook
+from .filters import ContentFilter
+from .headers import HeaderPattern
+from .images import ImageVariants
+from .ir import BookIR, code_version, list_assets, load_book, save_book
+from .model import Chapter, source_spans
+from .offline import (SERVICE_WORKER_TAG, chapter_images, image_refs, prefetch_hints,
+                      refresh_service_worker, write_service_worker)
+from .output import SYNC_ENV, staged_output, sync_file
+from .parallel import WORKERS_ENV, map_blocks
+from .reading import text_length, write_reading_table
+from .shared import SHARED_ASSETS_ENV, SiteFiles
+from .split import split_oversized
+from .template import PageTemplate
+from .toc import TocEntry, discover_toc, find_toc, section_entries, toc_title_map
+from .watch import watch
@@ -0,0 +1,59 @@
+"""
+Anchor lookups for splitting a book into chapters.
+"""
+
+import re
+
+
+def compile_anchor_scanner(anchor_ids, ignore_case=False):
+    """
+    Compiles one pattern that matches id="..." (or name="...") for any of the given anchor IDs
+    (e.g. the calibre_link IDs listed in a book's TOC).
+    With ignore_case, the attribute name matches in any case (ID="...");
+    the ID itself always matches exactly, as it is looked up by value.
+    Returns None if there are no IDs to look for.
+    """
+    if not anchor_ids:
+        return None
+    # The closing quote keeps calibre_link-1 from matching calibre_link-10
+    alternation = '|'.join(re.escape(anchor) for anchor in sorted(anchor_ids))
+    attribute = '(?i:id|name)' if ignore_case else '(?:id|name)'
+    return re.compile(f'\\b{attribute}="({alternation})"')
+
+
+def iter_chapter_starts(blocks, title_map, ignore_case=False):
+    """
+    Yields (block, title) for each block, where title is the title_map entry
+    of the first known anchor in the block, or None if the block does not
+    start a new chapter (ignore_case: see compile_anchor_scanner).
+    Only the known anchors are searched for, so blocks full of footnote and
+    paragraph IDs are scanned once without collecting every ID they contain.
+    """
+    scanner = compile_anchor_scanner(title_map, ignore_case)
+    for block in blocks:
+        match = scanner.search(block) if scanner else None
+        yield block, (title_map[match.group(1)] if match else None)
+
+
+class FragmentLinker:
+    """
+    Points same-page fragment links (href="#id") at the page that holds
+    their anchor once a book is split into pages: linker(block, filename)
+    rewrites the links in a block written to filename. anchor_pages maps
+    anchor IDs to filenames; pattern matches a link with the ID as group 1.
+    Instances are picklable, so map_blocks() can run them in worker processes.
+    """
+
+    def __init__(self, anchor_pages, pattern=r'href="#([^"]+)"'):
+        self.anchor_pages = anchor_pages
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+
+    def __call__(self, block, filename):
+        def replace(match):
+            target = self.anchor_pages.get(match.group(1))
+            # Links to anchors on the same page (or unknown ones) stay as they are
+            if target is None or target == filename:
+                return match.group(0)
+            return f'href="{target}#{match.group(1)}"'
+
+        return self.pattern.sub(replace, block)
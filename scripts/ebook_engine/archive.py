@@ -0,0 +1,236 @@
+"""
+Single-archive output.
+
+A built site is thousands of small files, which are slow to copy to a reader's
+device and to sync. write_bundle() packs a built site into one zip file and
+adds two tiny companions:
+
+    site.zip    every page, stylesheet and image of the site
+    sw.js       a service worker that serves requests out of site.zip
+    index.html  a loader that installs sw.js, then reloads into the site
+
+The zip's central directory is the offset index: the service worker reads it
+once and then serves any page by slicing the archive at the recorded
+offset. The archive stays a cache-backed Blob, so only the slices read are
+loaded into memory. Text files are deflated (the browser inflates them with
+DecompressionStream); images and fonts are already compressed, so they are
+stored as they are.
+
+sw.js carries the archive's content hash, which names its cache and is
+added to the archive URL; repacking a site replaces the cached archive
+instead of serving the old one. The service worker reads plain zip
+headers only, so sites that would need ZIP64 (more than 65535 files or
+2 GB) are refused.
+"""
+
+import hashlib
+import os
+import shutil
+import zipfile
+
+from .output import staged_output
+
+ARCHIVE_NAME = 'site.zip'
+
+# Already-compressed formats gain nothing from deflate
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.woff', '.woff2', '.zip', '.mp3', '.mp4'}
+
+# Largest archive the service worker can read (no ZIP64 records)
+MAX_ARCHIVE_FILES = 0xFFFF
+MAX_ARCHIVE_BYTES = zipfile.ZIP64_LIMIT
+
+# Fixed timestamp so packing the same site twice gives the same archive
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+SERVICE_WORKER = r"""// Serves the site out of site.zip (generated by ebook_engine.archive)
+// The version is the archive's content hash: a repacked site gets a new
+// sw.js, which fetches the new archive and drops the old one's cache
+const VERSION = '__VERSION__';
+const ARCHIVE_URL = new URL('site.zip?v=' + VERSION, self.registration.scope).href;
+const CACHE_PREFIX = 'ebook-archive:' + self.registration.scope + ':';
+const CACHE_NAME = CACHE_PREFIX + VERSION;
+const TYPES = {
+    html: 'text/html; charset=utf-8', css: 'text/css', js: 'text/javascript',
+    json: 'application/json', svg: 'image/svg+xml', jpg: 'image/jpeg', jpeg: 'image/jpeg',
+    png: 'image/png', gif: 'image/gif', webp: 'image/webp', avif: 'image/avif',
+    woff: 'font/woff', woff2: 'font/woff2'
+};
+
+let archivePromise = null;
+
+// The archive as a Blob backed by the cache: only the slices read are loaded
+async function fetchArchive() {
+    const cache = await caches.open(CACHE_NAME);
+    let response = await cache.match(ARCHIVE_URL);
+    if (!response) {
+        const fetched = await fetch(ARCHIVE_URL);
+        if (!fetched.ok) throw new Error('Could not load ' + ARCHIVE_URL);
+        await cache.put(ARCHIVE_URL, fetched);
+        response = await cache.match(ARCHIVE_URL);
+    }
+    return response.blob();
+}
+
+async function readBytes(blob, start, end) {
+    return new DataView(await blob.slice(start, end).arrayBuffer());
+}
+
+// Reads the central directory into a Map: name -> {header, size, method}
+async function readIndex(blob) {
+    // The end record is in the last 22 bytes, plus up to 64 KB of comment
+    const tailStart = Math.max(0, blob.size - 22 - 0xffff);
+    const tail = await readBytes(blob, tailStart, blob.size);
+    let eocd = tail.byteLength - 22;
+    while (eocd >= 0 && tail.getUint32(eocd, true) !== 0x06054b50) eocd--;
+    if (eocd < 0) throw new Error('Not a zip archive');
+    const count = tail.getUint16(eocd + 10, true);
+    const dirSize = tail.getUint32(eocd + 12, true);
+    const dirStart = tail.getUint32(eocd + 16, true);
+    const view = await readBytes(blob, dirStart, dirStart + dirSize);
+    const decoder = new TextDecoder();
+    const index = new Map();
+    let pos = 0;
+    for (let i = 0; i < count; i++) {
+        const method = view.getUint16(pos + 10, true);
+        const size = view.getUint32(pos + 20, true);
+        const nameLength = view.getUint16(pos + 28, true);
+        const extraLength = view.getUint16(pos + 30, true);
+        const commentLength = view.getUint16(pos + 32, true);
+        const header = view.getUint32(pos + 42, true);
+        const name = decoder.decode(new Uint8Array(view.buffer, pos + 46, nameLength));
+        index.set(name, {header, size, method});
+        pos += 46 + nameLength + extraLength + commentLength;
+    }
+    return {blob, index};
+}
+
+function loadArchive() {
+    if (!archivePromise) {
+        archivePromise = fetchArchive().then(readIndex);
+        archivePromise.catch(() => { archivePromise = null; });
+    }
+    return archivePromise;
+}
+
+async function serve(path) {
+    if (path === '' || path.endsWith('/')) path += 'index.html';
+    const {blob, index} = await loadArchive();
+    const entry = index.get(path);
+    if (!entry) return new Response('Not found', {status: 404});
+    // Entry data follows the local header, whose extra field may differ
+    const header = await readBytes(blob, entry.header, entry.header + 30);
+    const offset = entry.header + 30 + header.getUint16(26, true) + header.getUint16(28, true);
+    let body = blob.slice(offset, offset + entry.size);
+    if (entry.method === 8) {
+        body = body.stream().pipeThrough(new DecompressionStream('deflate-raw'));
+    }
+    const ext = path.split('.').pop().toLowerCase();
+    return new Response(body, {headers: {'Content-Type': TYPES[ext] || 'application/octet-stream'}});
+}
+
+self.addEventListener('install', event => {
+    event.waitUntil(loadArchive().then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys
+                .filter(key => key.startsWith(CACHE_PREFIX) && key !== CACHE_NAME)
+                .map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const scope = self.registration.scope;
+    const url = event.request.url.split('#')[0].split('?')[0];
+    if (event.request.method !== 'GET' || !url.startsWith(scope)) return;
+    const path = decodeURIComponent(url.slice(scope.length));
+    // The loader files themselves come from the network
+    if (path === 'sw.js' || path === 'site.zip') return;
+    event.respondWith(serve(path));
+});
+"""
+
+LOADER_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Loading…</title>
+</head>
+<body>
+    <p id="status">Loading book…</p>
+    <script>
+        // Installs the archive service worker, then reloads so this page
+        // (and every later one) is served from site.zip
+        if ('serviceWorker' in navigator) {
+            navigator.serviceWorker.register('sw.js').then(() => navigator.serviceWorker.ready)
+                .then(() => location.reload())
+                .catch(err => {
+                    document.getElementById('status').textContent = 'Could not load the book: ' + err;
+                });
+        } else {
+            document.getElementById('status').textContent =
+                'This browser cannot read packed books; unzip site.zip and open index.html instead.';
+        }
+    </script>
+</body>
+</html>
+"""
+
+
+def pack_site(site_dir, archive_path):
+    """
+    Writes every file under site_dir into a zip at archive_path, in sorted
+    order. Returns (file_count, archive_bytes). Raises ValueError if the
+    site is too large for a zip without ZIP64 records.
+    """
+    names = []
+    for root, dirs, files in os.walk(site_dir):
+        dirs.sort()
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            names.append((os.path.relpath(full_path, site_dir).replace(os.sep, '/'), full_path))
+
+    # Checked up front (uncompressed sizes, so before writing anything);
+    # allowZip64=False below still refuses anything that slips through
+    total_bytes = sum(os.path.getsize(full_path) for _, full_path in names)
+    if len(names) > MAX_ARCHIVE_FILES or total_bytes > MAX_ARCHIVE_BYTES:
+        raise ValueError(f"{site_dir} has {len(names)} files ({total_bytes / 1024 / 1024:.0f} MB); "
+                         f"archives are limited to {MAX_ARCHIVE_FILES} files and "
+                         f"{MAX_ARCHIVE_BYTES // 1024 // 1024} MB")
+
+    with zipfile.ZipFile(archive_path, 'w', allowZip64=False) as archive:
+        for arcname, full_path in names:
+            info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+            info.external_attr = 0o644 << 16
+            if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with open(full_path, 'rb') as src, archive.open(info, 'w') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    return len(names), os.path.getsize(archive_path)
+
+
+def write_bundle(site_dir, bundle_dir):
+    """
+    Packs a built site into bundle_dir (site.zip, sw.js and a loader
+    index.html). bundle_dir is replaced in one step, like any other output;
+    a site too large to pack raises ValueError and leaves it as it was.
+    """
+    with staged_output(bundle_dir) as out_dir:
+        archive_path = os.path.join(out_dir, ARCHIVE_NAME)
+        count, size = pack_site(site_dir, archive_path)
+        archive_hash = hashlib.sha256()
+        with open(archive_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                archive_hash.update(chunk)
+        with open(os.path.join(out_dir, 'sw.js'), 'w', encoding='utf-8') as f:
+            f.write(SERVICE_WORKER.replace('__VERSION__', archive_hash.hexdigest()[:16]))
+        with open(os.path.join(out_dir, 'index.html'), 'w', encoding='utf-8') as f:
+            f.write(LOADER_PAGE)
+    return count, size
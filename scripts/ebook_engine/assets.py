@@ -0,0 +1,149 @@
+"""
+Background asset copying.
+
+Generators copied the whole images/ tree before writing the first page, so
+the build spent its first seconds waiting on disk I/O and only then started
+rendering. start_asset_sync() copies assets on a background thread instead,
+while the main thread writes pages.
+
+The copier is a small asyncio pipeline: one producer walks the source trees
+and feeds (src, dst) pairs into a bounded queue, and a few consumers hand
+each copy to a thread pool (shutil releases the GIL while it copies). The
+bounded queue keeps memory flat on books with tens of thousands of images.
+A copy function other than shutil.copy2 (e.g. one that also writes image
+variants) can be passed in.
+
+wait() blocks until every file is copied, re-raises the first copy error,
+and reports how much of the copying overlapped with page writing. close()
+stops a copy that is no longer needed (pending files are skipped, copies in
+flight finish) and returns once the thread is done; generators call it from
+a `finally`, so a build that fails while writing pages never leaves the
+thread copying into a staging directory that is being removed.
+"""
+
+import asyncio
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .output import register_writer
+
+# Copies in flight at once, and pending copies the walker may queue ahead
+ASSET_WORKERS = 4
+ASSET_QUEUE_SIZE = 64
+
+
+class AssetSync:
+    """Copies (src, dst) pairs, files or directory trees, on a background thread."""
+
+    def __init__(self, jobs, copy=shutil.copy2, workers=ASSET_WORKERS, queue_size=ASSET_QUEUE_SIZE):
+        # Missing sources are skipped, like the `if os.path.exists()` checks they replace
+        self.jobs = [(src, dst) for src, dst in jobs if os.path.exists(src)]
+        self.copy = copy
+        self.workers = workers
+        self.queue_size = queue_size
+        self.files = 0
+        self.bytes = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._thread_main, name='asset-sync', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        # A failed build stops the copy before removing its staging directory
+        for _, dst in self.jobs:
+            register_writer(dst, self.close)
+        self._thread.start()
+        return self
+
+    def _thread_main(self):
+        try:
+            asyncio.run(self._run())
+        except Exception as exc:
+            self.error = exc
+        self.finished = time.perf_counter()
+
+    async def _run(self):
+        queue = asyncio.Queue(self.queue_size)
+        with ThreadPoolExecutor(self.workers) as executor:
+            consumers = [asyncio.create_task(self._consume(queue, executor)) for _ in range(self.workers)]
+            try:
+                await self._produce(queue)
+            finally:
+                # One stop marker per consumer
+                for _ in consumers:
+                    await queue.put(None)
+                await asyncio.gather(*consumers)
+
+    async def _produce(self, queue):
+        for src, dst in self.jobs:
+            if self._cancelled.is_set():
+                return
+            if not os.path.isdir(src):
+                await queue.put((src, dst))
+                continue
+            for root, dirs, files in os.walk(src):
+                if self._cancelled.is_set():
+                    return
+                dirs.sort()
+                target = os.path.join(dst, os.path.relpath(root, src))
+                os.makedirs(target, exist_ok=True)
+                for name in sorted(files):
+                    await queue.put((os.path.join(root, name), os.path.join(target, name)))
+
+    async def _consume(self, queue, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if self.error is not None or self._cancelled.is_set():
+                # Keep draining so the producer never blocks on a full queue
+                continue
+            src, dst = item
+            try:
+                await loop.run_in_executor(executor, self.copy, src, dst)
+            except Exception as exc:
+                self.error = exc
+                continue
+            self.files += 1
+            self.bytes += os.path.getsize(src)
+
+    def wait(self):
+        """
+        Waits for the copy to finish and prints a summary. Pages written
+        between start() and wait() count as overlapped with the copy.
+        """
+        writing_done = time.perf_counter()
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        if not self.files:
+            return
+        elapsed = self.finished - self.started
+        overlapped = max(min(self.finished, writing_done) - self.started, 0)
+        print(f"Copied {self.files} asset files ({self.bytes / 1024 / 1024:.1f} MB) in {elapsed:.2f}s, "
+              f"{overlapped:.2f}s of it while pages were written")
+
+    def cancel(self):
+        """Asks the copy to stop: files not yet copied are skipped. Does not wait."""
+        self._cancelled.set()
+
+    def close(self):
+        """
+        Cancels the copy if it is still running and waits for the thread to
+        finish. Errors are not raised; safe to call after wait() and more
+        than once.
+        """
+        self.cancel()
+        if self.started is not None:
+            self._thread.join()
+
+
+def start_asset_sync(jobs, copy=shutil.copy2):
+    """Starts copying (src, dst) pairs in the background. Returns the AssetSync."""
+    return AssetSync(jobs, copy).start()
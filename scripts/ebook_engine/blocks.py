@@ -0,0 +1,55 @@
+"""
+Block splitting at top-level container divs.
+
+The generators split the body with re.split() on the container's start tag
+(e.g. <div class="calibre" ...>), which also splits at any matching div
+nested inside another container, cutting a block in the middle of its
+markup. split_blocks() scans the div start and end tags once, tracking
+nesting depth, and splits only at openers that sit at the top level.
+Otherwise it behaves exactly like the re.split() loops it replaces: each
+block runs from its opener to the next top-level opener, and anything before
+the first opener is dropped. scripts/check_blocks.py compares the two on
+sample bodies and on any export given to it.
+"""
+
+import re
+
+# Every div start/end tag, plus comments so that markup inside them is skipped
+DIV_TAG_PATTERN = re.compile(r'<!--.*?-->|<(/?)div\b[^>]*?(/?)>', re.DOTALL | re.IGNORECASE)
+
+
+def iter_block_spans(text, opener):
+    """
+    Yields the (start, end) offsets of each block of text. opener is a
+    compiled pattern matching a container's start tag; only matches at
+    nesting depth 0 start a block.
+    """
+    depth = 0
+    block_start = None
+    for match in DIV_TAG_PATTERN.finditer(text):
+        closing, self_closing = match.group(1), match.group(2)
+        if closing is None:
+            # Comment
+            continue
+        if closing:
+            # A stray end tag does not take the depth below the top level
+            depth = max(depth - 1, 0)
+            continue
+        if depth == 0 and opener.match(text, match.start()):
+            if block_start is not None:
+                yield block_start, match.start()
+            block_start = match.start()
+        if not self_closing:
+            depth += 1
+    if block_start is not None:
+        yield block_start, len(text)
+
+
+def split_blocks(text, opener):
+    """
+    Splits text into blocks at top-level container start tags (see
+    iter_block_spans). opener may be a pattern string or a compiled pattern.
+    """
+    if isinstance(opener, str):
+        opener = re.compile(opener)
+    return [text[start:end] for start, end in iter_block_spans(text, opener)]
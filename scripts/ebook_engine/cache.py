@@ -0,0 +1,126 @@
+"""
+Persistent cache of transformed content blocks.
+
+Ad removal and link rewriting run over every block of a book on every build,
+even when only the splitting heuristic or the template changed. BlockCache
+stores each transformed block in a small sqlite database (one per book under
+.cache/ in the project root), keyed by a hash of the block text, the
+transform version and any extra inputs the transform depends on. Repeated
+builds of the same source then reuse the transformed blocks.
+
+Set EBOOK_HELPER_NO_CACHE=1 to bypass the cache entirely.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+DISABLE_ENV = 'EBOOK_HELPER_NO_CACHE'
+
+
+class BlockCache:
+    """
+    Cache of transform(block) results, keyed by block hash + transform version.
+
+    Bump the version string whenever the transform's behaviour changes, so
+    stale entries are never served. Use as a context manager so new entries
+    are committed in one transaction at the end of the build.
+    """
+
+    def __init__(self, path, version, enabled=None):
+        if enabled is None:
+            enabled = not os.environ.get(DISABLE_ENV)
+        self.path = path
+        self.enabled = enabled
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._pending = []
+        self._db = None
+        if enabled:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path)
+            self._db.execute('CREATE TABLE IF NOT EXISTS blocks (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def key(self, block, extra=''):
+        hasher = hashlib.sha256()
+        for part in (self.version, extra, block):
+            hasher.update(part.encode('utf-8'))
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+    def get_or_compute(self, block, transform, extra=''):
+        """
+        Returns transform(block), from the cache when possible.
+        extra identifies any other input the result depends on (e.g. the page
+        the block is written to).
+        """
+        if self._db is None:
+            return transform(block)
+
+        key = self.key(block, extra)
+        row = self._db.execute('SELECT value FROM blocks WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.hits += 1
+            return row[0]
+
+        value = transform(block)
+        self.misses += 1
+        self._pending.append((key, value))
+        return value
+
+    def get_or_compute_many(self, blocks, compute, extras=None):
+        """
+        get_or_compute() for a list of blocks, with a single compute() call
+        for the ones not in the cache: compute(indices) returns the results
+        for blocks[i] of each index, in order (e.g. from map_blocks(), to
+        transform them in worker processes). extras, if given, holds the
+        extra key of each block.
+        """
+        if extras is None:
+            extras = [''] * len(blocks)
+        results = [None] * len(blocks)
+        missing = []
+        keys = []
+        for index, (block, extra) in enumerate(zip(blocks, extras)):
+            if self._db is None:
+                missing.append(index)
+                continue
+            key = self.key(block, extra)
+            row = self._db.execute('SELECT value FROM blocks WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                results[index] = row[0]
+            else:
+                missing.append(index)
+                keys.append(key)
+
+        if missing:
+            values = compute(missing)
+            for index, value in zip(missing, values):
+                results[index] = value
+            if self._db is not None:
+                self.misses += len(missing)
+                self._pending.extend(zip(keys, values))
+        return results
+
+    def summary(self):
+        if not self.enabled:
+            return "cache disabled"
+        return f"{self.hits} blocks from cache, {self.misses} transformed"
+
+    def close(self):
+        if self._db is None:
+            return
+        if self._pending:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO blocks (key, value) VALUES (?, ?)', self._pending)
+            self._pending = []
+        self._db.close()
+        self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,186 @@
+"""
+Direct EPUB reading with the standard library.
+
+Reads an .epub (a zip file) without a Calibre HTML export: the OPF package
+gives the spine (reading order) and manifest (assets), and the EPUB 3 nav
+document or EPUB 2 NCX gives the table of contents. Spine documents are read
+one at a time, so the whole book never exists as one monolithic HTML string.
+
+All paths are zip member names (e.g. 'OEBPS/Text/chapter01.xhtml').
+"""
+
+import posixpath
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote, urlsplit
+
+from .toc import TocEntry
+
+NS = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'ncx': 'http://www.daisy.org/z3986/2005/ncx/',
+    'xhtml': 'http://www.w3.org/1999/xhtml',
+    'epub': 'http://www.idpf.org/2007/ops',
+}
+
+DOCUMENT_TYPES = ('application/xhtml+xml', 'text/html')
+NCX_TYPE = 'application/x-dtbncx+xml'
+
+BODY_PATTERN = re.compile(r'<body[^>]*>(.*?)</body>', re.DOTALL | re.IGNORECASE)
+
+
+def resolve(base_path, href):
+    """
+    Resolves an href found in the zip member base_path.
+    Returns (member_path, fragment); member_path is None for pure fragments
+    and external URLs.
+    """
+    parts = urlsplit(href)
+    if parts.scheme or parts.netloc:
+        return None, parts.fragment
+    if not parts.path:
+        return None, parts.fragment
+    path = posixpath.normpath(posixpath.join(posixpath.dirname(base_path), unquote(parts.path)))
+    return path, parts.fragment
+
+
+def _text(element):
+    return ' '.join(''.join(element.itertext()).split()) if element is not None else ''
+
+
+class EpubBook:
+    """
+    An open EPUB file.
+
+    Attributes: title, language, spine (document paths in reading order),
+    manifest ({path: media_type}), toc (list of TocEntry in reading order),
+    root (directory of the OPF file inside the zip).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path)
+
+        container = ET.fromstring(self.zip.read('META-INF/container.xml'))
+        rootfile = container.find('.//container:rootfile', NS)
+        if rootfile is None:
+            raise ValueError(f"{path}: no rootfile in META-INF/container.xml")
+        opf_path = rootfile.get('full-path')
+        self.root = posixpath.dirname(opf_path)
+
+        opf = ET.fromstring(self.zip.read(opf_path))
+        self.title = _text(opf.find('.//dc:title', NS)) or posixpath.basename(path)
+        self.language = _text(opf.find('.//dc:language', NS)) or 'en'
+
+        items = {}
+        self.manifest = {}
+        nav_path = None
+        for item in opf.findall('.//opf:manifest/opf:item', NS):
+            item_path = posixpath.normpath(posixpath.join(self.root, unquote(item.get('href'))))
+            media_type = item.get('media-type', '')
+            items[item.get('id')] = item_path
+            self.manifest[item_path] = media_type
+            if 'nav' in (item.get('properties') or '').split():
+                nav_path = item_path
+
+        spine = opf.find('.//opf:spine', NS)
+        self.spine = []
+        for itemref in spine.findall('opf:itemref', NS):
+            item_path = items.get(itemref.get('idref'))
+            if item_path and self.manifest.get(item_path) in DOCUMENT_TYPES:
+                self.spine.append(item_path)
+
+        ncx_path = items.get(spine.get('toc')) if spine.get('toc') else None
+        if ncx_path is None:
+            ncx_path = next((p for p, t in self.manifest.items() if t == NCX_TYPE), None)
+
+        if nav_path:
+            self.toc = self._read_nav(nav_path)
+        elif ncx_path:
+            self.toc = self._read_ncx(ncx_path)
+        else:
+            self.toc = []
+
+    def _read_nav(self, nav_path):
+        """EPUB 3: <nav epub:type="toc"> with nested <ol><li><a href>."""
+        tree = ET.fromstring(self.zip.read(nav_path))
+        toc_nav = None
+        for nav in tree.iter(f"{{{NS['xhtml']}}}nav"):
+            if nav.get(f"{{{NS['epub']}}}type") == 'toc':
+                toc_nav = nav
+                break
+        if toc_nav is None:
+            return []
+
+        entries = []
+
+        def walk(ol, level):
+            for li in ol.findall('xhtml:li', NS):
+                link = li.find('xhtml:a', NS)
+                if link is not None and link.get('href'):
+                    path, fragment = resolve(nav_path, link.get('href'))
+                    if path:
+                        entries.append(TocEntry(level, _text(link), path, fragment))
+                for child in li.findall('xhtml:ol', NS):
+                    walk(child, level + 1)
+
+        for ol in toc_nav.findall('xhtml:ol', NS):
+            walk(ol, 0)
+        return entries
+
+    def _read_ncx(self, ncx_path):
+        """EPUB 2: nested <navPoint> elements in the NCX navMap."""
+        tree = ET.fromstring(self.zip.read(ncx_path))
+        entries = []
+
+        def walk(parent, level):
+            for point in parent.findall('ncx:navPoint', NS):
+                content = point.find('ncx:content', NS)
+                if content is not None and content.get('src'):
+                    path, fragment = resolve(ncx_path, content.get('src'))
+                    if path:
+                        title = _text(point.find('ncx:navLabel/ncx:text', NS))
+                        entries.append(TocEntry(level, title, path, fragment))
+                walk(point, level + 1)
+
+        nav_map = tree.find('ncx:navMap', NS)
+        if nav_map is not None:
+            walk(nav_map, 0)
+        return entries
+
+    def read_text(self, member):
+        return self.zip.read(member).decode('utf-8')
+
+    def read_body(self, member):
+        """Returns the inner HTML of a spine document's <body>."""
+        text = self.read_text(member)
+        match = BODY_PATTERN.search(text)
+        return match.group(1) if match else text
+
+    def iter_spine(self):
+        """Yields (path, body_html) for each spine document, one at a time."""
+        for member in self.spine:
+            yield member, self.read_body(member)
+
+    def assets(self):
+        """Manifest paths that are not documents (images, CSS, fonts)."""
+        for member, media_type in self.manifest.items():
+            if media_type in DOCUMENT_TYPES or media_type == NCX_TYPE:
+                continue
+            yield member
+
+    def relative_to_root(self, member):
+        """The member's path relative to the OPF directory (used as its output path)."""
+        return posixpath.relpath(member, self.root) if self.root else member
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
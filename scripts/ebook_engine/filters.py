@@ -0,0 +1,107 @@
+"""
+Data-driven content filters.
+
+Some sources carry promotional paragraphs injected by ebook piracy sites.
+Instead of hard-coding a list of re.sub() calls in each generator, removal
+rules live in a rule file per book (scripts/filters/<book>.rules) and are
+compiled into a single alternation, so each block is scanned once no matter
+how many rules there are.
+
+Rule file format, one rule per line:
+
+    # comment
+    rule_name: <regular expression>
+
+Patterns are matched with DOTALL and IGNORECASE; matches are removed.
+"""
+
+import hashlib
+import re
+
+from .parallel import map_blocks
+
+
+class ContentFilter:
+    """
+    Removes every match of a set of named rules in one pass per block and
+    counts how often each rule fired.
+    """
+
+    def __init__(self, rules):
+        if not rules:
+            raise ValueError("A content filter needs at least one rule")
+        self.rules = list(rules)
+        self.names = [name for name, _ in self.rules]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("Duplicate rule names in content filter")
+        # Each rule becomes its own named group; earlier rules win when two
+        # match at the same position, as with sequential re.sub() calls
+        self._group_names = [f"rule{i}" for i in range(len(self.rules))]
+        alternation = '|'.join(
+            f'(?P<{group}>{pattern})' for group, (_, pattern) in zip(self._group_names, self.rules)
+        )
+        self.pattern = re.compile(alternation, re.DOTALL | re.IGNORECASE)
+        self.counts = dict.fromkeys(self.names, 0)
+        # Identifies the rule set, e.g. as part of a BlockCache version
+        self.version = hashlib.sha256(
+            '\n'.join(f'{name}: {pattern}' for name, pattern in self.rules).encode('utf-8')
+        ).hexdigest()
+
+    @classmethod
+    def from_file(cls, path):
+        rules = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                name, sep, pattern = line.partition(':')
+                name, pattern = name.strip(), pattern.strip()
+                if not sep or not name or not pattern:
+                    raise ValueError(f"{path}:{line_no}: expected 'name: pattern'")
+                rules.append((name, pattern))
+        return cls(rules)
+
+    def _remove(self, match):
+        for group, name in zip(self._group_names, self.names):
+            if match.group(group) is not None:
+                self.counts[name] += 1
+                break
+        return ''
+
+    def apply(self, block):
+        """Returns the block with every rule match removed."""
+        return self.pattern.sub(self._remove, block)
+
+    def apply_counted(self, block):
+        """
+        Returns (cleaned block, match count per rule) without adding to
+        counts (for map_blocks workers, whose counts would be lost).
+        """
+        counts = [0] * len(self.names)
+
+        def remove(match):
+            for i, group in enumerate(self._group_names):
+                if match.group(group) is not None:
+                    counts[i] += 1
+                    break
+            return ''
+
+        return self.pattern.sub(remove, block), counts
+
+    def apply_blocks(self, source_path, source_text, spans):
+        """
+        apply() for each (start, end) span of source_text, in worker
+        processes for large sources (see map_blocks). Match counts from the
+        workers are added to counts.
+        """
+        results = map_blocks(self.apply_counted, source_path, source_text, spans)
+        for _, counts in results:
+            for name, count in zip(self.names, counts):
+                self.counts[name] += count
+        return [cleaned for cleaned, _ in results]
+
+    def report(self):
+        """One line per rule with its match count."""
+        width = max(len(name) for name in self.names)
+        return '\n'.join(f"  {name:<{width}}  {self.counts[name]}" for name in self.names)
@@ -0,0 +1,53 @@
+"""
+Chapter header detection with one combined pattern.
+
+A generator that finds chapters by their headers (rather than by the anchors
+of a contents page) describes them as a HeaderPattern: one regex with an
+alternative per kind of header (part, chapter, front matter, ...) and the
+priority of those kinds. Instances are picklable, so map_blocks() can run
+them in worker processes; a function defined in the generator script cannot
+be used there, since build_all.py runs the scripts as __main__.
+"""
+
+
+class HeaderPattern:
+    """
+    Finds the highest-priority header near the start of a block.
+
+    Each alternative of pattern ends in its own named title group. kinds
+    lists the alternatives in priority order as (title group, number group
+    or None, is_part_header); a number group is put before the title, as in
+    "第一部 認知革命". Headers sit at the top of a block, so only the first
+    scan_limit characters are searched, and matches do not overlap: a header
+    starting later, or inside the text of an earlier match, is not found
+    (and nothing is reported).
+    """
+
+    def __init__(self, pattern, kinds, scan_limit=4096):
+        self.pattern = pattern
+        self.kinds = [tuple(kind) for kind in kinds]
+        self.scan_limit = scan_limit
+        # lastgroup (the final named group of whichever alternative matched) -> rank
+        self.ranks = {kind[0]: rank for rank, kind in enumerate(self.kinds)}
+
+    def __call__(self, block):
+        """
+        Returns (title, is_part_header) for the block's header, or
+        (None, False) if the block has no header.
+        """
+        best = None
+        best_rank = len(self.kinds)
+        for match in self.pattern.finditer(block, 0, self.scan_limit):
+            rank = self.ranks[match.lastgroup]
+            if rank < best_rank:
+                best, best_rank = match, rank
+                if rank == 0:
+                    break
+
+        if best is None:
+            return None, False
+        title_group, number_group, is_part_header = self.kinds[best_rank]
+        title = best.group(title_group)
+        if number_group:
+            title = f"{best.group(number_group)} {title}"
+        return title, is_part_header
@@ -0,0 +1,222 @@
+"""
+Optional WebP/AVIF variants of a book's images.
+
+Calibre exports keep the original JPEG/PNG/GIF images, which make up most of
+an illustrated book's size. With EBOOK_HELPER_IMAGE_FORMATS set (e.g.
+"avif,webp"), ImageVariants encodes each image a page uses into those
+formats and rewrites its <img> into a <picture>:
+
+    <picture><source srcset="images/00012.jpeg.avif" type="image/avif">
+    <source srcset="images/00012.jpeg.webp" type="image/webp">
+    <img src="images/00012.jpeg" ...></picture>
+
+Browsers take the first format they support and fall back to the original
+<img>, which stays as it was (the lightbox still opens the original).
+
+Encoders are whatever is installed: Pillow (WebP, and AVIF with Pillow
+11.3+ or the pillow-avif-plugin package), otherwise the cwebp / avifenc
+command-line tools. Formats with no encoder are skipped with a note, so the
+build never depends on them. A variant is kept only if it is smaller than
+the original.
+
+Encoded files are cached under .cache/images/ by the hash of the original
+image, so later builds (and other books with the same image) only copy
+them. Images are encoded while the pages using them are written, since the
+page markup depends on which variants exist.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+from urllib.parse import unquote
+
+FORMATS_ENV = 'EBOOK_HELPER_IMAGE_FORMATS'
+
+# Format -> (MIME type, encoder quality)
+IMAGE_FORMATS = {
+    'avif': ('image/avif', 60),
+    'webp': ('image/webp', 80),
+}
+
+# Originals worth transcoding; SVG and the like stay as they are
+SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+IMG_TAG_PATTERN = re.compile(r'<img\b[^>]*?\bsrc="([^"]+)"[^>]*>', re.IGNORECASE)
+
+
+def _pillow_encoder(fmt):
+    """Encoder function using Pillow, or None if Pillow cannot write fmt."""
+    try:
+        from PIL import Image, features
+    except ImportError:
+        return None
+    if fmt == 'avif' and not features.check('avif'):
+        try:
+            # Importing the plugin registers AVIF with older Pillow versions
+            import pillow_avif
+        except ImportError:
+            return None
+    elif fmt == 'webp' and not features.check('webp'):
+        return None
+    quality = IMAGE_FORMATS[fmt][1]
+
+    def encode(src, dst):
+        with Image.open(src) as image:
+            if getattr(image, 'n_frames', 1) > 1:
+                # Animated GIFs stay GIFs
+                raise ValueError("animated image")
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            image.save(dst, format=fmt.upper(), quality=quality)
+
+    encode.name = 'Pillow'
+    return encode
+
+
+def _command_encoder(fmt):
+    """Encoder function using the cwebp / avifenc tools, or None if missing."""
+    quality = str(IMAGE_FORMATS[fmt][1])
+    commands = {
+        'webp': lambda src, dst: ['cwebp', '-quiet', '-q', quality, src, '-o', dst],
+        'avif': lambda src, dst: ['avifenc', '-q', quality, src, dst],
+    }
+    program = commands[fmt]('', '')[0]
+    if shutil.which(program) is None:
+        return None
+
+    def encode(src, dst):
+        if src.lower().endswith('.gif'):
+            # Neither tool reads GIF
+            raise ValueError("unsupported source format")
+        subprocess.run(commands[fmt](src, dst), check=True, capture_output=True)
+
+    encode.name = program
+    return encode
+
+
+def find_encoders(formats):
+    """{format: encoder} for the requested formats that can be encoded here."""
+    encoders = {}
+    for fmt in formats:
+        if fmt not in IMAGE_FORMATS:
+            print(f"Unknown image format '{fmt}' in {FORMATS_ENV}, skipped")
+            continue
+        encoder = _pillow_encoder(fmt) or _command_encoder(fmt)
+        if encoder is None:
+            print(f"No {fmt.upper()} encoder found (Pillow or command-line tool), skipped")
+            continue
+        encoders[fmt] = encoder
+    return encoders
+
+
+class ImageVariants:
+    """
+    Writes smaller variants of the images a site uses and wraps their <img>
+    tags in <picture>. Does nothing unless EBOOK_HELPER_IMAGE_FORMATS is set.
+
+    source_root is the directory image URLs are relative to in the source
+    (the Calibre export folder, which holds images/), out_dir the site
+    being written and cache_dir where encoded files are kept between builds.
+    """
+
+    def __init__(self, source_root, out_dir, cache_dir, formats=None):
+        if formats is None:
+            value = os.environ.get(FORMATS_ENV, '')
+            formats = [name.strip().lower() for name in value.split(',') if name.strip()]
+        self.encoders = find_encoders(formats) if formats else {}
+        self.source_root = source_root
+        self.out_dir = out_dir
+        self.cache_dir = cache_dir
+        # Image URL -> [(variant URL, MIME type)], so shared images are handled once
+        self._variants = {}
+        self.encoded = 0
+        self.cached = 0
+        # Bytes of the originals that got variants, and of the variants per format
+        self.original_bytes = 0
+        self.variant_bytes = dict.fromkeys(self.encoders, 0)
+
+    def _cached_variant(self, src, key, fmt):
+        """
+        Path of the cached fmt variant of src, encoding it on first use.
+        Returns None when the variant is not smaller or cannot be encoded.
+        """
+        encoder = self.encoders[fmt]
+        cache_path = os.path.join(self.cache_dir, f"{key}.{encoder.name}.q{IMAGE_FORMATS[fmt][1]}.{fmt}")
+        # An empty file records a variant that was not worth keeping
+        if os.path.exists(cache_path):
+            self.cached += 1
+            return cache_path if os.path.getsize(cache_path) else None
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp.{fmt}"
+        try:
+            encoder(src, temp_path)
+            keep = os.path.getsize(temp_path) < os.path.getsize(src)
+        except Exception as err:
+            # Pages keep the original for any image that cannot be encoded
+            # (decompression bombs, truncated or unreadable files, tool
+            # errors); ValueError is how the encoders skip animated GIFs and
+            # sources they cannot read, which needs no message
+            if not isinstance(err, ValueError):
+                print(f"Could not encode {src} as {fmt} ({type(err).__name__}: {err}); keeping the original")
+            keep = False
+        if not keep:
+            with open(temp_path, 'wb'):
+                pass
+        os.replace(temp_path, cache_path)
+        self.encoded += 1
+        return cache_path if keep else None
+
+    def variants(self, url):
+        """[(variant URL, MIME type)] for an image URL used by a page."""
+        if not self.encoders:
+            return []
+        if url in self._variants:
+            return self._variants[url]
+        result = []
+        path = unquote(url)
+        src = os.path.join(self.source_root, *path.split('/'))
+        if (path.lower().endswith(SOURCE_EXTENSIONS) and not path.startswith(('/', '..'))
+                and os.path.isfile(src)):
+            with open(src, 'rb') as f:
+                key = hashlib.sha256(f.read()).hexdigest()
+            for fmt, (mime, _) in IMAGE_FORMATS.items():
+                if fmt not in self.encoders:
+                    continue
+                cache_path = self._cached_variant(src, key, fmt)
+                if cache_path is None:
+                    continue
+                dst = os.path.join(self.out_dir, *path.split('/')) + '.' + fmt
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copyfile(cache_path, dst)
+                self.variant_bytes[fmt] += os.path.getsize(cache_path)
+                result.append((f"{url}.{fmt}", mime))
+            if result:
+                self.original_bytes += os.path.getsize(src)
+        self._variants[url] = result
+        return result
+
+    def rewrite(self, html):
+        """Wraps each <img> with smaller variants in a <picture>."""
+        if not self.encoders:
+            return html
+
+        def picture(match):
+            sources = self.variants(match.group(1))
+            if not sources:
+                return match.group(0)
+            tags = ''.join(f'<source srcset="{url}" type="{mime}">' for url, mime in sources)
+            return f'<picture>{tags}{match.group(0)}</picture>'
+
+        return IMG_TAG_PATTERN.sub(picture, html)
+
+    def report(self):
+        """Prints what was transcoded (nothing when transcoding is off)."""
+        if not self.encoders:
+            return
+        sizes = ', '.join(f"{self.variant_bytes[fmt] / 1024 / 1024:.1f} MB {fmt} ({encoder.name})"
+                          for fmt, encoder in self.encoders.items())
+        print(f"Image variants: {self.encoded} encoded, {self.cached} from cache; "
+              f"{self.original_bytes / 1024 / 1024:.1f} MB of originals as {sizes}")
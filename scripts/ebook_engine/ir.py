@@ -0,0 +1,232 @@
+"""
+Book intermediate representation (IR), cached between builds.
+
+Every build used to go from the raw source HTML straight to pages, so each
+template or styling experiment re-ran the whole body extraction, block
+split and chapter detection. save_book() records the result of that parse
+as a small JSON-lines file next to the block cache (.cache/<book>.ir.jsonl):
+
+    {"ir_version": 1, "code": "...", "source_sha256": "...", "source_length": N}
+    {"blocks": [[start, end], ...]}        block spans, offsets into the source
+    {"anchors": {"calibre_link-12": 3}}    anchor ID -> block index
+    {"toc": [[level, title, anchor], ...]}
+    {"assets": ["images/00001.jpg", ...]}
+    {"chapter": {"title": ..., "filename": ..., ...}, "blocks": [first, end]}
+    ...                                     one line per chapter
+
+Blocks are stored as offsets, not text, so the IR stays a few KB. The next
+build loads it with load_book(), which checks the source hash and the code
+key (a hash of the generator's parsing functions and of the engine modules
+they use, see code_version()) and slices the chapters' blocks straight out
+of the source text. Any change to the source or to the splitting code makes
+the IR stale and the book is parsed again; changing a template does not.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import re
+
+from .model import Chapter
+from .toc import TocEntry
+
+IR_VERSION = 1
+
+ID_PATTERN = re.compile(r'\bid="([^"]+)"')
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Engine modules the generators' parsing builds on (block splitting, anchor,
+# header and TOC scanning, content filters, chapter records)
+PARSE_MODULES = ('anchors', 'blocks', 'filters', 'headers', 'model', 'toc')
+
+# Characters of the source encoded at a time when hashing it
+DIGEST_CHUNK = 1024 * 1024
+
+
+class BookIR:
+    """A parsed book: chapters (Chapter records), toc, anchors, assets."""
+
+    def __init__(self, chapters, toc, anchors, assets):
+        self.chapters = chapters
+        self.toc = toc
+        self.anchors = anchors
+        self.assets = assets
+
+
+def _code_text(part):
+    """
+    Text that identifies one part of a generator's parsing code: the source
+    of a function or class, the pattern and flags of a compiled regex, and
+    the values of plain constants (containers are walked). repr() is never
+    used, since it can cut values short (a compiled pattern's repr stops at
+    200 characters).
+    """
+    if inspect.isfunction(part) or inspect.ismethod(part) or inspect.isclass(part):
+        return inspect.getsource(part)
+    if isinstance(part, re.Pattern):
+        return f"re:{part.flags}:{part.pattern}"
+    if isinstance(part, (list, tuple)):
+        return f"{type(part).__name__}[" + ",".join(_code_text(item) for item in part) + "]"
+    if isinstance(part, dict):
+        return "dict{" + ",".join(f"{_code_text(key)}:{_code_text(value)}"
+                                  for key, value in part.items()) + "}"
+    if part is None or isinstance(part, (str, int, float, bool)):
+        return json.dumps(part, ensure_ascii=False)
+    raise TypeError(f"code_version() cannot hash a {type(part).__name__}")
+
+
+def code_version(*parse_code):
+    """
+    Hash of the code that parses a book, used as the IR's code key.
+    parse_code is the generator's parsing functions (their source is hashed)
+    and the constants they read, such as a compiled header pattern (its
+    pattern and flags are hashed, see _code_text()); the engine modules in
+    PARSE_MODULES are always included. Template, output or styling changes
+    keep the IR.
+    """
+    hasher = hashlib.sha256()
+    for part in parse_code:
+        hasher.update(_code_text(part).encode('utf-8'))
+        hasher.update(b'\0')
+    for name in PARSE_MODULES:
+        with open(os.path.join(_PACKAGE_DIR, f"{name}.py"), 'rb') as f:
+            hasher.update(f.read())
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+def list_assets(source_dir, *subdirs):
+    """Paths (relative to source_dir, '/'-separated) of the files in subdirs."""
+    assets = []
+    for subdir in subdirs:
+        for root, dirs, files in os.walk(os.path.join(source_dir, subdir)):
+            dirs.sort()
+            for name in sorted(files):
+                assets.append(os.path.relpath(os.path.join(root, name), source_dir).replace(os.sep, '/'))
+    return assets
+
+
+def _source_digest(source_text):
+    """SHA-256 of the UTF-8 source, encoded a chunk at a time (no full copy)."""
+    hasher = hashlib.sha256()
+    for start in range(0, len(source_text), DIGEST_CHUNK):
+        hasher.update(source_text[start:start + DIGEST_CHUNK].encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def _chapter(meta, source_text, ranges):
+    """
+    A Chapter for an IR chapter record; records with keys a Chapter does
+    not carry stay dicts, with their blocks sliced out.
+    """
+    fields = {key: value for key, value in meta.items() if key not in ('title', 'filename')}
+    if set(fields) <= set(Chapter.FIELDS):
+        return Chapter.from_ranges(meta["title"], meta["filename"], source_text, ranges, **fields)
+    ch = dict(meta)
+    ch["content_blocks"] = [source_text[start:stop] for start, stop in ranges]
+    return ch
+
+
+def locate_blocks(source_text, blocks, start=0):
+    """
+    Returns the [start, end) span of each block in source_text. Blocks must
+    be consecutive, unmodified slices of the source (as produced by
+    re.split); anything between them (e.g. leading whitespace) is skipped.
+    """
+    spans = []
+    position = start
+    for block in blocks:
+        found = source_text.find(block, position)
+        if found < 0:
+            raise ValueError("Block is not a slice of the source text")
+        position = found + len(block)
+        spans.append((found, position))
+    return spans
+
+
+def save_book(path, source_text, code_key, chapters, blocks, body_start=0, toc=(), assets=()):
+    """
+    Writes the IR for chapters built from blocks (consecutive slices of
+    source_text starting at body_start). Each chapter's content_blocks must
+    be the next run of those block objects, which holds for any splitter
+    that only groups blocks; otherwise nothing is written. Returns the
+    BookIR either way; once written, its chapters refer to source_text by
+    offset, so the caller can drop its block strings.
+    """
+    spans = locate_blocks(source_text, blocks, body_start)
+
+    # Chapters are consecutive runs of blocks: record [first, end) per chapter
+    ranges = []
+    cursor = 0
+    for ch in chapters:
+        count = len(ch["content_blocks"])
+        run = blocks[cursor:cursor + count]
+        if len(run) != count or any(a is not b for a, b in zip(run, ch["content_blocks"])):
+            print(f"Chapters are not runs of source blocks; not writing {path}")
+            return BookIR(chapters, list(toc), {}, list(assets))
+        ranges.append((cursor, cursor + count))
+        cursor += count
+
+    anchors = {}
+    for index, block in enumerate(blocks):
+        for anchor in ID_PATTERN.findall(block):
+            anchors.setdefault(anchor, index)
+
+    records = [
+        {"ir_version": IR_VERSION, "code": code_key,
+         "source_sha256": _source_digest(source_text), "source_length": len(source_text)},
+        {"blocks": spans},
+        {"anchors": anchors},
+        {"toc": [[entry.level, entry.title, entry.fragment] for entry in toc]},
+        {"assets": list(assets)},
+    ]
+    for ch, block_range in zip(chapters, ranges):
+        meta = {key: value for key, value in ch.items() if key != "content_blocks"}
+        records.append({"chapter": meta, "blocks": block_range})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write('\n')
+    os.replace(tmp_path, path)
+
+    # Hand back chapters that refer to the source by offset
+    compact = []
+    for record in records[5:]:
+        first, end = record["blocks"]
+        compact.append(_chapter(record["chapter"], source_text, spans[first:end]))
+    return BookIR(compact, list(toc), anchors, list(assets))
+
+
+def load_book(path, source_text, code_key):
+    """
+    Rebuilds the book from its IR. Returns None if there is no IR, or if it
+    was written for a different source, code key or IR version.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    try:
+        header = json.loads(lines[0])
+        if (header.get("ir_version") != IR_VERSION or header.get("code") != code_key
+                or header.get("source_length") != len(source_text)
+                or header.get("source_sha256") != _source_digest(source_text)):
+            return None
+        spans = json.loads(lines[1])["blocks"]
+        anchors = json.loads(lines[2])["anchors"]
+        toc = [TocEntry(level, title, None, anchor) for level, title, anchor in json.loads(lines[3])["toc"]]
+        assets = json.loads(lines[4])["assets"]
+        chapters = []
+        for line in lines[5:]:
+            record = json.loads(line)
+            first, end = record["blocks"]
+            chapters.append(_chapter(record["chapter"], source_text, spans[first:end]))
+    except (IndexError, KeyError, ValueError, TypeError):
+        # Truncated or hand-edited IR: parse the source again
+        return None
+    return BookIR(chapters, toc, anchors, assets)
@@ -0,0 +1,122 @@
+"""
+Compact chapter records.
+
+Chapters used to be dicts holding a list of block strings each, and
+re.split() hands those blocks out as copies of the source, so a large book
+sat in memory twice (three times while the body slice was alive) for the
+whole build. A Chapter keeps the source text by reference and its blocks as
+(start, end) offset pairs in a flat array('q'), 16 bytes per block; the
+block strings are sliced out only when content_blocks is read, i.e. while
+the chapter's page is being written, and freed right after.
+
+Chapter also answers the chapter-dict keys the generators use
+(ch["title"], ch.get("continuation_of"), ch["content_blocks"], ...), so it
+drops into the existing page loops and split_oversized() unchanged.
+"""
+
+from array import array
+
+
+class Chapter:
+    """One output page whose blocks are offset ranges into the source text."""
+
+    __slots__ = ('title', 'filename', 'is_part_header', 'continuation_of', 'source', 'spans', 'blocks')
+
+    # Keys answered by ch[key], besides "content_blocks"
+    FIELDS = ('title', 'filename', 'is_part_header', 'continuation_of')
+
+    def __init__(self, title, filename, source, spans=(), is_part_header=False, continuation_of=None):
+        self.title = title
+        self.filename = filename
+        self.is_part_header = is_part_header
+        self.continuation_of = continuation_of
+        self.source = source
+        # Flat [start0, end0, start1, end1, ...]
+        self.spans = array('q', spans)
+        # Explicit block strings, set only when blocks were rewritten
+        self.blocks = None
+
+    @classmethod
+    def from_ranges(cls, title, filename, source, ranges, **fields):
+        """Builds a chapter from an iterable of (start, end) pairs."""
+        return cls(title, filename, source, [offset for span in ranges for offset in span], **fields)
+
+    @property
+    def content_blocks(self):
+        """The chapter's blocks as strings (sliced from the source on each access)."""
+        if self.blocks is not None:
+            return self.blocks
+        source = self.source
+        spans = self.spans
+        return [source[spans[i]:spans[i + 1]] for i in range(0, len(spans), 2)]
+
+    def block_count(self):
+        return len(self.blocks) if self.blocks is not None else len(self.spans) // 2
+
+    def finditer(self, pattern):
+        """
+        Matches of a compiled pattern in each block, in block order. Blocks
+        still sliced from the source are searched in place, without copying.
+        """
+        if self.blocks is not None:
+            for block in self.blocks:
+                yield from pattern.finditer(block)
+            return
+        spans = self.spans
+        for i in range(0, len(spans), 2):
+            yield from pattern.finditer(self.source, spans[i], spans[i + 1])
+
+    def copy(self):
+        ch = Chapter(self.title, self.filename, self.source, self.spans, self.is_part_header, self.continuation_of)
+        if self.blocks is not None:
+            ch.blocks = list(self.blocks)
+        return ch
+
+    # Chapter-dict compatibility
+
+    def keys(self):
+        keys = ['title', 'filename', 'content_blocks', 'is_part_header']
+        if self.continuation_of is not None:
+            keys.append('continuation_of')
+        return keys
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key == 'content_blocks':
+            return self.content_blocks
+        if key in self.FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        value = self[key] if key in self.keys() else None
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        if key == 'content_blocks':
+            # Rewritten blocks (e.g. relinked sub-pages) no longer match the source
+            self.blocks = list(value)
+            self.spans = array('q')
+        elif key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return f"Chapter({self.title!r}, {self.filename!r}, {self.block_count()} blocks)"
+
+
+def source_spans(chapters, source):
+    """
+    The (start, end) offsets into source of every block of the chapters, in
+    order, or None if any chapter does not slice source as is (a chapter
+    dict, or a Chapter whose blocks were rewritten, e.g. by split_oversized).
+    """
+    spans = []
+    for ch in chapters:
+        if not isinstance(ch, Chapter) or ch.blocks is not None or ch.source is not source:
+            return None
+        spans.extend(zip(ch.spans[0::2], ch.spans[1::2]))
+    return spans
@@ -0,0 +1,242 @@
+"""
+Offline support: a generated service worker for every site.
+
+"Offline-first" used to mean only "no CDN". write_service_worker() runs after
+a site is written and adds sw.js, which
+
+- precaches the app shell (index.html and every stylesheet/script; the TOC
+  is part of each page) when the site is first opened,
+- caches chapters and images as they are read (cache first, network as
+  fallback), so anything read once is available offline,
+- prefetches the next chapter in reading order whenever a chapter is opened,
+  using the page order the generator already computed for prev/next buttons.
+
+Every file's content hash goes into the cache version, so a rebuild that
+changes anything installs a fresh cache and drops the old one; unchanged
+rebuilds produce a byte-identical sw.js and readers keep their cache.
+
+Files from the cross-book asset store (see ebook_engine.shared) live
+outside the site; they are precached like the site's own scripts and
+served by the worker too, since the pages that load them are its clients.
+
+Pages register the worker with SERVICE_WORKER_TAG (bound into the template's
+{site_scripts} field). Browsers only run service workers over http(s), so
+opening the files directly from disk behaves exactly as before.
+
+prefetch_hints() covers browsers without the worker (and the very first
+visit): each page's {head_links} field gets <link rel="prefetch"> hints for
+the next chapter and its first images, plus a speculation rule that
+prerenders the next chapter when EBOOK_HELPER_PRERENDER is set.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from .model import Chapter
+
+SERVICE_WORKER_NAME = 'sw.js'
+
+# Precached on install; everything else is cached when first fetched
+SHELL_EXTENSIONS = ('.css', '.js')
+
+PRERENDER_ENV = 'EBOOK_HELPER_PRERENDER'
+# Images of the next chapter worth fetching ahead (the ones seen first)
+PREFETCH_IMAGE_COUNT = 2
+
+IMG_SRC_PATTERN = re.compile(r'<img\b[^>]*?\bsrc="([^"]+)"', re.IGNORECASE)
+
+SERVICE_WORKER_TAG = """<script>
+        if ('serviceWorker' in navigator && location.protocol.startsWith('http')) {
+            navigator.serviceWorker.register('sw.js');
+        }
+    </script>"""
+
+SERVICE_WORKER_TEMPLATE = r"""// Offline cache for this book (generated by ebook_engine.offline)
+const CACHE_NAME = 'ebook-site-__VERSION__';
+const PRECACHE = __PRECACHE__;
+// Precached files outside the site (the shared asset store)
+const SHARED = new Set(PRECACHE.map(path => new URL(path, self.registration.scope).href)
+    .filter(url => !url.startsWith(self.registration.scope)));
+// Reading order, for prefetching the next chapter
+const PAGES = __PAGES__;
+
+function pathOf(url) {
+    const path = url.split('#')[0].split('?')[0].slice(self.registration.scope.length);
+    return path === '' || path.endsWith('/') ? path + 'index.html' : path;
+}
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_NAME)
+            .then(cache => cache.addAll(PRECACHE))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys
+                .filter(key => key.startsWith('ebook-site-') && key !== CACHE_NAME)
+                .map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+async function cacheFirst(request) {
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(request, {ignoreSearch: true});
+    if (cached) return cached;
+    try {
+        const response = await fetch(request);
+        if (response.ok) await cache.put(request, response.clone());
+        return response;
+    } catch (err) {
+        // Offline and never read: fall back to the cover page for navigations
+        if (request.mode === 'navigate') {
+            const fallback = await cache.match('index.html');
+            if (fallback) return fallback;
+        }
+        throw err;
+    }
+}
+
+async function prefetchAfter(path) {
+    const position = PAGES.indexOf(path);
+    if (position < 0 || position + 1 >= PAGES.length) return;
+    const next = PAGES[position + 1];
+    const cache = await caches.open(CACHE_NAME);
+    if (!(await cache.match(next))) {
+        const response = await fetch(next);
+        if (response.ok) await cache.put(next, response);
+    }
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    if (!request.url.startsWith(self.registration.scope) && !SHARED.has(request.url)) return;
+    event.respondWith(cacheFirst(request));
+    if (request.mode === 'navigate') {
+        event.waitUntil(prefetchAfter(pathOf(request.url)).catch(() => {}));
+    }
+});
+"""
+
+
+def _site_files(out_dir):
+    """Relative URL paths of every file in the site, sorted."""
+    paths = []
+    for root, dirs, files in os.walk(out_dir):
+        dirs.sort()
+        for name in sorted(files):
+            paths.append(os.path.relpath(os.path.join(root, name), out_dir).replace(os.sep, '/'))
+    return paths
+
+
+def write_service_worker(out_dir, page_order, shared=()):
+    """
+    Writes sw.js into a finished site. page_order is the list of page
+    filenames in reading order (the same order as the prev/next buttons);
+    shared lists the URLs of files the site uses from the shared asset
+    store (SiteFiles.shared). Call it after every other file has been
+    written.
+    """
+    # A page listed twice (e.g. two sections written to index.html) is read once
+    page_order = list(dict.fromkeys(page_order))
+    site_hash = hashlib.sha256()
+    precache = ['index.html']
+    for path in _site_files(out_dir):
+        if path == SERVICE_WORKER_NAME:
+            continue
+        file_hash = hashlib.sha256()
+        with open(os.path.join(out_dir, *path.split('/')), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                file_hash.update(chunk)
+        site_hash.update(f"{path}\0{file_hash.hexdigest()}\n".encode('utf-8'))
+        if path.endswith(SHELL_EXTENSIONS):
+            precache.append(path)
+    # Store files are named by their content hash, so their URLs stand for it
+    for url in shared:
+        site_hash.update(f"{url}\n".encode('utf-8'))
+        precache.append(url)
+
+    script = (SERVICE_WORKER_TEMPLATE
+              .replace('__VERSION__', site_hash.hexdigest()[:16])
+              .replace('__PRECACHE__', json.dumps(precache, ensure_ascii=False))
+              .replace('__PAGES__', json.dumps(page_order, ensure_ascii=False)))
+    with open(os.path.join(out_dir, SERVICE_WORKER_NAME), 'w', encoding='utf-8') as f:
+        f.write(script)
+    print(f"Wrote {SERVICE_WORKER_NAME} ({len(precache)} precached files, {len(page_order)} pages)")
+
+
+def refresh_service_worker(out_dir):
+    """
+    Rewrites an existing site's sw.js after files were changed in place
+    (e.g. a theme copied in by build_all.py --watch), keeping its page
+    order, so readers' caches pick up the change. Returns False if the
+    site has no service worker.
+    """
+    path = os.path.join(out_dir, SERVICE_WORKER_NAME)
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        script = f.read()
+    pages = re.search(r'^const PAGES = (.*);$', script, re.MULTILINE)
+    precache = re.search(r'^const PRECACHE = (.*);$', script, re.MULTILINE)
+    # Precached URLs outside the site are the shared store files
+    shared = [url for url in json.loads(precache.group(1)) if url.startswith('../')] if precache else []
+    write_service_worker(out_dir, json.loads(pages.group(1)) if pages else [], shared)
+    return True
+
+
+def image_refs(blocks, limit=PREFETCH_IMAGE_COUNT):
+    """The first limit distinct image URLs in blocks (data: URLs skipped)."""
+    sources = (match.group(1) for block in blocks for match in IMG_SRC_PATTERN.finditer(block))
+    return _first_images(sources, limit)
+
+
+def chapter_images(chapter, limit=PREFETCH_IMAGE_COUNT):
+    """
+    The first limit image URLs of a chapter (a Chapter record or chapter
+    dict), for prefetch_hints(). Collect them once per chapter, before the
+    page loop; a Chapter's blocks are scanned in the source without being
+    sliced out.
+    """
+    if isinstance(chapter, Chapter):
+        return _first_images((match.group(1) for match in chapter.finditer(IMG_SRC_PATTERN)), limit)
+    return image_refs(chapter["content_blocks"], limit)
+
+
+def _first_images(sources, limit):
+    images = []
+    for src in sources:
+        if len(images) >= limit:
+            break
+        if src not in images and not src.startswith('data:'):
+            images.append(src)
+    return images
+
+
+def prefetch_hints(next_filename, next_images=(), image_variants=None):
+    """
+    <head> markup asking the browser to fetch the next chapter, and its
+    first images (next_images, from chapter_images()), while the current
+    one is read. With image_variants (an ImageVariants), an image that has
+    WebP/AVIF variants is prefetched as the one its <picture> lists first,
+    which is what the browser will load.
+    """
+    links = [f'<link rel="prefetch" href="{next_filename}">']
+    for src in next_images:
+        variants = image_variants.variants(src) if image_variants is not None else []
+        if variants:
+            url, mime = variants[0]
+            links.append(f'<link rel="prefetch" href="{url}" as="image" type="{mime}">')
+        else:
+            links.append(f'<link rel="prefetch" href="{src}" as="image">')
+    if os.environ.get(PRERENDER_ENV):
+        rules = json.dumps({"prerender": [{"source": "list", "urls": [next_filename]}]})
+        links.append(f'<script type="speculationrules">{rules}</script>')
+    return "\n    ".join(links)
@@ -0,0 +1,203 @@
+"""
+Staged output directories.
+
+Generators used to rmtree() their output directory and write into it page by
+page, so a crashed build, or two builds writing the same dist/, left the
+served site half-empty. staged_output() gives the build a fresh staging
+directory next to the real one and swaps it into place only once the build
+has finished. Readers (e.g. a running http.server) see either the complete
+old site or the complete new one.
+
+With EBOOK_HELPER_SYNC_OUTPUT set (build_all.py --watch sets it for its
+rebuilds), the finished staging directory is merged into the existing
+output instead: only files whose content changed are replaced, and files
+the new build no longer has are removed, so a rebuild after a small edit
+touches only the pages that edit changed.
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+import filecmp
+import os
+import shutil
+import tempfile
+
+SYNC_ENV = 'EBOOK_HELPER_SYNC_OUTPUT'
+
+# renameat2() flag for exchanging two paths atomically (Linux >= 3.15)
+_RENAME_EXCHANGE = 2
+_AT_FDCWD = -100
+
+
+# Stop functions of background writers (e.g. AssetSync) by the path they
+# write to; see register_writer()
+_writers = []
+
+
+def register_writer(path, stop):
+    """
+    Registers a background writer (e.g. an AssetSync copying into a staging
+    directory). If the build fails, staged_output() calls stop(), which must
+    return once the writer no longer touches path, before it removes the
+    staging directory; otherwise the removal races with the writer.
+    """
+    _writers.append((os.path.abspath(path), stop))
+
+
+def _stop_writers(staging_dir, stop):
+    """Forgets the writers inside staging_dir, calling their stop() if asked."""
+    prefix = os.path.abspath(staging_dir) + os.sep
+    inside = [writer for writer in _writers if (writer[0] + os.sep).startswith(prefix)]
+    for writer in inside:
+        _writers.remove(writer)
+    if stop:
+        for _, stop_writer in inside:
+            stop_writer()
+
+
+def _load_renameat2():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return None
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    renameat2.restype = ctypes.c_int
+    return renameat2
+
+
+_renameat2 = _load_renameat2()
+
+
+def _exchange(a, b):
+    """Atomically swaps two existing paths. Returns False if unsupported."""
+    if _renameat2 is None:
+        return False
+    result = _renameat2(_AT_FDCWD, os.fsencode(a), _AT_FDCWD, os.fsencode(b), _RENAME_EXCHANGE)
+    return result == 0
+
+
+def _default_dir_mode():
+    # mkdtemp() creates 0700 directories; the site must stay readable
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o777 & ~umask
+
+
+def swap_into_place(staging_dir, output_dir):
+    """
+    Replaces output_dir with staging_dir.
+    Uses an atomic exchange where the OS supports it; otherwise the old
+    directory is renamed aside and the new one renamed in (two renames, so
+    there is a very short window without output_dir).
+    """
+    parent = os.path.dirname(os.path.abspath(output_dir))
+    name = os.path.basename(os.path.normpath(output_dir))
+
+    if not os.path.lexists(output_dir):
+        os.rename(staging_dir, output_dir)
+        return
+
+    if _exchange(staging_dir, output_dir):
+        # staging_dir now holds the previous build
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return
+
+    retired = tempfile.mkdtemp(prefix=f'.{name}.old-', dir=parent)
+    old_path = os.path.join(retired, name)
+    os.rename(output_dir, old_path)
+    os.rename(staging_dir, output_dir)
+    shutil.rmtree(retired, ignore_errors=True)
+
+
+def same_file(a, b):
+    """
+    True if b exists with the same content as a. Files copied with their
+    timestamps (copy2) match on size and mtime without being read.
+    """
+    try:
+        stat_a, stat_b = os.stat(a), os.stat(b)
+    except FileNotFoundError:
+        return False
+    if stat_a.st_size != stat_b.st_size:
+        return False
+    if stat_a.st_mtime_ns == stat_b.st_mtime_ns:
+        return True
+    return filecmp.cmp(a, b, shallow=False)
+
+
+def sync_file(src, dst):
+    """
+    Copies src over dst unless dst already has the same content; the copy
+    replaces dst in one rename. Returns True if dst was written.
+    """
+    if same_file(src, dst):
+        return False
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = f"{dst}.tmp"
+    shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+    return True
+
+
+def sync_into_place(staging_dir, output_dir):
+    """
+    Merges staging_dir into output_dir: each changed or new file is moved
+    into place, files missing from staging_dir are deleted, and
+    staging_dir is removed. Returns (updated, removed) file counts.
+    """
+    updated = 0
+    staged = set()
+    for root, dirs, files in os.walk(staging_dir):
+        relative = os.path.relpath(root, staging_dir)
+        target_root = os.path.normpath(os.path.join(output_dir, relative))
+        os.makedirs(target_root, exist_ok=True)
+        for name in files:
+            staged.add(os.path.normpath(os.path.join(relative, name)))
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if not same_file(source, target):
+                os.replace(source, target)
+                updated += 1
+
+    removed = 0
+    for root, dirs, files in os.walk(output_dir, topdown=False):
+        relative = os.path.relpath(root, output_dir)
+        for name in files:
+            if os.path.normpath(os.path.join(relative, name)) not in staged:
+                os.remove(os.path.join(root, name))
+                removed += 1
+        if root != output_dir and not os.listdir(root):
+            os.rmdir(root)
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    return updated, removed
+
+
+@contextlib.contextmanager
+def staged_output(output_dir):
+    """
+    Yields an empty staging directory on the same filesystem as output_dir.
+    When the block completes, the staging directory replaces output_dir; if
+    it raises, background writers registered inside the staging directory
+    (see register_writer) are stopped, the staging directory is removed and
+    output_dir is untouched.
+    """
+    parent = os.path.dirname(os.path.abspath(output_dir))
+    name = os.path.basename(os.path.normpath(output_dir))
+    os.makedirs(parent, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=f'.{name}.staging-', dir=parent)
+    os.chmod(staging_dir, _default_dir_mode())
+    try:
+        yield staging_dir
+    except BaseException:
+        _stop_writers(staging_dir, stop=True)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    _stop_writers(staging_dir, stop=False)
+    if os.environ.get(SYNC_ENV) and os.path.isdir(output_dir):
+        updated, removed = sync_into_place(staging_dir, output_dir)
+        print(f"Updated {updated} files in {output_dir} ({removed} removed)")
+        return
+    swap_into_place(staging_dir, output_dir)
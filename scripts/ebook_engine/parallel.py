@@ -0,0 +1,117 @@
+"""
+Per-block work fanned out to a process pool.
+
+Header detection and block transforms look at one block at a time, so on a
+multi-hundred-MB source they can run on every core. map_blocks() takes the
+block boundaries the generator already found (offsets into the source text),
+converts them to byte ranges of the source file and hands contiguous runs of
+ranges to worker processes. Each worker maps the file with mmap and decodes
+only its own blocks, so no block text is pickled on the way in; results come
+back in block order.
+
+Small sources are processed in-process, since starting workers costs more
+than it saves. EBOOK_HELPER_WORKERS sets the number of processes (1 turns
+the pool off); the default is one per CPU. A generator run by build_all.py
+is itself in a pool worker, and those workers can start processes, so
+build_all.py sets EBOOK_HELPER_WORKERS for each book to share the CPUs
+between the books it builds at once. When the pool fails (func cannot be
+pickled, a worker dies, processes cannot be started), the blocks are
+processed in-process too.
+
+func is pickled to the workers, so it must be importable by them: a
+function or a picklable object (e.g. a bound method) from ebook_engine, not
+one defined in a generator script, which build_all.py runs as __main__.
+"""
+
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+WORKERS_ENV = 'EBOOK_HELPER_WORKERS'
+
+# Sources smaller than this are not worth a process pool
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+
+# Tasks per worker, so uneven blocks still spread over all processes
+TASKS_PER_WORKER = 4
+
+
+def worker_count():
+    """Process count from EBOOK_HELPER_WORKERS, or the number of CPUs."""
+    value = os.environ.get(WORKERS_ENV)
+    if value:
+        return max(int(value), 1)
+    return os.cpu_count() or 1
+
+
+def byte_spans(text, spans):
+    """
+    Converts ascending (start, end) character offsets into text to UTF-8
+    byte offsets, encoding each stretch of text once.
+    """
+    result = []
+    position = 0
+    byte_position = 0
+    for start, end in spans:
+        byte_position += len(text[position:start].encode('utf-8'))
+        byte_start = byte_position
+        byte_position += len(text[start:end].encode('utf-8'))
+        result.append((byte_start, byte_position))
+        position = end
+    return result
+
+
+def _map_range(func, path, ranges, args):
+    """Worker: func() of each byte range of the file at path, decoded."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        if args is None:
+            return [func(view[start:end].decode('utf-8')) for start, end in ranges]
+        return [func(view[start:end].decode('utf-8'), arg) for (start, end), arg in zip(ranges, args)]
+
+
+def _map_serial(func, source_text, spans, args):
+    if args is None:
+        return [func(source_text[start:end]) for start, end in spans]
+    return [func(source_text[start:end], arg) for (start, end), arg in zip(spans, args)]
+
+
+def map_blocks(func, source_path, source_text, spans, workers=None, args=None):
+    """
+    Returns [func(source_text[start:end]) for start, end in spans], or
+    func(block, arg) with args, a list of one extra argument per span.
+    source_text must be the UTF-8 decoded contents of source_path and func
+    importable by the workers (see above). Falls back to running in this
+    process for small sources, a single worker, no source_path, a file
+    whose bytes do not line up with source_text (e.g. CRLF line endings
+    translated on read), or a pool that cannot be used.
+    """
+    if workers is None:
+        workers = worker_count()
+    spans = list(spans)
+    if args is not None:
+        args = list(args)
+    if (source_path is None or workers < 2 or len(spans) < workers
+            or os.path.getsize(source_path) < PARALLEL_MIN_BYTES):
+        return _map_serial(func, source_text, spans, args)
+
+    ranges = byte_spans(source_text, spans)
+    tail = len(source_text[spans[-1][1]:].encode('utf-8'))
+    if ranges[-1][1] + tail != os.path.getsize(source_path):
+        return _map_serial(func, source_text, spans, args)
+
+    chunk = -(-len(ranges) // (workers * TASKS_PER_WORKER))
+    starts = range(0, len(ranges), chunk)
+    chunks = [ranges[i:i + chunk] for i in starts]
+    arg_chunks = [None if args is None else args[i:i + chunk] for i in starts]
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for part in pool.map(_map_range, [func] * len(chunks), [source_path] * len(chunks),
+                                 chunks, arg_chunks):
+                results.extend(part)
+    except Exception as err:
+        # No usable pool (func not picklable, a worker died, no processes
+        # can be started, ...). An error raised by func itself recurs below.
+        print(f"Process pool unavailable ({type(err).__name__}: {err}); processing blocks in this process")
+        return _map_serial(func, source_text, spans, args)
+    return results
@@ -0,0 +1,124 @@
+"""
+Reading position and progress, shared by every page of a site.
+
+READING_SCRIPT is the same for every book, so SiteFiles (ebook_engine.shared)
+writes it once as reading.js and pages load it through the template's
+{site_scripts} field: one small file fetched once and then served from the
+browser and service worker caches, not code repeated in every chapter. It
+
+- remembers the last block read (the first visible child of
+  .chapter-content) per book in localStorage, using an IntersectionObserver
+  rather than a scroll listener, and returns to it when that page is
+  opened again,
+- shows a thin progress bar and offers a "continue" link on the cover,
+- computes the percentage from a chapter-length table generated at build
+  time (the text length of every page), so no page layout is measured.
+
+write_reading_table() writes that table, the book's own part, as
+reading_pages.js once the pages are written.
+
+Within a page, every block counts the same. Positions are stored under the
+site's directory path, so books hosted side by side keep separate positions.
+Browsers without IntersectionObserver or localStorage just read as before.
+"""
+
+import json
+import os
+import re
+
+READING_SCRIPT_NAME = 'reading.js'
+READING_TABLE_NAME = 'reading_pages.js'
+
+# Markup and whitespace, which do not count towards a page's length
+MARKUP_PATTERN = re.compile(r'<[^>]*>|\s+')
+
+READING_SCRIPT = r"""// Reading position and progress (generated by ebook_engine.reading)
+(function () {
+    // [page, text length] in reading order, from reading_pages.js
+    const PAGES = self.READING_PAGES || [];
+    const KEY = 'ebook-position:' + location.pathname.replace(/[^\/]*$/, '');
+    const page = decodeURIComponent(location.pathname.split('/').pop()) || 'index.html';
+    const index = PAGES.findIndex(entry => entry[0] === page);
+    const content = document.querySelector('.chapter-content');
+    if (index < 0 || !content || !('IntersectionObserver' in window)) return;
+
+    let before = 0, total = 0;
+    PAGES.forEach((entry, i) => {
+        if (i < index) before += entry[1];
+        total += entry[1];
+    });
+
+    function load() {
+        try { return JSON.parse(localStorage.getItem(KEY)); } catch (err) { return null; }
+    }
+    function save(position) {
+        try { localStorage.setItem(KEY, JSON.stringify(position)); } catch (err) {}
+    }
+
+    const bar = document.createElement('div');
+    bar.className = 'reading-progress';
+    bar.style.cssText = 'position:fixed;top:0;left:0;height:3px;background:currentColor;'
+        + 'opacity:0.4;pointer-events:none;z-index:1000;width:0';
+    document.body.appendChild(bar);
+
+    const blocks = Array.from(content.children);
+    const order = new Map(blocks.map((block, i) => [block, i]));
+    const saved = load();
+    // The cover keeps the saved position until the reader moves on
+    let resuming = false;
+    if (saved && saved.page === page) {
+        // Back on the page last read; a link to an anchor wins
+        if (!location.hash && blocks[saved.block]) blocks[saved.block].scrollIntoView();
+    } else if (saved && index === 0 && PAGES.some(entry => entry[0] === saved.page)) {
+        resuming = true;
+        const tocLink = document.querySelector('.toc a[href="' + saved.page + '"]');
+        const link = document.createElement('a');
+        link.href = saved.page;
+        link.className = 'nav-btn resume';
+        link.textContent = '↪ ' + (tocLink ? tocLink.textContent : saved.page) + ' (' + saved.percent + '%)';
+        const footer = document.querySelector('.navigation-footer');
+        if (footer) footer.insertBefore(link, footer.firstChild);
+    }
+
+    const visible = new Set();
+    let pending = null;
+    const observer = new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (entry.isIntersecting) visible.add(order.get(entry.target));
+            else visible.delete(order.get(entry.target));
+        });
+        if (!visible.size) return;
+        const block = Math.min(...visible);
+        const within = blocks.length ? PAGES[index][1] * block / blocks.length : 0;
+        const percent = total ? Math.round(1000 * (before + within) / total) / 10 : 0;
+        bar.style.width = percent + '%';
+        if (resuming && block === 0) return;
+        resuming = false;
+        // One localStorage write once scrolling pauses
+        clearTimeout(pending);
+        pending = setTimeout(() => save({page: page, block: block, percent: percent}), 500);
+    });
+    blocks.forEach(block => observer.observe(block));
+})();
+"""
+
+
+def text_length(html):
+    """Length of the text in an HTML fragment (markup and whitespace excluded)."""
+    return len(MARKUP_PATTERN.sub('', html))
+
+
+def write_reading_table(out_dir, page_lengths):
+    """
+    Writes reading_pages.js into a site. page_lengths is the list of
+    (filename, text length) of every page in reading order, e.g. collected
+    with text_length(content) while the pages are written.
+    """
+    # A page written in several parts (e.g. two sections in index.html) adds up
+    lengths = {}
+    for filename, length in page_lengths:
+        lengths[filename] = lengths.get(filename, 0) + length
+    table = json.dumps(list(lengths.items()), ensure_ascii=False, separators=(',', ':'))
+    with open(os.path.join(out_dir, READING_TABLE_NAME), 'w', encoding='utf-8') as f:
+        f.write(f"self.READING_PAGES = {table};\n")
+    print(f"Wrote {READING_TABLE_NAME} ({len(lengths)} pages, {sum(lengths.values())} characters)")
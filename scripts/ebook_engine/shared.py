@@ -0,0 +1,151 @@
+"""
+Files every page loads, written once per site or once across books.
+
+Each page used to inline the same mobile-menu / TOC / lightbox script, and
+every site carried its own copy of its theme. SiteFiles writes such files
+once per site instead (site.js, the theme, reading.js) and builds the
+{site_scripts} markup that loads them; per-book data (reading_pages.js,
+sw.js), style.css and the images stay in the site as before.
+
+With EBOOK_HELPER_SHARED_ASSETS set to a directory (e.g. public/assets),
+the shared files go into that directory, named by a hash of their content
+(site.3f2a9c1e0b4d.js), and pages link to them with a relative URL
+(../assets/site.3f2a9c1e0b4d.js). Books built with the same script or theme
+then point at the same file: a reader hosting several books downloads it
+once, and the deploy stores it once. A hashed name never changes content,
+so the store can be served with a far-future cache lifetime. Earlier
+versions are left in place for pages that still link to them.
+
+The URL is relative to the final output directory, so the store must be
+deployed at the same place relative to the sites. pack_site.py bundles a
+single site directory, so bundle a build made without the store.
+"""
+
+import hashlib
+import os
+
+from .offline import SERVICE_WORKER_TAG
+from .reading import READING_SCRIPT, READING_SCRIPT_NAME, READING_TABLE_NAME
+
+SHARED_ASSETS_ENV = 'EBOOK_HELPER_SHARED_ASSETS'
+
+PAGE_SCRIPT_NAME = 'site.js'
+
+# Hex digits of the content hash in a stored file's name
+HASH_LENGTH = 12
+
+# Highlights the current TOC entry, opens and closes the mobile menu, and
+# zooms content images in the lightbox
+PAGE_SCRIPT = r"""document.addEventListener('DOMContentLoaded', () => {
+    // Highlight active TOC item
+    const currentObj = window.location.pathname.split('/').pop();
+    const links = document.querySelectorAll('.toc a');
+    links.forEach(link => {
+        if (link.getAttribute('href') === currentObj) {
+            link.classList.add('active');
+            link.scrollIntoView({ block: 'center', behavior: 'smooth' });
+        }
+    });
+
+    // Mobile Menu
+    const toggleBtn = document.getElementById('menu-toggle');
+    const closeBtn = document.getElementById('menu-close');
+    const sidebar = document.getElementById('sidebar');
+    const overlay = document.getElementById('sidebar-overlay');
+
+    function toggleMenu() {
+        sidebar.classList.toggle('open');
+        overlay.classList.toggle('active');
+    }
+
+    function closeMenu() {
+        sidebar.classList.remove('open');
+        overlay.classList.remove('active');
+    }
+
+    if(toggleBtn) toggleBtn.addEventListener('click', toggleMenu);
+    if(closeBtn) closeBtn.addEventListener('click', closeMenu);
+    if(overlay) overlay.addEventListener('click', closeMenu);
+
+    // Lightbox
+    const lightbox = document.getElementById('lightbox');
+    const lightboxImg = document.getElementById('lightbox-img');
+    const contentImages = document.querySelectorAll('.chapter-content img');
+
+    contentImages.forEach(img => {
+        img.style.cursor = 'zoom-in';
+        img.addEventListener('click', (e) => {
+            e.stopPropagation();
+            lightboxImg.src = img.src;
+            lightbox.classList.add('active');
+        });
+    });
+
+    lightbox.addEventListener('click', () => {
+        lightbox.classList.remove('active');
+    });
+});
+"""
+
+
+class SiteFiles:
+    """
+    Writes a site's shared files, into the site or into the shared store,
+    and returns the URLs pages use for them.
+    """
+
+    def __init__(self, output_dir, store_dir=None):
+        if store_dir is None:
+            store_dir = os.environ.get(SHARED_ASSETS_ENV) or None
+        self.store_dir = os.path.abspath(store_dir) if store_dir else None
+        if self.store_dir:
+            # Pages link from the final output directory, not the staging one
+            self.store_url = os.path.relpath(self.store_dir, os.path.abspath(output_dir)).replace(os.sep, '/')
+        # URLs of the store files this site uses (precached by the service worker)
+        self.shared = []
+
+    def add(self, out_dir, name, data):
+        """Writes data (bytes) as name. Returns the URL pages use for it."""
+        if not self.store_dir:
+            with open(os.path.join(out_dir, name), 'wb') as f:
+                f.write(data)
+            return name
+
+        stem, ext = os.path.splitext(name)
+        stored_name = f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+        path = os.path.join(self.store_dir, stored_name)
+        if not os.path.exists(path):
+            os.makedirs(self.store_dir, exist_ok=True)
+            # Books built in parallel may store the same file; each write is one rename
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        url = f"{self.store_url}/{stored_name}"
+        if url not in self.shared:
+            self.shared.append(url)
+        return url
+
+    def add_file(self, out_dir, name, src):
+        """Copies the file at src as name. Returns the URL pages use for it."""
+        with open(src, 'rb') as f:
+            return self.add(out_dir, name, f.read())
+
+    def site_scripts(self, out_dir, page_script=True):
+        """
+        Writes the page script (unless the template has its own) and the
+        reading-position script, and returns the {site_scripts} markup that
+        loads them. The reading table (reading_pages.js) is written after
+        the pages, by write_reading_table().
+        """
+        tags = [SERVICE_WORKER_TAG]
+        if page_script:
+            url = self.add(out_dir, PAGE_SCRIPT_NAME, PAGE_SCRIPT.encode('utf-8'))
+            tags.append(f'<script src="{url}" defer></script>')
+        # Deferred scripts run in order: the table first, then the code using it
+        tags.append(f'<script src="{READING_TABLE_NAME}" defer></script>')
+        url = self.add(out_dir, READING_SCRIPT_NAME, READING_SCRIPT.encode('utf-8'))
+        tags.append(f'<script src="{url}" defer></script>')
+        if self.shared:
+            print(f"Linked {len(self.shared)} shared files in {self.store_dir}")
+        return "\n    ".join(tags)
@@ -0,0 +1,143 @@
+"""
+Size-aware page splitting.
+
+Chapter boundaries come from headings, so a few pages (Notes, Index, long
+appendices) end up many megabytes while most are small, and those pages are
+slow to load on a phone. When a page budget is set, split_oversized()
+subdivides any chapter over the budget at block boundaries into numbered
+sub-pages (chapter_05.html, chapter_05_2.html, ...). The first sub-page
+keeps the chapter's filename, so TOC links stay valid, and links between
+the sub-pages are rewritten from href="#id" to href="chapter_05_2.html#id"
+using an index of the anchors each page holds. Links from other chapters
+into a split chapter (href="chapter_05.html#note12", as silkroads writes
+its note references) are pointed at the sub-page holding the anchor too.
+
+The budget is off by default; set EBOOK_HELPER_MAX_PAGE_KB (e.g. 512) to
+enable it for every generator.
+"""
+
+import os
+import re
+
+MAX_PAGE_ENV = 'EBOOK_HELPER_MAX_PAGE_KB'
+
+# Attribute names in any case (ID=, HREF=), IDs exactly
+ID_PATTERN = re.compile(r'\b(?i:id)="([^"]+)"')
+# href="#id" and href="chapter_05.html#id"
+FRAGMENT_LINK_PATTERN = re.compile(r'(?i:href)="([^"#/:]*)#([^"]+)"')
+
+
+def max_page_bytes():
+    """The page budget from EBOOK_HELPER_MAX_PAGE_KB in bytes, or None if unset."""
+    value = os.environ.get(MAX_PAGE_ENV)
+    if not value:
+        return None
+    kilobytes = int(value)
+    return kilobytes * 1024 if kilobytes > 0 else None
+
+
+def plan_pages(sizes, budget):
+    """
+    Groups consecutive item sizes into (start, end) ranges whose totals stay
+    within budget. An item larger than the budget gets a range of its own,
+    since blocks are never cut.
+    """
+    ranges = []
+    start = 0
+    total = 0
+    for i, size in enumerate(sizes):
+        if i > start and total + size > budget:
+            ranges.append((start, i))
+            start = i
+            total = 0
+        total += size
+    if sizes:
+        ranges.append((start, len(sizes)))
+    return ranges
+
+
+def _relink(pages, split_files):
+    """
+    Points links at the page that now holds their anchor, across the whole
+    book: href="#id" on any page whose own blocks lack the anchor, and
+    href="chapter_05.html#id" into a split chapter whose anchor moved to
+    one of its sub-pages. split_files holds the filenames of split chapters
+    and their sub-pages; links to other pages are left alone.
+    """
+    anchor_pages = {}
+    page_anchors = []
+    for page in pages:
+        anchors = set()
+        for block in page["content_blocks"]:
+            anchors.update(ID_PATTERN.findall(block))
+        for anchor in anchors:
+            anchor_pages.setdefault(anchor, page["filename"])
+        page_anchors.append(anchors)
+
+    for page, anchors in zip(pages, page_anchors):
+        filename = page["filename"]
+
+        def replace(match):
+            target_file, anchor = match.group(1), match.group(2)
+            if target_file:
+                if target_file not in split_files:
+                    return match.group(0)
+            elif anchor in anchors:
+                return match.group(0)
+            target = anchor_pages.get(anchor)
+            if target is None or target == (target_file or filename):
+                return match.group(0)
+            if target == filename:
+                return f'href="#{anchor}"'
+            return f'href="{target}#{anchor}"'
+
+        blocks = page["content_blocks"]
+        relinked = [FRAGMENT_LINK_PATTERN.sub(replace, block) for block in blocks]
+        # Only pages that changed get explicit blocks (see model.Chapter)
+        if relinked != blocks:
+            page["content_blocks"] = relinked
+
+
+def split_oversized(chapters, budget=None):
+    """
+    Returns chapters with every chapter over budget bytes split into
+    sub-pages. Sub-pages copy the chapter's other keys, get a "(2/3)" style
+    title and a "continuation_of" key naming the chapter's first page, so
+    the sidebar can list the chapter once. With no budget (the default
+    unless EBOOK_HELPER_MAX_PAGE_KB is set) chapters are returned unchanged.
+    """
+    if budget is None:
+        budget = max_page_bytes()
+    if not budget:
+        return chapters
+
+    result = []
+    split_files = set()
+    for ch in chapters:
+        blocks = ch["content_blocks"]
+        # Pages are written as "\n".join(blocks)
+        sizes = [len(block.encode('utf-8')) + 1 for block in blocks]
+        ranges = plan_pages(sizes, budget)
+        if len(ranges) < 2:
+            result.append(ch)
+            continue
+
+        stem, ext = os.path.splitext(ch["filename"])
+        pages = []
+        for n, (start, end) in enumerate(ranges, 1):
+            page = ch.copy()
+            page["content_blocks"] = blocks[start:end]
+            if n > 1:
+                page["filename"] = f"{stem}_{n}{ext}"
+                page["title"] = f'{ch["title"]} ({n}/{len(ranges)})'
+                page["continuation_of"] = ch["filename"]
+                if "is_part_header" in page:
+                    page["is_part_header"] = False
+            pages.append(page)
+            split_files.add(page["filename"])
+        print(f"Split {ch['filename']} ({sum(sizes) // 1024} KB) into {len(pages)} pages")
+        result.extend(pages)
+    if split_files:
+        # Anchors moved to sub-pages; links anywhere in the book may point at them
+        _relink(result, split_files)
+    return result
@@ -0,0 +1,82 @@
+"""
+Precompiled page templates.
+
+The generators keep their HTML_TEMPLATE in str.format syntax (with doubled
+{{ }} braces around the inline JavaScript). Calling HTML_TEMPLATE.format()
+for every page reparses the whole template and builds the full page as one
+string before it is encoded and written. PageTemplate parses the template
+once into UTF-8 encoded static chunks and named fields, and writes each page
+with writelines() so only the per-page fields are encoded.
+
+Fragments shared by every page (the TOC sidebar, theme name) can be bound
+once with bind(), which encodes them a single time and folds them into the
+static chunks. Thousands of CJK pages then do not re-encode the same TOC.
+"""
+
+import string
+
+# Pages are written in binary mode through a large buffer so the many small
+# static chunks coalesce into few write() calls
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class PageTemplate:
+    """
+    A str.format-style template split once into static byte chunks and fields.
+
+    Chunks are stored in order: bytes for static text, str for a field name.
+    """
+
+    def __init__(self, template):
+        chunks = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if literal:
+                # parse() has already collapsed {{ and }} to single braces
+                chunks.append(literal.encode('utf-8'))
+            if field is not None:
+                if not field or format_spec or conversion:
+                    raise ValueError(f"Unsupported template field: {{{field}}}")
+                chunks.append(field)
+        self._set_chunks(chunks)
+
+    def _set_chunks(self, chunks):
+        # Merge adjacent static chunks
+        merged = []
+        for chunk in chunks:
+            if isinstance(chunk, bytes) and merged and isinstance(merged[-1], bytes):
+                merged[-1] += chunk
+            else:
+                merged.append(chunk)
+        self.chunks = merged
+        self.fields = {chunk for chunk in merged if isinstance(chunk, str)}
+
+    def bind(self, **fields):
+        """
+        Returns a new template with the given fields encoded once and merged
+        into the static chunks (e.g. toc_items, theme_css shared by all pages).
+        """
+        bound = PageTemplate.__new__(PageTemplate)
+        bound._set_chunks([
+            str(fields[chunk]).encode('utf-8') if isinstance(chunk, str) and chunk in fields else chunk
+            for chunk in self.chunks
+        ])
+        return bound
+
+    def render(self, **fields):
+        """
+        Yields the page as a sequence of UTF-8 byte chunks.
+        Raises KeyError for a missing field, like str.format().
+        """
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                yield chunk
+            else:
+                yield str(fields[chunk]).encode('utf-8')
+
+    def write(self, path, **fields):
+        """Renders the page straight into the file at path."""
+        missing = self.fields.difference(fields)
+        if missing:
+            raise KeyError(', '.join(sorted(missing)))
+        with open(path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.writelines(self.render(**fields))
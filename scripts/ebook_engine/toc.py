@@ -0,0 +1,212 @@
+"""
+Table of contents discovery for Calibre HTML exports.
+
+The generators used to locate the book's contents page through hard-coded
+anchor IDs (e.g. '<div class="calibre" id="calibre_link-5">') or carried
+whole per-book tables of anchor IDs and chapter filenames. Any re-export
+renumbers the calibre_link-N IDs and silently breaks splitting.
+
+discover_toc() finds the contents page heuristically instead: it is the
+densest run of in-document links (<a href="#id">) with little text between
+them, pointing at many distinct anchors, mostly further down the book.
+Footnote references are spread through running text and notes sections link
+backwards, so neither wins. Links whose text is only a number (page numbers
+next to each entry, footnote markers) are not entries, and a target linked
+twice keeps its first link and title. A run ends at a long stretch of text,
+or where the gaps between links grow well beyond the run's usual spacing,
+so a contents page does not merge with back-reference links after it. Levels come from <ul>/<ol> nesting when the TOC
+is a nested list, otherwise part/volume titles ("Part One", "第二卷", ...)
+become level 0 and everything else level 1.
+"""
+
+import json
+import re
+
+# <a ... href="#calibre_link-13" ...>Chapter 1: ...</a>
+LINK_PATTERN = re.compile(r'<a\b[^>]*?\bhref="#([^"]+)"[^>]*>(.*?)</a>', re.DOTALL | re.IGNORECASE)
+# Anchors are id="..." or, in older exports, <a name="...">
+ID_PATTERN = re.compile(r'\b(?i:id|name)="([^"]+)"')
+TAG_PATTERN = re.compile(r'<[^>]+>')
+LIST_TAG_PATTERN = re.compile(r'<(/?)(?:ul|ol)\b', re.IGNORECASE)
+
+# Titles that open a part / volume rather than a chapter
+PART_TITLE_PATTERN = re.compile(
+    r'^(?:(?:Part|Book|Volume)\s+\w+'
+    r'|第[\d一二三四五六七八九十百零〇两兩]+[部卷篇编編])',
+    re.IGNORECASE
+)
+
+# Visible characters allowed between two links of the same TOC
+# (room for page numbers or an unlinked section title)
+MAX_GAP_TEXT = 40
+# Once a run has MIN_ENTRIES links, a gap this many times its average gap
+# (and at least MIN_DENSITY_GAP characters) means the link density dropped
+DENSITY_FACTOR = 4
+MIN_DENSITY_GAP = 10
+# Page numbers, footnote markers
+NUMERIC_TITLE_PATTERN = re.compile(r'^[\d\s.,\-–]+$')
+# Fewer distinct targets than this is not a table of contents
+MIN_ENTRIES = 3
+
+# Bump when the heuristic changes, so cached TOCs are rediscovered
+TOC_VERSION = 2
+
+
+class TocEntry:
+    """One table of contents entry; level 0 is the top of the hierarchy."""
+
+    __slots__ = ('level', 'title', 'path', 'fragment')
+
+    def __init__(self, level, title, path, fragment):
+        self.level = level
+        self.title = title
+        self.path = path
+        self.fragment = fragment
+
+    def __repr__(self):
+        return f"TocEntry({self.level}, {self.title!r}, {self.path!r}, {self.fragment!r})"
+
+
+def _clean_title(inner_html):
+    return ' '.join(TAG_PATTERN.sub('', inner_html).split())
+
+
+def _visible_length(html):
+    return len(''.join(TAG_PATTERN.sub('', html).split()))
+
+
+def _is_numeric(match):
+    return bool(NUMERIC_TITLE_PATTERN.match(_clean_title(match.group(2)) or '0'))
+
+
+def _link_runs(content):
+    """
+    Splits the document's internal links into runs separated by running
+    text. Numeric links are left out (they neither extend nor split a run).
+    """
+    runs = []
+    current = []
+    gap_total = 0
+    previous_end = None
+    for match in LINK_PATTERN.finditer(content):
+        if _is_numeric(match):
+            continue
+        if previous_end is not None:
+            gap = _visible_length(content[previous_end:match.start()])
+            average = gap_total / (len(current) - 1) if len(current) > 1 else 0
+            density_dropped = (len(current) >= MIN_ENTRIES and gap >= MIN_DENSITY_GAP
+                               and gap > DENSITY_FACTOR * average)
+            if gap > MAX_GAP_TEXT or density_dropped:
+                runs.append(current)
+                current = []
+                gap_total = 0
+            else:
+                gap_total += gap
+        current.append(match)
+        previous_end = match.end()
+    if current:
+        runs.append(current)
+    return runs
+
+
+def _score(run, id_positions):
+    """Distinct targets that exist in the document and lie after the run."""
+    run_end = run[-1].end()
+    targets = {m.group(1) for m in run if id_positions.get(m.group(1), -1) >= 0}
+    forward = {t for t in targets if id_positions[t] > run_end}
+    # A contents page points forwards (the odd link back to the cover is fine)
+    if len(forward) * 2 < len(targets):
+        return 0
+    return len(targets)
+
+
+def _list_depths(content, run):
+    """<ul>/<ol> nesting depth of each link, relative to the run start."""
+    depths = []
+    depth = 0
+    position = run[0].start()
+    for match in run:
+        for tag in LIST_TAG_PATTERN.finditer(content, position, match.start()):
+            depth += -1 if tag.group(1) else 1
+        depths.append(depth)
+        position = match.end()
+    return depths
+
+
+def find_toc(content):
+    """
+    Discovers the table of contents in an HTML document.
+    Returns a list of TocEntry (path is None, fragment is the anchor ID) in
+    TOC order, or [] if nothing looks like a contents page.
+    """
+    id_positions = {}
+    for match in ID_PATTERN.finditer(content):
+        id_positions.setdefault(match.group(1), match.start())
+
+    best, best_score = None, 0
+    for run in _link_runs(content):
+        score = _score(run, id_positions)
+        # Ties go to the earlier run; contents pages come first
+        if score > best_score:
+            best, best_score = run, score
+    if best is None or best_score < MIN_ENTRIES:
+        return []
+
+    depths = _list_depths(content, best)
+    # A target linked twice (title, then again elsewhere) keeps its first link
+    seen = set()
+    links = []
+    for match, depth in zip(best, depths):
+        if match.group(1) not in seen:
+            seen.add(match.group(1))
+            links.append((match, depth))
+    best = [match for match, _ in links]
+    depths = [depth for _, depth in links]
+
+    titles = [_clean_title(m.group(2)) for m in best]
+    if len(set(depths)) > 1:
+        top = min(depths)
+        levels = [d - top for d in depths]
+    else:
+        is_part = [bool(PART_TITLE_PATTERN.match(t)) for t in titles]
+        levels = [0 if part else 1 for part in is_part] if any(is_part) else [0] * len(titles)
+
+    return [
+        TocEntry(level, title, None, m.group(1))
+        for level, title, m in zip(levels, titles, best)
+        if title and m.group(1) in id_positions
+    ]
+
+
+def discover_toc(content, cache=None):
+    """
+    find_toc(), memoised in a BlockCache when one is given: the TOC of an
+    unchanged source is read back instead of rediscovered.
+    """
+    if cache is None:
+        return find_toc(content)
+
+    def compute(text):
+        return json.dumps([[e.level, e.title, e.fragment] for e in find_toc(text)], ensure_ascii=False)
+
+    rows = json.loads(cache.get_or_compute(content, compute, extra=f"toc:{TOC_VERSION}"))
+    return [TocEntry(level, title, None, fragment) for level, title, fragment in rows]
+
+
+def toc_title_map(entries):
+    """
+    {anchor_id: title} for the entries, e.g. for iter_chapter_starts().
+    An anchor listed more than once keeps its first title.
+    """
+    titles = {}
+    for entry in entries:
+        titles.setdefault(entry.fragment, entry.title)
+    return titles
+
+
+def section_entries(entries):
+    """Level-0 entries that have children (parts, volumes)."""
+    return [
+        entry for i, entry in enumerate(entries)
+        if entry.level == 0 and i + 1 < len(entries) and entries[i + 1].level > 0
+    ]
@@ -0,0 +1,150 @@
+"""
+File watching for rebuild-on-save.
+
+watch() snapshots the (mtime, size) of every file under the watched paths
+and calls back with the paths that changed. On Linux it sleeps on inotify
+(through ctypes, like the renameat2() call in output.py) so a save is
+picked up at once and an idle watcher costs nothing; elsewhere, or if
+inotify is unavailable, it polls every WATCH_INTERVAL seconds. Either way
+the snapshot diff decides what changed, so the two behave the same.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+WATCH_INTERVAL = 1.0
+# Quiet time after the last change before calling back (editors save in steps)
+SETTLE_DELAY = 0.3
+
+# inotify(7) event mask: anything that changes a file's content or presence
+_IN_MODIFY = 0x002
+_IN_ATTRIB = 0x004
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO
+               | _IN_CREATE | _IN_DELETE)
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+
+def snapshot(paths):
+    """{file path: (mtime_ns, size)} for the given files and directory trees."""
+    state = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    full_path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(full_path)
+                    except FileNotFoundError:
+                        continue
+                    state[full_path] = (stat.st_mtime_ns, stat.st_size)
+        elif os.path.exists(path):
+            stat = os.stat(path)
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+    return state
+
+
+def changed_paths(old, new):
+    """Sorted paths added, removed or modified between two snapshots."""
+    return sorted(path for path in old.keys() | new.keys() if old.get(path) != new.get(path))
+
+
+class _Inotify:
+    """Wakes the watcher when anything in the watched directories changes."""
+
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self.fd = fd
+        self._watched = set()
+
+    @classmethod
+    def create(cls):
+        """An inotify instance, or None where inotify is not available."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError):
+            return None
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def add(self, paths):
+        """Watches the directories holding paths (whole trees for directories)."""
+        directories = set()
+        for path in paths:
+            if os.path.isdir(path):
+                directories.update(root for root, _, _ in os.walk(path))
+            else:
+                directories.add(os.path.dirname(os.path.abspath(path)))
+        for directory in directories - self._watched:
+            if self._libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK) >= 0:
+                self._watched.add(directory)
+
+    def wait(self, timeout):
+        """Blocks until an event arrives or timeout seconds pass."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        # Drain the queued events; the snapshot diff says what they were
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch(paths, on_change, interval=WATCH_INTERVAL):
+    """
+    Calls on_change(changed) with the list of changed files whenever files
+    under paths (files or directory trees) change. Runs until interrupted.
+    """
+    notifier = _Inotify.create()
+    if notifier is not None:
+        notifier.add(paths)
+        print("Watching for changes (inotify). Press Ctrl-C to stop.")
+    else:
+        print(f"Watching for changes (polling every {interval:g}s). Press Ctrl-C to stop.")
+
+    current = snapshot(paths)
+    try:
+        while True:
+            if notifier is not None:
+                # The timeout is a safety net for events inotify cannot see
+                notifier.wait(interval * 10)
+            else:
+                time.sleep(interval)
+            latest = snapshot(paths)
+            if latest == current:
+                continue
+            # Wait for the writes to settle before acting on them
+            while True:
+                time.sleep(SETTLE_DELAY)
+                settled = snapshot(paths)
+                if settled == latest:
+                    break
+                latest = settled
+            changed = changed_paths(current, latest)
+            current = latest
+            on_change(changed)
+            if notifier is not None:
+                # Pick up directories created since the last change
+                notifier.add(paths)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+    finally:
+        if notifier is not None:
+            notifier.close()
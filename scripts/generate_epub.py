@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Generate a static site directly from an .epub file.
+
+Unlike the other generators, this needs no Calibre HTML export: the spine
+documents are read one at a time from the EPUB, and chapters and the sidebar
+come from the EPUB's own table of contents (EPUB 3 nav or EPUB 2 NCX)
+instead of hand-coded HEADINGS_MAP / BOOK_MAP tables.
+
+Usage:
+    python3 scripts/generate_epub.py path/to/book.epub [--output dist_book] [--theme theme_sapiens.css]
+"""
+
+import argparse
+import html
+import os
+import re
+import shutil
+
+from ebook_engine import (EpubBook, ImageVariants, PageTemplate, SiteFiles, prefetch_hints,
+                          section_entries, staged_output, text_length, write_reading_table,
+                          write_service_worker)
+from ebook_engine.epub import resolve
+
+# Configuration
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
+DEFAULT_THEME_CSS_NAME = 'theme_sapiens.css'
+
+# HTML Template
+HTML_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="{lang}">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title} - {book_title}</title>
+    <!-- Local CSS only for offline access -->
+    <link rel="stylesheet" href="style.css">
+    <link rel="stylesheet" href="{theme_css}">
+    {head_links}
+</head>
+<body>
+    <div class="app-container">
+        <!-- Mobile Header -->
+        <div class="mobile-header">
+            <button id="menu-toggle" class="menu-toggle" aria-label="Toggle Navigation">
+                ☰ 
+            </button>
+            <span class="mobile-title">{book_title}</span>
+        </div>
+
+        <!-- Sidebar -->
+        <aside class="sidebar" id="sidebar">
+            <div class="sidebar-header">
+                <a href="index.html" class="book-title">{book_title}</a>
+                <button id="menu-close" class="menu-close" aria-label="Close Navigation">×</button>
+            </div>
+            <nav class="toc">
+                <ul>
+                    {toc_items}
+                </ul>
+            </nav>
+        </aside>
+        
+        <!-- Main Content -->
+        <main class="content-area">
+            <div class="chapter-content">
+                {content}
+            </div>
+            
+            <div class="navigation-footer">
+                {prev_button}
+                {next_button}
+            </div>
+        </main>
+        
+        <!-- Overlay -->
+        <div class="sidebar-overlay" id="sidebar-overlay"></div>
+
+        <!-- Lightbox -->
+        <div id="lightbox" class="lightbox">
+            <img id="lightbox-img" src="" alt="Enlarged image">
+        </div>
+    </div>
+    
+    {site_scripts}
+</body>
+</html>
+"""
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
+
+# src="..." / href="..." / xlink:href="..." attributes inside spine documents
+LINK_ATTR_PATTERN = re.compile(r'((?:xlink:)?href|src)="([^"]*)"')
+CSS_URL_PATTERN = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+def plan_pages(book):
+    """
+    Groups spine documents into pages. A document that a TOC entry points to
+    starts a new page titled after that entry; other documents are appended
+    to the current page.
+    """
+    sections = set(section_entries(book.toc))
+    first_entry = {}
+    for index, entry in enumerate(book.toc):
+        first_entry.setdefault(entry.path, index)
+
+    pages = []
+    for member in book.spine:
+        index = first_entry.get(member)
+        if index is not None or not pages:
+            filename = "index.html" if not pages else f"chapter_{len(pages):02d}.html"
+            if index is not None:
+                entry = book.toc[index]
+                title = entry.title
+                # Top-level entries with children (e.g. "Part One") become section headers
+                is_part_header = entry in sections
+            else:
+                title = book.title
+                is_part_header = False
+            pages.append({
+                "title": title,
+                "filename": filename,
+                "members": [member],
+                "is_part_header": is_part_header
+            })
+        else:
+            pages[-1]["members"].append(member)
+    return pages
+
+def rewrite_links(book, member, body, page_of):
+    """
+    Points links at the generated pages and extracted assets.
+    Assets keep their path relative to the OPF directory.
+    """
+    def replace(match):
+        attr, url = match.groups()
+        path, fragment = resolve(member, html.unescape(url))
+        if path is None:
+            return match.group(0)
+        suffix = f"#{fragment}" if fragment else ""
+        if path in page_of:
+            return f'{attr}="{page_of[path]}{suffix}"'
+        if path in book.manifest:
+            return f'{attr}="{html.escape(book.relative_to_root(path))}{suffix}"'
+        return match.group(0)
+
+    return LINK_ATTR_PATTERN.sub(replace, body)
+
+def extract_assets(book, out_dir):
+    """
+    Copies images and fonts out of the EPUB, and merges its stylesheets into
+    style.css (with url() references re-pointed at the extracted files).
+    """
+    stylesheets = []
+    count = 0
+    skipped = 0
+    site_root = os.path.realpath(out_dir)
+    for member in book.assets():
+        if book.manifest[member] == 'text/css':
+            def replace_url(match):
+                path, _ = resolve(member, match.group(2))
+                if path is None:
+                    return match.group(0)
+                return f'url("{book.relative_to_root(path)}")'
+            css = book.read_text(member)
+            stylesheets.append(f"/* {book.relative_to_root(member)} */\n" + CSS_URL_PATTERN.sub(replace_url, css))
+            continue
+
+        target = os.path.join(out_dir, *book.relative_to_root(member).split('/'))
+        # Manifest paths come from the EPUB; "../" or absolute ones would
+        # write outside the site (zip slip), so they are not extracted
+        if os.path.commonpath([site_root, os.path.realpath(target)]) != site_root:
+            print(f"Skipped asset outside the site: {member}")
+            skipped += 1
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with book.zip.open(member) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        count += 1
+
+    with open(os.path.join(out_dir, 'style.css'), 'w', encoding='utf-8') as f:
+        f.write("\n".join(stylesheets))
+    print(f"Extracted {count} assets and {len(stylesheets)} stylesheets"
+          + (f" ({skipped} skipped)" if skipped else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a static site from an EPUB file.")
+    parser.add_argument('epub', help="path to the .epub file")
+    parser.add_argument('--output', help="output directory (default: dist_<epub name>)")
+    parser.add_argument('--theme', default=DEFAULT_THEME_CSS_NAME,
+                        help=f"theme stylesheet in scripts/ (default: {DEFAULT_THEME_CSS_NAME})")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.epub):
+        print(f"Error: Source file not found at {args.epub}")
+        return
+
+    if args.output:
+        output_dir = os.path.abspath(args.output)
+    else:
+        stem = re.sub(r'[^\w-]+', '_', os.path.splitext(os.path.basename(args.epub))[0]).strip('_').lower()
+        output_dir = os.path.join(PROJECT_ROOT, f"dist_{stem}")
+    theme_css_name = args.theme
+
+    print(f"Reading {args.epub}...")
+    with EpubBook(args.epub) as book:
+        print(f"Found {len(book.spine)} spine documents and {len(book.toc)} TOC entries.")
+
+        pages = plan_pages(book)
+        page_of = {member: page["filename"] for page in pages for member in page["members"]}
+
+        # Generate TOC HTML from the EPUB's own table of contents
+        toc_html = ""
+        seen_pages = set()
+        sections = set(section_entries(book.toc))
+        for entry in book.toc:
+            filename = page_of.get(entry.path)
+            if filename is None:
+                continue
+            # The first entry for a page links to the page itself (so it gets
+            # highlighted), later ones to their anchor on that page
+            href = filename
+            if filename in seen_pages and entry.fragment:
+                href = f"{filename}#{entry.fragment}"
+            seen_pages.add(filename)
+            title = html.escape(entry.title)
+            if entry in sections:
+                toc_html += f'<li class="book-section-header"><a href="{href}">{title}</a></li>\n'
+            else:
+                toc_html += f'<li><a href="{href}">{title}</a></li>\n'
+
+        # Prepare Output
+        # Everything is written to a staging directory that replaces
+        # output_dir only once the build is complete
+        with staged_output(output_dir) as out_dir:
+            extract_assets(book, out_dir)
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(out_dir, out_dir, IMAGE_CACHE_DIR)
+
+            # The theme and the page scripts go into the site, or the shared asset store
+            site_files = SiteFiles(output_dir)
+            theme_css = theme_css_name
+            theme_src = os.path.join(SCRIPT_DIR, theme_css_name)
+            if os.path.exists(theme_src):
+                theme_css = site_files.add_file(out_dir, theme_css_name, theme_src)
+                print(f"Copied {theme_css_name}")
+
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(
+                lang=html.escape(book.language),
+                book_title=html.escape(book.title),
+                theme_css=theme_css,
+                toc_items=toc_html,
+                site_scripts=site_files.site_scripts(out_dir)
+            )
+
+            # Write Pages, reading each page's spine documents only when it is written
+            print(f"Generating {len(pages)} pages...")
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, page in enumerate(pages):
+                # Navigation
+                prev_btn = ""
+                if i > 0:
+                    prev_btn = f'<a href="{pages[i-1]["filename"]}" class="nav-btn prev">← Previous</a>'
+
+                next_btn = ""
+                if i < len(pages) - 1:
+                    next_btn = f'<a href="{pages[i+1]["filename"]}" class="nav-btn next">Next →</a>'
+
+                content = "\n".join(
+                    rewrite_links(book, member, book.read_body(member), page_of)
+                    for member in page["members"]
+                )
+
+                # Let the browser fetch the next chapter early (its images are not read yet)
+                head_links = ""
+                if i < len(pages) - 1:
+                    head_links = prefetch_hints(pages[i+1]["filename"])
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                content = image_variants.rewrite(content)
+                page_lengths.append((page["filename"], text_length(content)))
+
+                page_template.write(
+                    os.path.join(out_dir, page["filename"]),
+                    title=html.escape(page["title"]),
+                    head_links=head_links,
+                    content=content,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # Shared reading-position script, with the page-length table
+            write_reading_table(out_dir, page_lengths)
+
+            # Service worker for offline reading (written last: it hashes every file)
+            write_service_worker(out_dir, [page["filename"] for page in pages], site_files.shared)
+
+    print(f"Done. Output in {output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,12 @@ import os
 import re
 import shutil
 
+from ebook_engine import (HeaderPattern, ImageVariants, PageTemplate, SiteFiles,
+                          chapter_images, code_version, iter_block_spans, list_assets,
+                          load_book, map_blocks, prefetch_hints, save_book, split_oversized,
+                          staged_output, start_asset_sync, text_length, write_reading_table,
+                          write_service_worker)
+
 # Configuration
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -12,6 +18,8 @@ SOURCE_DIR_NAME = 'ren-lei-da-li-shi'
 SOURCE_FILE = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'index.html')
 IMAGES_DIR_NAME = 'images'
 THEME_CSS_NAME = 'theme_renlei.css' # Using the specific theme for Renlei
+IR_FILE = os.path.join(PROJECT_ROOT, '.cache', 'renlei.ir.jsonl')
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
 
 # HTML Template
 HTML_TEMPLATE = """
@@ -24,6 +32,7 @@ HTML_TEMPLATE = """
     <!-- Local CSS only for offline access -->
     <link rel="stylesheet" href="style.css">
     <link rel="stylesheet" href="{theme_css}">
+    {head_links}
 </head>
 <body>
     <div class="app-container">
@@ -69,140 +78,93 @@ HTML_TEMPLATE = """
         </div>
     </div>
     
-    <script>
-        document.addEventListener('DOMContentLoaded', () => {{
-            // Highlight active TOC item
-            const currentObj = window.location.pathname.split('/').pop();
-            const links = document.querySelectorAll('.toc a');
-            links.forEach(link => {{
-                if (link.getAttribute('href') === currentObj) {{
-                    link.classList.add('active');
-                    link.scrollIntoView({{ block: 'center', behavior: 'smooth' }});
-                }}
-            }});
-            
-            // Mobile Menu
-            const toggleBtn = document.getElementById('menu-toggle');
-            const closeBtn = document.getElementById('menu-close');
-            const sidebar = document.getElementById('sidebar');
-            const overlay = document.getElementById('sidebar-overlay');
-            
-            function toggleMenu() {{
-                sidebar.classList.toggle('open');
-                overlay.classList.toggle('active');
-            }}
-            
-            function closeMenu() {{
-                sidebar.classList.remove('open');
-                overlay.classList.remove('active');
-            }}
-            
-            if(toggleBtn) toggleBtn.addEventListener('click', toggleMenu);
-            if(closeBtn) closeBtn.addEventListener('click', closeMenu);
-            if(overlay) overlay.addEventListener('click', closeMenu);
-
-            // Lightbox
-            const lightbox = document.getElementById('lightbox');
-            const lightboxImg = document.getElementById('lightbox-img');
-            const contentImages = document.querySelectorAll('.chapter-content img');
-
-            contentImages.forEach(img => {{
-                img.style.cursor = 'zoom-in';
-                img.addEventListener('click', (e) => {{
-                    e.stopPropagation();
-                    lightboxImg.src = img.src;
-                    lightbox.classList.add('active');
-                }});
-            }});
-
-            lightbox.addEventListener('click', () => {{
-                lightbox.classList.remove('active');
-            }});
-        }});
-    </script>
+    {site_scripts}
 </body>
 </html>
 """
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
 
-def main():
-    if not os.path.exists(SOURCE_FILE):
-        print(f"Error: Source file not found at {SOURCE_FILE}")
-        return
+# Top-level container of each block: <div class="calibre" id="calibre_link-36">
+BLOCK_OPENER = re.compile(r'<div class="calibre"[^>]*>')
 
-    print(f"Reading {SOURCE_FILE}...")
-    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
-        content = f.read()
+# Header Detection
+# We assume:
+# 1. Front matter pages (like '誌謝') have <h1 class="calibre3">
+# 2. Part headers (like '第一部') have <h1 class="p"><span class="num">
+# 3. Chapters (like '第01章') have <h2 class="p1"><span class="num">
+#
+# All three are matched by one combined pattern in a single pass. Headers sit
+# at the top of a block, so only the first HEADER_SCAN_LIMIT characters are
+# scanned instead of the whole (possibly very long) block.
+# Limits, neither of which is reported while building:
+# - a header that starts after the first HEADER_SCAN_LIMIT characters of its
+#   block is not seen;
+# - matches do not overlap, so a header inside the text of an earlier match
+#   (e.g. an <h1> on the same line as an <h2> whose title runs past it) is
+#   not seen either. The three separate searches used before would find it.
+# scripts/check_blocks.py compares the detector with those full-block
+# searches on a source, to catch either case.
+HEADER_SCAN_LIMIT = 4096
+
+RE_HEADER = re.compile(
+    # Part: <h1 class="..."><span class="num">第一部</span>認知革命</h1>
+    r'<h1[^>]*><span class="num">(?P<part_num>[^<]+)</span>(?P<part_title>[^<]+)</h1>'
+    # Chapter: <h2 class="..."><span class="num">第01章</span>...</h2>
+    # The title may contain inline tags; unrolled loop instead of a tempered dot
+    r'|<h2[^>]*><span class="num">(?P<chapter_num>[^<]+)</span>'
+    r'(?P<chapter_title>(?!</h2>)[^<\n]*(?:<(?!/h2>)[^<\n]*)*)</h2>'
+    # Front matter: <h1 class="calibre3">Title</h1> (no num span)
+    r'|<h1[^>]*>(?!<span)(?P<front_title>[^<]+)</h1>',
+    re.IGNORECASE
+)
 
+# Priority when a block carries several headers: part > chapter > front matter,
+# as (title group, number group, is_part_header)
+HEADER_KINDS = [
+    ("part_title", "part_num", True),        # e.g. 第一部 認知革命
+    ("chapter_title", "chapter_num", False), # e.g. 第01章 人類: ...
+    ("front_title", None, False),
+]
+
+# Picklable, so header detection can run in worker processes
+HEADER_DETECTOR = HeaderPattern(RE_HEADER, HEADER_KINDS, HEADER_SCAN_LIMIT)
+
+def split_chapters(content, source_path=None):
+    """
+    Splits the source into blocks and groups them into chapters.
+    Returns (chapters, blocks, body_start), or None if there is no body.
+    With source_path (the file content was read from), header detection
+    runs in a process pool for large sources.
+    """
     # Extract Body Content
     body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
     if not body_match:
         print("Could not find body tag.")
-        return
+        return None
     full_body_content = body_match.group(1)
+    body_start = body_match.start(1)
 
     # Split into blocks based on top-level divs with class 'calibre'
     # Pattern: <div class="calibre" id="calibre_link-36">
-    parts = re.split(r'(<div class="calibre"[^>]*>)', full_body_content)
-    
-    blocks = []
-    if len(parts) > 1:
-        # parts[0] is usually empty or whitespace before first div
-        for i in range(1, len(parts), 2):
-            if i+1 < len(parts):
-                block = parts[i] + parts[i+1]
-                blocks.append(block)
-    else:
+    # (nested calibre divs stay inside their block)
+    spans = [(body_start + start, body_start + end)
+             for start, end in iter_block_spans(full_body_content, BLOCK_OPENER)]
+    if not spans:
         # Fallback
-        blocks = [full_body_content]
+        spans = [(body_start, body_match.end(1))]
+    blocks = [content[start:end] for start, end in spans]
 
     print(f"Found {len(blocks)} content blocks.")
 
+    # Every block's header, detected on all cores for large sources
+    headers = map_blocks(HEADER_DETECTOR, source_path, content, spans)
+
     chapters = []
     
     # Check first block, usually cover or title page.
-    # We will assume:
-    # 1. Front matter pages (like '誌謝') have <h1 class="calibre3">
-    # 2. Part headers (like '第一部') have <h1 class="p">
-    # 3. Chapters (like '第01章') have <h2 class="p1">
-    
-    # Regex patterns
-    # Matches <h1 class="..."> <span class="num">...</span> ... </h1>
-    re_part = re.compile(r'<h1[^>]*><span class="num">([^<]+)</span>([^<]+)</h1>', re.IGNORECASE)
-    
-    # Matches <h2 class="..."> <span class="num">...</span> ... </h2>
-    # Note: text might be immediately after span or have some whitespace
-    re_chapter = re.compile(r'<h2[^>]*><span class="num">([^<]+)</span>((?:(?!</h2>).)+)</h2>', re.IGNORECASE)
-    
-    # Front matter: <h1 class="calibre3">Title</h1> - class might change too, so match h1 without num span?
-    # But Parts also use h1. Part has span.num, Front matter doesn't.
-    re_front = re.compile(r'<h1[^>]*>(?!<span)([^<]+)</h1>', re.IGNORECASE)
-
     current_chapter = None
     
-    for i, block in enumerate(blocks):
-        # Determine title
-        title = None
-        is_part_header = False
-        
-        # Search for headers in priority
-        # Part headers are high level
-        match_part = re_part.search(block)
-        
-        # Chapter headers
-        match_chapter = re_chapter.search(block)
-        
-        # Front matter
-        match_front = re_front.search(block)
-
-        if match_part:
-            # e.g. 第一部 認知革命
-            title = f"{match_part.group(1)} {match_part.group(2)}"
-            is_part_header = True
-        elif match_chapter:
-            # e.g. 第01章 人類: ...
-            title = f"{match_chapter.group(1)} {match_chapter.group(2)}"
-        elif match_front:
-            title = match_front.group(1)
+    for block, (title, is_part_header) in zip(blocks, headers):
         
         # If no explicit header, maybe it's just following usage of previous chapter or it's a cover/misc page
         if title:
@@ -234,9 +196,43 @@ def main():
                     "is_part_header": False
                 })
 
+    return chapters, blocks, body_start
+
+def main():
+    if not os.path.exists(SOURCE_FILE):
+        print(f"Error: Source file not found at {SOURCE_FILE}")
+        return
+
+    print(f"Reading {SOURCE_FILE}...")
+    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    # Reuse the book IR from a previous build when neither the source nor
+    # the splitting code changed; otherwise parse the source and save it
+    code_key = code_version(split_chapters, BLOCK_OPENER, RE_HEADER, HEADER_KINDS, HEADER_SCAN_LIMIT)
+    book = load_book(IR_FILE, content, code_key)
+    if book is not None:
+        print(f"Loaded {len(book.chapters)} chapters from {IR_FILE}")
+    else:
+        parsed = split_chapters(content, SOURCE_FILE)
+        if parsed is None:
+            return
+        chapters, blocks, body_start = parsed
+        assets = list_assets(os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME), IMAGES_DIR_NAME)
+        book = save_book(IR_FILE, content, code_key, chapters, blocks, body_start, assets=assets)
+        # The book's chapters slice the source by offset; drop the parsed copies
+        del parsed, blocks
+    chapters = book.chapters
+
+    # Subdivide oversized chapters (only when EBOOK_HELPER_MAX_PAGE_KB is set)
+    chapters = split_oversized(chapters)
+
     # Generate TOC HTML
     toc_html = ""
     for ch in chapters:
+        # Sub-pages of a split chapter are reached through its first page
+        if ch.get("continuation_of"):
+            continue
         title = ch["title"]
         filename = ch["filename"]
         
@@ -246,54 +242,86 @@ def main():
             toc_html += f'<li><a href="{filename}">{title}</a></li>\n'
 
     # Prepare Output
-    if os.path.exists(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
+    # Everything is written to a staging directory that replaces
+    # OUTPUT_DIR only once the build is complete
+    with staged_output(OUTPUT_DIR) as out_dir:
     
-    # Copy Assets
-    src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
-    dst_images = os.path.join(OUTPUT_DIR, IMAGES_DIR_NAME)
-    if os.path.exists(src_images):
-        shutil.copytree(src_images, dst_images)
-        print(f"Copied images from {src_images}")
-
-    src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
-    if os.path.exists(src_style):
-        shutil.copy(src_style, os.path.join(OUTPUT_DIR, 'style.css'))
-        print("Copied original style.css")
+        # Copy Assets
+        # Images are copied in the background while the pages are written
+        src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
+        dst_images = os.path.join(out_dir, IMAGES_DIR_NAME)
+        image_sync = start_asset_sync([(src_images, dst_images)])
+        try:
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(os.path.dirname(src_images), out_dir, IMAGE_CACHE_DIR)
+
+            src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
+            if os.path.exists(src_style):
+                shutil.copy(src_style, os.path.join(out_dir, 'style.css'))
+                print("Copied original style.css")
         
-    theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
-    if os.path.exists(theme_src):
-        shutil.copy(theme_src, os.path.join(OUTPUT_DIR, THEME_CSS_NAME))
-        print(f"Copied {THEME_CSS_NAME}")
-
-    # Write Pages
-    print(f"Generating {len(chapters)} pages...")
-    for i, ch in enumerate(chapters):
-        # Navigation
-        prev_btn = ""
-        if i > 0:
-            prev_ch = chapters[i-1]
-            prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← 上一章</a>'
+            # The theme and the page scripts go into the site, or the shared asset store
+            site_files = SiteFiles(OUTPUT_DIR)
+            theme_css = THEME_CSS_NAME
+            theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
+            if os.path.exists(theme_src):
+                theme_css = site_files.add_file(out_dir, THEME_CSS_NAME, theme_src)
+                print(f"Copied {THEME_CSS_NAME}")
+
+            # Write Pages
+            print(f"Generating {len(chapters)} pages...")
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(theme_css=theme_css, toc_items=toc_html, site_scripts=site_files.site_scripts(out_dir))
+
+            # First images of every page, collected once for the prefetch hints
+            page_images = [chapter_images(ch) for ch in chapters]
+
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, ch in enumerate(chapters):
+                # Navigation
+                prev_btn = ""
+                if i > 0:
+                    prev_ch = chapters[i-1]
+                    prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← 上一章</a>'
             
-        next_btn = ""
-        if i < len(chapters) - 1:
-            next_ch = chapters[i+1]
-            next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">下一章 →</a>'
+                next_btn = ""
+                if i < len(chapters) - 1:
+                    next_ch = chapters[i+1]
+                    next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">下一章 →</a>'
 
-        content = "\n".join(ch["content_blocks"])
-        
-        html = HTML_TEMPLATE.format(
-            title=ch["title"],
-            theme_css=THEME_CSS_NAME,
-            toc_items=toc_html,
-            content=content,
-            prev_button=prev_btn,
-            next_button=next_btn
-        )
+                content = "\n".join(ch["content_blocks"])
         
-        with open(os.path.join(OUTPUT_DIR, ch["filename"]), 'w', encoding='utf-8') as f:
-            f.write(html)
+                # Let the browser fetch the next chapter (and its first images) early
+                head_links = ""
+                if i < len(chapters) - 1:
+                    head_links = prefetch_hints(chapters[i+1]["filename"], page_images[i+1], image_variants)
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                content = image_variants.rewrite(content)
+                page_lengths.append((ch["filename"], text_length(content)))
+
+                page_template.write(
+                    os.path.join(out_dir, ch["filename"]),
+                    title=ch["title"],
+                    head_links=head_links,
+                    content=content,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # The service worker hashes every file, so the images must be in place
+            image_sync.wait()
+        finally:
+            image_sync.close()
+
+        # Shared reading-position script, with the page-length table
+        write_reading_table(out_dir, page_lengths)
+
+        # Service worker for offline reading (written last: it hashes every file)
+        write_service_worker(out_dir, [ch["filename"] for ch in chapters], site_files.shared)
 
     print("Done.")
 
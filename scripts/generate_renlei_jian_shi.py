@@ -2,11 +2,18 @@ import os
 import re
 import shutil
 
+from ebook_engine import (ImageVariants, PageTemplate, SiteFiles, chapter_images, code_version,
+                          list_assets, load_book, prefetch_hints, save_book, split_blocks,
+                          split_oversized, staged_output, start_asset_sync, text_length,
+                          write_reading_table, write_service_worker)
+
 # Configuration
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 OUTPUT_DIR_NAME = 'dist_renlei_jian_shi'
 OUTPUT_DIR = os.path.join(PROJECT_ROOT, OUTPUT_DIR_NAME)
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
+IR_FILE = os.path.join(PROJECT_ROOT, '.cache', 'renlei_jian_shi.ir.jsonl')
 
 # Book Specific Config
 SOURCE_DIR_NAME = 'Ren Lei Jian Shi _Cong Dong Wu Dao Shang D - Yuval Noah Harari'
@@ -25,6 +32,7 @@ HTML_TEMPLATE = """
     <!-- Local CSS only for offline access -->
     <link rel="stylesheet" href="style.css">
     <link rel="stylesheet" href="{theme_css}">
+    {head_links}
 </head>
 <body>
     <div class="app-container">
@@ -70,60 +78,11 @@ HTML_TEMPLATE = """
         </div>
     </div>
     
-    <script>
-        document.addEventListener('DOMContentLoaded', () => {{
-            // Highlight active TOC item
-            const currentObj = window.location.pathname.split('/').pop();
-            const links = document.querySelectorAll('.toc a');
-            links.forEach(link => {{
-                if (link.getAttribute('href') === currentObj) {{
-                    link.classList.add('active');
-                    link.scrollIntoView({{ block: 'center', behavior: 'smooth' }});
-                }}
-            }});
-            
-            // Mobile Menu
-            const toggleBtn = document.getElementById('menu-toggle');
-            const closeBtn = document.getElementById('menu-close');
-            const sidebar = document.getElementById('sidebar');
-            const overlay = document.getElementById('sidebar-overlay');
-            
-            function toggleMenu() {{
-                sidebar.classList.toggle('open');
-                overlay.classList.toggle('active');
-            }}
-            
-            function closeMenu() {{
-                sidebar.classList.remove('open');
-                overlay.classList.remove('active');
-            }}
-            
-            if(toggleBtn) toggleBtn.addEventListener('click', toggleMenu);
-            if(closeBtn) closeBtn.addEventListener('click', closeMenu);
-            if(overlay) overlay.addEventListener('click', closeMenu);
-
-            // Lightbox
-            const lightbox = document.getElementById('lightbox');
-            const lightboxImg = document.getElementById('lightbox-img');
-            const contentImages = document.querySelectorAll('.chapter-content img');
-
-            contentImages.forEach(img => {{
-                img.style.cursor = 'zoom-in';
-                img.addEventListener('click', (e) => {{
-                    e.stopPropagation();
-                    lightboxImg.src = img.src;
-                    lightbox.classList.add('active');
-                }});
-            }});
-
-            lightbox.addEventListener('click', () => {{
-                lightbox.classList.remove('active');
-            }});
-        }});
-    </script>
+    {site_scripts}
 </body>
 </html>
 """
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
 
 def clean_title(title_html):
     """
@@ -139,36 +98,24 @@ def clean_title(title_html):
     title = title.strip()
     return title
 
-def main():
-    if not os.path.exists(SOURCE_FILE):
-        print(f"Error: Source file not found at {SOURCE_FILE}")
-        return
-
-    print(f"Reading {SOURCE_FILE}...")
-    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
-        content = f.read()
-
+def split_chapters(content):
+    """
+    Splits the source into blocks and groups them into chapters at the
+    part and chapter headings.
+    Returns (chapters, blocks, body_start), or None if there is no body.
+    """
     # Extract Body Content
     body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
     if not body_match:
         print("Could not find body tag.")
-        return
+        return None
     full_body_content = body_match.group(1)
 
     # Split into blocks based on top-level divs with id 'calibre_link-X'
     # This covers both <div class="calibre" id="..."> and <div class="brownll" id="...">
-    parts = re.split(r'(<div[^>]+id="calibre_link-\d+"[^>]*>)', full_body_content)
-    
-    blocks = []
-    if len(parts) > 1:
-        # parts[0] is usually empty or whitespace before first div
-        # The split keeps delimiters, so parts[1] is delimiter, parts[2] is content.
-        # We need to Combine Delimiter + Content
-        for i in range(1, len(parts), 2):
-            if i+1 < len(parts):
-                block = parts[i] + parts[i+1]
-                blocks.append(block)
-    else:
+    # Only top-level divs start a block; anything before the first one is dropped
+    blocks = split_blocks(full_body_content, r'<div[^>]+id="calibre_link-\d+"[^>]*>')
+    if not blocks:
         # Fallback
         blocks = [full_body_content]
 
@@ -235,9 +182,43 @@ def main():
                     "is_part_header": False
                 })
 
+    return chapters, blocks, body_match.start(1)
+
+def main():
+    if not os.path.exists(SOURCE_FILE):
+        print(f"Error: Source file not found at {SOURCE_FILE}")
+        return
+
+    print(f"Reading {SOURCE_FILE}...")
+    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    # Reuse the book IR from a previous build when neither the source nor
+    # the splitting code changed; otherwise parse the source and save it
+    code_key = code_version(split_chapters, clean_title)
+    book = load_book(IR_FILE, content, code_key)
+    if book is not None:
+        print(f"Loaded {len(book.chapters)} chapters from {IR_FILE}")
+    else:
+        parsed = split_chapters(content)
+        if parsed is None:
+            return
+        chapters, blocks, body_start = parsed
+        assets = list_assets(os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME), IMAGES_DIR_NAME)
+        book = save_book(IR_FILE, content, code_key, chapters, blocks, body_start, assets=assets)
+        # The book's chapters slice the source by offset; drop the parsed copies
+        del parsed, blocks
+    chapters = book.chapters
+
+    # Subdivide oversized chapters (only when EBOOK_HELPER_MAX_PAGE_KB is set)
+    chapters = split_oversized(chapters)
+
     # Generate TOC HTML
     toc_html = ""
     for ch in chapters:
+        # Sub-pages of a split chapter are reached through its first page
+        if ch.get("continuation_of"):
+            continue
         title = ch["title"]
         filename = ch["filename"]
         
@@ -251,62 +232,94 @@ def main():
             toc_html += f'<li><a href="{filename}">{title}</a></li>\n'
 
     # Prepare Output
-    if os.path.exists(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
+    # Everything is written to a staging directory that replaces
+    # OUTPUT_DIR only once the build is complete
+    with staged_output(OUTPUT_DIR) as out_dir:
     
-    # Copy Assets
-    src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
-    dst_images = os.path.join(OUTPUT_DIR, IMAGES_DIR_NAME)
-    if os.path.exists(src_images):
-        shutil.copytree(src_images, dst_images)
-        print(f"Copied images from {src_images}")
-    else:
-        print(f"Warning: Image directory not found at {src_images}")
+        # Copy Assets
+        # Images are copied in the background while the pages are written
+        src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
+        dst_images = os.path.join(out_dir, IMAGES_DIR_NAME)
+        image_sync = start_asset_sync([(src_images, dst_images)])
+        try:
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(os.path.dirname(src_images), out_dir, IMAGE_CACHE_DIR)
+            if not os.path.exists(src_images):
+                print(f"Warning: Image directory not found at {src_images}")
 
-    src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
-    if os.path.exists(src_style):
-        shutil.copy(src_style, os.path.join(OUTPUT_DIR, 'style.css'))
-        print("Copied original style.css")
+            src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
+            if os.path.exists(src_style):
+                shutil.copy(src_style, os.path.join(out_dir, 'style.css'))
+                print("Copied original style.css")
         
-    theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
-    if os.path.exists(theme_src):
-        shutil.copy(theme_src, os.path.join(OUTPUT_DIR, THEME_CSS_NAME))
-        print(f"Copied {THEME_CSS_NAME}")
-
-    # Write Pages
-    print(f"Generating {len(chapters)} pages...")
-    for i, ch in enumerate(chapters):
-        # Navigation
-        prev_btn = ""
-        if i > 0:
-            prev_ch = chapters[i-1]
-            prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← {prev_ch["title"]}</a>'
+            # The theme and the page scripts go into the site, or the shared asset store
+            site_files = SiteFiles(OUTPUT_DIR)
+            theme_css = THEME_CSS_NAME
+            theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
+            if os.path.exists(theme_src):
+                theme_css = site_files.add_file(out_dir, THEME_CSS_NAME, theme_src)
+                print(f"Copied {THEME_CSS_NAME}")
+
+            # Write Pages
+            print(f"Generating {len(chapters)} pages...")
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(theme_css=theme_css, toc_items=toc_html, site_scripts=site_files.site_scripts(out_dir))
+
+            # First images of every page, collected once for the prefetch hints
+            page_images = [chapter_images(ch) for ch in chapters]
+
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, ch in enumerate(chapters):
+                # Navigation
+                prev_btn = ""
+                if i > 0:
+                    prev_ch = chapters[i-1]
+                    prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← {prev_ch["title"]}</a>'
             
-        next_btn = ""
-        if i < len(chapters) - 1:
-            next_ch = chapters[i+1]
-            next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">{next_ch["title"]} →</a>'
+                next_btn = ""
+                if i < len(chapters) - 1:
+                    next_ch = chapters[i+1]
+                    next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">{next_ch["title"]} →</a>'
         
-        # Truncate long button text
-        if len(prev_btn) > 40:
-             prev_btn = f'<a href="{chapters[i-1]["filename"]}" class="nav-btn prev">← 上一章</a>'
-        if len(next_btn) > 40:
-             next_btn = f'<a href="{chapters[i+1]["filename"]}" class="nav-btn next">下一章 →</a>'
+                # Truncate long button text
+                if len(prev_btn) > 40:
+                     prev_btn = f'<a href="{chapters[i-1]["filename"]}" class="nav-btn prev">← 上一章</a>'
+                if len(next_btn) > 40:
+                     next_btn = f'<a href="{chapters[i+1]["filename"]}" class="nav-btn next">下一章 →</a>'
 
-        content = "\n".join(ch["content_blocks"])
-        
-        html = HTML_TEMPLATE.format(
-            title=ch["title"],
-            theme_css=THEME_CSS_NAME,
-            toc_items=toc_html,
-            content=content,
-            prev_button=prev_btn,
-            next_button=next_btn
-        )
+                content = "\n".join(ch["content_blocks"])
         
-        with open(os.path.join(OUTPUT_DIR, ch["filename"]), 'w', encoding='utf-8') as f:
-            f.write(html)
+                # Let the browser fetch the next chapter (and its first images) early
+                head_links = ""
+                if i < len(chapters) - 1:
+                    head_links = prefetch_hints(chapters[i+1]["filename"], page_images[i+1], image_variants)
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                content = image_variants.rewrite(content)
+                page_lengths.append((ch["filename"], text_length(content)))
+
+                page_template.write(
+                    os.path.join(out_dir, ch["filename"]),
+                    title=ch["title"],
+                    head_links=head_links,
+                    content=content,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # The service worker hashes every file, so the images must be in place
+            image_sync.wait()
+        finally:
+            image_sync.close()
+
+        # Shared reading-position script, with the page-length table
+        write_reading_table(out_dir, page_lengths)
+
+        # Service worker for offline reading (written last: it hashes every file)
+        write_service_worker(out_dir, [ch["filename"] for ch in chapters], site_files.shared)
 
     print(f"Done. Output in {OUTPUT_DIR_NAME}")
 
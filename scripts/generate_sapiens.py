@@ -3,6 +3,12 @@ import re
 import shutil
 import argparse
 
+from ebook_engine import (BlockCache, ImageVariants, PageTemplate, SiteFiles, chapter_images,
+                          code_version, discover_toc, iter_chapter_starts, list_assets,
+                          load_book, prefetch_hints, save_book, section_entries, split_blocks,
+                          split_oversized, staged_output, start_asset_sync, text_length,
+                          toc_title_map, write_reading_table, write_service_worker)
+
 # Configuration
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -14,6 +20,9 @@ SOURCE_DIR_NAME = 'sapiens-a-brief-history-of-humankind'
 SOURCE_FILE = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'index.html')
 IMAGES_DIR_NAME = 'images'
 THEME_CSS_NAME = 'theme_sapiens.css'
+CACHE_FILE = os.path.join(PROJECT_ROOT, '.cache', 'sapiens.sqlite')
+IR_FILE = os.path.join(PROJECT_ROOT, '.cache', 'sapiens.ir.jsonl')
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
 
 # HTML Template (English)
 HTML_TEMPLATE = """
@@ -26,6 +35,7 @@ HTML_TEMPLATE = """
     <!-- Local CSS only for offline access -->
     <link rel="stylesheet" href="style.css">
     <link rel="stylesheet" href="{theme_css}">
+    {head_links}
 </head>
 <body>
     <div class="app-container">
@@ -71,139 +81,44 @@ HTML_TEMPLATE = """
         </div>
     </div>
     
-    <script>
-        document.addEventListener('DOMContentLoaded', () => {{
-            // Highlight active TOC item
-            const currentObj = window.location.pathname.split('/').pop();
-            const links = document.querySelectorAll('.toc a');
-            links.forEach(link => {{
-                if (link.getAttribute('href') === currentObj) {{
-                    link.classList.add('active');
-                    link.scrollIntoView({{ block: 'center', behavior: 'smooth' }});
-                }}
-            }});
-            
-            // Mobile Menu
-            const toggleBtn = document.getElementById('menu-toggle');
-            const closeBtn = document.getElementById('menu-close');
-            const sidebar = document.getElementById('sidebar');
-            const overlay = document.getElementById('sidebar-overlay');
-            
-            function toggleMenu() {{
-                sidebar.classList.toggle('open');
-                overlay.classList.toggle('active');
-            }}
-            
-            function closeMenu() {{
-                sidebar.classList.remove('open');
-                overlay.classList.remove('active');
-            }}
-            
-            if(toggleBtn) toggleBtn.addEventListener('click', toggleMenu);
-            if(closeBtn) closeBtn.addEventListener('click', closeMenu);
-            if(overlay) overlay.addEventListener('click', closeMenu);
-
-            // Lightbox
-            const lightbox = document.getElementById('lightbox');
-            const lightboxImg = document.getElementById('lightbox-img');
-            const contentImages = document.querySelectorAll('.chapter-content img');
-
-            contentImages.forEach(img => {{
-                img.style.cursor = 'zoom-in';
-                img.addEventListener('click', (e) => {{
-                    e.stopPropagation();
-                    lightboxImg.src = img.src;
-                    lightbox.classList.add('active');
-                }});
-            }});
-
-            lightbox.addEventListener('click', () => {{
-                lightbox.classList.remove('active');
-            }});
-        }});
-    </script>
+    {site_scripts}
 </body>
 </html>
 """
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
 
-# Structural Mapping
-# Based on analysis of index.html
-# "calibre_6" class marks the start of major sections
-HEADINGS_MAP = {
-    "calibre_link-4": "Title Page",
-    "calibre_link-5": "Copyright",
-    "calibre_link-6": "Dedication",
-    "calibre_link-7": "Timeline of History",
-    "calibre_link-8": "Part One: The Cognitive Revolution",
-    "calibre_link-9": "1. An Animal of No Significance",
-    "calibre_link-10": "2. The Tree of Knowledge",
-    "calibre_link-11": "3. A Day in the Life of Adam and Eve",
-    "calibre_link-12": "4. The Flood",
-    "calibre_link-13": "Part Two: The Agricultural Revolution",
-    "calibre_link-14": "5. History's Biggest Fraud",
-    "calibre_link-15": "6. Building Pyramids",
-    "calibre_link-16": "7. Memory Overload",
-    "calibre_link-17": "8. There is No Justice in History",
-    "calibre_link-18": "Part Three: The Unification of Humankind",
-    "calibre_link-19": "9. The Arrow of History",
-    "calibre_link-20": "10. The Scent of Money",
-    "calibre_link-21": "11. Imperial Visions",
-    "calibre_link-22": "12. The Law of Religion",
-    "calibre_link-23": "13. The Secret of Success",
-    "calibre_link-24": "Part Four: The Scientific Revolution",
-    "calibre_link-25": "14. The Discovery of Ignorance",
-    "calibre_link-26": "15. The Marriage of Science and Empire",
-    "calibre_link-27": "16. The Capitalist Creed",
-    "calibre_link-28": "17. The Wheels of Industry",
-    "calibre_link-29": "18. A Permanent Revolution",
-    "calibre_link-30": "19. And They Lived Happily Ever After",
-    "calibre_link-31": "20. The End of Homo Sapiens",
-    "calibre_link-32": "Afterword: The Animal that Became a God",
-    "calibre_link-33": "Notes",
-    "calibre_link-34": "Acknowledgements",
-    "calibre_link-35": "Image credits"
-}
-
-PART_HEADERS = [
-    "Part One: The Cognitive Revolution",
-    "Part Two: The Agricultural Revolution",
-    "Part Three: The Unification of Humankind",
-    "Part Four: The Scientific Revolution"
-]
-
-def main():
-    if not os.path.exists(SOURCE_FILE):
-        print(f"Error: Source file not found at {SOURCE_FILE}")
-        return
-
-    print(f"Reading {SOURCE_FILE}...")
-    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
-        content = f.read()
-
+def split_chapters(content):
+    """
+    Splits the source into blocks and groups them into chapters at the
+    anchors listed in the contents page.
+    Returns (chapters, blocks, body_start, toc), or None if there is no body.
+    """
     # Extract Body Content
     body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
     if not body_match:
         print("Could not find body tag.")
-        return
+        return None
     full_body_content = body_match.group(1)
 
     # Split into blocks based on top-level divs with class 'calibre'
     # Pattern: <div class="calibre" id="calibre_link-36">
-    parts = re.split(r'(<div class="calibre"[^>]*>)', full_body_content)
-    
-    blocks = []
-    if len(parts) > 1:
-        # parts[0] is usually empty or whitespace before first div
-        for i in range(1, len(parts), 2):
-            if i+1 < len(parts):
-                block = parts[i] + parts[i+1]
-                blocks.append(block)
-    else:
+    # (nested calibre divs stay inside their block)
+    blocks = split_blocks(full_body_content, r'<div class="calibre"[^>]*>')
+    if not blocks:
         # Fallback if no such div found (unlikely for this file)
         blocks = [full_body_content]
 
     print(f"Found {len(blocks)} content blocks.")
 
+    # Structural Mapping
+    # The contents page lists the anchors (<p id="calibre_link-X" class="calibre_6">)
+    # that start each section; parts are its top-level entries
+    with BlockCache(CACHE_FILE, "toc") as cache:
+        toc = discover_toc(full_body_content, cache)
+    print(f"Extracted {len(toc)} TOC entries.")
+    headings_map = toc_title_map(toc)
+    part_headers = {entry.title for entry in section_entries(toc)}
+
     chapters = []
     current_chapter = {
         "title": "Front Matter",
@@ -212,28 +127,14 @@ def main():
         "is_part_header": False
     }
 
-    # Regex to find the Anchors that define chapters
-    # We look for the <p id="calibre_link-X" class="calibre_6"> inside the block
-    anchor_pattern = re.compile(r'id="(calibre_link-\d+)"', re.IGNORECASE)
-    
-    # Track which anchor started the current chapter to avoid duplicates
-    current_anchor_id = None
+    # The first section in the contents page (the title page) is the landing page
+    landing_pending = True
 
-    for block in blocks:
-        # Check if this block contains a defining anchor
-        found_new_chapter = False
-        target_anchor = None
-        
-        # We need to find the *first* matching anchor in this block that is in our HEADINGS_MAP
-        matches = anchor_pattern.findall(block)
-        for anchor in matches:
-            if anchor in HEADINGS_MAP:
-                target_anchor = anchor
-                break
-        
-        if target_anchor:
+    # Walk the blocks, looking only for the anchors that define chapters
+    # (the anchors listed in the contents page); ID= counts as id=
+    for block, new_title in iter_chapter_starts(blocks, headings_map, ignore_case=True):
+        if new_title is not None:
             # We found a start of a new section
-            new_title = HEADINGS_MAP[target_anchor]
             
             # Save previous chapter if it has content
             if current_chapter["content_blocks"]:
@@ -248,8 +149,9 @@ def main():
             
             # Determine filename
             # Special case for Index
-            if new_title == "Title Page":
+            if landing_pending:
                  filename = "index.html"
+                 landing_pending = False
             else:
                  # Sequential naming is safer to keep order
                  filename = f"chapter_{len(chapters):02d}.html"
@@ -258,9 +160,8 @@ def main():
                 "title": new_title,
                 "filename": filename,
                 "content_blocks": [block],
-                "is_part_header": new_title in PART_HEADERS
+                "is_part_header": new_title in part_headers
             }
-            current_anchor_id = target_anchor
         else:
             # Continue current chapter
             current_chapter["content_blocks"].append(block)
@@ -269,12 +170,46 @@ def main():
     if current_chapter:
         chapters.append(current_chapter)
 
+    return chapters, blocks, body_match.start(1), toc
+
+def main():
+    if not os.path.exists(SOURCE_FILE):
+        print(f"Error: Source file not found at {SOURCE_FILE}")
+        return
+
+    print(f"Reading {SOURCE_FILE}...")
+    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    # Reuse the book IR from a previous build when neither the source nor
+    # the splitting code changed; otherwise parse the source and save it
+    code_key = code_version(split_chapters)
+    book = load_book(IR_FILE, content, code_key)
+    if book is not None:
+        print(f"Loaded {len(book.chapters)} chapters from {IR_FILE}")
+    else:
+        parsed = split_chapters(content)
+        if parsed is None:
+            return
+        chapters, blocks, body_start, toc = parsed
+        assets = list_assets(os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME), IMAGES_DIR_NAME)
+        book = save_book(IR_FILE, content, code_key, chapters, blocks, body_start, toc, assets)
+        # The book's chapters slice the source by offset; drop the parsed copies
+        del parsed, blocks
+    chapters = book.chapters
+
+    # Subdivide oversized chapters (only when EBOOK_HELPER_MAX_PAGE_KB is set)
+    chapters = split_oversized(chapters)
+
     # Generate TOC HTML
     toc_html = ""
     # Add explicit link to Front Matter if not covered
-    # (The loop above handles it if Title Page was found, otherwise we might miss it)
+    # (The loop above writes the first contents entry to index.html)
     
     for ch in chapters:
+        # Sub-pages of a split chapter are reached through its first page
+        if ch.get("continuation_of"):
+            continue
         # If it's a Part Header, we can style it differently or just add it
         title = ch["title"]
         filename = ch["filename"]
@@ -286,70 +221,102 @@ def main():
             toc_html += f'<li><a href="{filename}">{title}</a></li>\n'
 
     # Prepare Output
-    if os.path.exists(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
+    # Everything is written to a staging directory that replaces
+    # OUTPUT_DIR only once the build is complete
+    with staged_output(OUTPUT_DIR) as out_dir:
     
-    # Copy Assets
-    src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
-    dst_images = os.path.join(OUTPUT_DIR, IMAGES_DIR_NAME)
-    if os.path.exists(src_images):
-        shutil.copytree(src_images, dst_images)
-        print(f"Copied images from {src_images}")
-
-    src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
-    if os.path.exists(src_style):
-        shutil.copy(src_style, os.path.join(OUTPUT_DIR, 'style.css'))
-        print("Copied original style.css")
+        # Copy Assets
+        # Images are copied in the background while the pages are written
+        src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
+        dst_images = os.path.join(out_dir, IMAGES_DIR_NAME)
+        image_sync = start_asset_sync([(src_images, dst_images)])
+        try:
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(os.path.dirname(src_images), out_dir, IMAGE_CACHE_DIR)
+
+            src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
+            if os.path.exists(src_style):
+                shutil.copy(src_style, os.path.join(out_dir, 'style.css'))
+                print("Copied original style.css")
         
-    theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
-    if os.path.exists(theme_src):
-        shutil.copy(theme_src, os.path.join(OUTPUT_DIR, THEME_CSS_NAME))
-        print(f"Copied {THEME_CSS_NAME}")
-
-    # Write Pages
-    print(f"Generating {len(chapters)} pages...")
-    for i, ch in enumerate(chapters):
-        # Navigation
-        prev_btn = ""
-        if i > 0:
-            prev_ch = chapters[i-1]
-            prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← Previous</a>'
+            # The theme and the page scripts go into the site, or the shared asset store
+            site_files = SiteFiles(OUTPUT_DIR)
+            theme_css = THEME_CSS_NAME
+            theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
+            if os.path.exists(theme_src):
+                theme_css = site_files.add_file(out_dir, THEME_CSS_NAME, theme_src)
+                print(f"Copied {THEME_CSS_NAME}")
+
+            # Write Pages
+            print(f"Generating {len(chapters)} pages...")
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(theme_css=theme_css, toc_items=toc_html, site_scripts=site_files.site_scripts(out_dir))
+
+            # First images of every page, collected once for the prefetch hints
+            page_images = [chapter_images(ch) for ch in chapters]
+
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, ch in enumerate(chapters):
+                # Navigation
+                prev_btn = ""
+                if i > 0:
+                    prev_ch = chapters[i-1]
+                    prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← Previous</a>'
             
-        next_btn = ""
-        if i < len(chapters) - 1:
-            next_ch = chapters[i+1]
-            next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">Next →</a>'
+                next_btn = ""
+                if i < len(chapters) - 1:
+                    next_ch = chapters[i+1]
+                    next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">Next →</a>'
 
-        content = "\n".join(ch["content_blocks"])
-        
-        # Inject IDs into links if needed ? 
-        # The internal links like <a href="#calibre_link-45"> work if the target ID is on the same page.
-        # But we split pages. 
-        # FIX: We need to rewrite internal hrefs.
-        # Map all锚点 -> Filename
+                content = "\n".join(ch["content_blocks"])
         
-        # NOT IMPLEMENTED YET: Complex rewrites. 
-        # Implementation Plan Option A: "保留链接但转换为页内锚点" which implies if it's on same page it works. 
-        # If it's on distinct page, it breaks.
-        # User accepted plan which said "Proposal A: Keep as anchor".
-        # However, for a better experience, basic remapping is good if simple.
-        # Since we have the chapters, let's verify if we can easily map.
+                # Inject IDs into links if needed ? 
+                # The internal links like <a href="#calibre_link-45"> work if the target ID is on the same page.
+                # But we split pages. 
+                # FIX: We need to rewrite internal hrefs.
+                # Map all锚点 -> Filename
         
-        # Not doing complex remapping now as per plan Step 1 (Implementation Phase) 
-        # just focused on generation.
+                # NOT IMPLEMENTED YET: Complex rewrites. 
+                # Implementation Plan Option A: "保留链接但转换为页内锚点" which implies if it's on same page it works. 
+                # If it's on distinct page, it breaks.
+                # User accepted plan which said "Proposal A: Keep as anchor".
+                # However, for a better experience, basic remapping is good if simple.
+                # Since we have the chapters, let's verify if we can easily map.
         
-        html = HTML_TEMPLATE.format(
-            title=ch["title"],
-            theme_css=THEME_CSS_NAME,
-            toc_items=toc_html,
-            content=content,
-            prev_button=prev_btn,
-            next_button=next_btn
-        )
+                # Not doing complex remapping now as per plan Step 1 (Implementation Phase) 
+                # just focused on generation.
         
-        with open(os.path.join(OUTPUT_DIR, ch["filename"]), 'w', encoding='utf-8') as f:
-            f.write(html)
+                # Let the browser fetch the next chapter (and its first images) early
+                head_links = ""
+                if i < len(chapters) - 1:
+                    head_links = prefetch_hints(chapters[i+1]["filename"], page_images[i+1], image_variants)
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                content = image_variants.rewrite(content)
+                page_lengths.append((ch["filename"], text_length(content)))
+
+                page_template.write(
+                    os.path.join(out_dir, ch["filename"]),
+                    title=ch["title"],
+                    head_links=head_links,
+                    content=content,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # The service worker hashes every file, so the images must be in place
+            image_sync.wait()
+        finally:
+            image_sync.close()
+
+        # Shared reading-position script, with the page-length table
+        write_reading_table(out_dir, page_lengths)
+
+        # Service worker for offline reading (written last: it hashes every file)
+        write_service_worker(out_dir, [ch["filename"] for ch in chapters], site_files.shared)
 
     print("Done.")
 
@@ -3,6 +3,12 @@ import os
 import re
 import shutil
 
+from ebook_engine import (BlockCache, ImageVariants, PageTemplate, SiteFiles, chapter_images,
+                          code_version, discover_toc, list_assets, load_book, prefetch_hints,
+                          save_book, split_blocks, split_oversized, staged_output,
+                          start_asset_sync, text_length, toc_title_map, write_reading_table,
+                          write_service_worker)
+
 # Configuration
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -13,6 +19,9 @@ SOURCE_DIR_NAME = 'si-chou-zhi-lu'
 SOURCE_FILE = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'index.html')
 IMAGES_DIR_NAME = 'images'
 THEME_CSS_NAME = 'theme_sichou.css'
+CACHE_FILE = os.path.join(PROJECT_ROOT, '.cache', 'sichou.sqlite')
+IR_FILE = os.path.join(PROJECT_ROOT, '.cache', 'sichou.ir.jsonl')
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
 
 # HTML Template
 HTML_TEMPLATE = """
@@ -25,6 +34,7 @@ HTML_TEMPLATE = """
     <!-- Local CSS only for offline access -->
     <link rel="stylesheet" href="style.css">
     <link rel="stylesheet" href="{theme_css}">
+    {head_links}
 </head>
 <body>
     <div class="app-container">
@@ -71,124 +81,23 @@ HTML_TEMPLATE = """
         </div>
     </div>
     
-    <script>
-        document.addEventListener('DOMContentLoaded', () => {{
-            // Highlight active TOC item
-            const currentObj = window.location.pathname.split('/').pop();
-            const links = document.querySelectorAll('.toc a');
-            links.forEach(link => {{
-                if (link.getAttribute('href') === currentObj) {{
-                    link.classList.add('active');
-                    link.scrollIntoView({{ block: 'center', behavior: 'smooth' }});
-                }}
-            }});
-            
-            // Mobile Menu
-            const toggleBtn = document.getElementById('menu-toggle');
-            const closeBtn = document.getElementById('menu-close');
-            const sidebar = document.getElementById('sidebar');
-            const overlay = document.getElementById('sidebar-overlay');
-            
-            function toggleMenu() {{
-                sidebar.classList.toggle('open');
-                overlay.classList.toggle('active');
-            }}
-            
-            function closeMenu() {{
-                sidebar.classList.remove('open');
-                overlay.classList.remove('active');
-            }}
-            
-            if(toggleBtn) toggleBtn.addEventListener('click', toggleMenu);
-            if(closeBtn) closeBtn.addEventListener('click', closeMenu);
-            if(overlay) overlay.addEventListener('click', closeMenu);
-
-            // Lightbox
-            const lightbox = document.getElementById('lightbox');
-            const lightboxImg = document.getElementById('lightbox-img');
-            const contentImages = document.querySelectorAll('.chapter-content img');
-
-            contentImages.forEach(img => {{
-                img.style.cursor = 'zoom-in';
-                img.addEventListener('click', (e) => {{
-                    e.stopPropagation();
-                    lightboxImg.src = img.src;
-                    lightbox.classList.add('active');
-                }});
-            }});
-
-            lightbox.addEventListener('click', () => {{
-                lightbox.classList.remove('active');
-            }});
-        }});
-    </script>
+    {site_scripts}
 </body>
 </html>
 """
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
 
-def extract_toc_map(content):
+def split_chapters(content):
     """
-    Extracts the TOC mapping from the HTML.
-    Targeting the TOC block: <div class="p-text" id="calibre_link-5">
-    Returns a dictionary: { "calibre_link-X": "Title" }
+    Splits the source into blocks and groups them into chapters at the
+    anchors listed in the contents page.
+    Returns (chapters, blocks, body_start, toc), or None if there is no body.
     """
-    toc_map = {}
-    
-    # Locate the TOC block
-    # It seems strictly between id="calibre_link-5" and the next id="calibre_link-6"
-    # But since we are splitting by blocks anyway, we can just find the block that contains "目次" class="big-h"
-    
-    # We will iterate through blocks later. But for now, let's find the TOC in the raw content just to be sure
-    # Or, we can parse it from the specific block if we can find it.
-    
-    # Let's use regex to find all links in the file that look like TOC entries
-    # Pattern seen: <p class="calibre"><a href="#calibre_link-8" ...><span ...>第一章</span> <span ...>絲綢之路的開端</span></a></p>
-    # Also: <p class="calibre"><span class="bold"><a href="#calibre_link-6" ...><span ...>關於字母轉寫</span></a></span></p>
-    
-    # We'll search for all <a href="#calibre_link-\d+">...</a> and extract text.
-    # However, create a map only for UNIQUE links that appear in the TOC area. 
-    # To be safe, let's try to identify the TOC region first.
-    
-    start_marker = '<div class="p-text" id="calibre_link-5">'
-    end_marker = '<div class="p-text" id="calibre_link-6">' # Assumption based on file view
-    
-    start_idx = content.find(start_marker)
-    if start_idx == -1:
-        print("Warning: Could not find strict TOC block start. Using loose regex.")
-        search_area = content # Fallback to whole file? No, that might catch internal links.
-    else:
-        end_idx = content.find(end_marker, start_idx)
-        if end_idx == -1:
-             search_area = content[start_idx:]
-        else:
-             search_area = content[start_idx:end_idx]
-    
-    # Extract links
-    # <a href="#calibre_link-8" ...> ... </a>
-    link_pattern = re.compile(r'<a href="#(calibre_link-\d+)"[^>]*>(.*?)</a>', re.DOTALL)
-    
-    matches = link_pattern.findall(search_area)
-    for link_id, link_inner in matches:
-        # Strip spans to get clean text
-        clean_text = re.sub(r'<[^>]+>', '', link_inner).strip()
-        # Clean up whitespace
-        clean_text = ' '.join(clean_text.split())
-        toc_map[link_id] = clean_text
-        
+    # Get TOC Map ({ "calibre_link-X": "Title" }) from the book's contents page
+    with BlockCache(CACHE_FILE, "toc") as cache:
+        toc = discover_toc(content, cache)
+    toc_map = toc_title_map(toc)
     print(f"Extracted {len(toc_map)} TOC entries.")
-    return toc_map
-
-def main():
-    if not os.path.exists(SOURCE_FILE):
-        print(f"Error: Source file not found at {SOURCE_FILE}")
-        return
-
-    print(f"Reading {SOURCE_FILE}...")
-    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
-        content = f.read()
-
-    # Get TOC Map
-    toc_map = extract_toc_map(content)
     
     # Add manual entry for the first few pages if they are not in TOC
     # Usually link-0 to link-4 are images and foreword stuff.
@@ -201,30 +110,24 @@ def main():
     body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
     if not body_match:
         print("Could not find body tag.")
-        return
+        return None
     full_body_content = body_match.group(1)
 
     # Split into blocks
     # Pattern: <div class="p-text" id="calibre_link-36"> or <div class="p-cover" id="...">
     # We want to keep the delimiter to know the ID
-    parts = re.split(r'(<div class="(?:p-text|p-cover)"[^>]*>)', full_body_content)
-    
+    # Only top-level divs start a block; anything before the first one is dropped
     blocks = []
-    # parts[0] is usually empty or whitespace
-    # parts[1] is delim, parts[2] is content, parts[3] is delim...
-    for i in range(1, len(parts), 2):
-        if i+1 < len(parts):
-            header = parts[i]
-            body = parts[i+1]
-            # Extract ID from header
-            id_match = re.search(r'id="(calibre_link-\d+)"', header)
-            block_id = id_match.group(1) if id_match else None
-            
-            full_block = header + body
-            blocks.append({
-                "id": block_id,
-                "content": full_block
-            })
+    for full_block in split_blocks(full_body_content, r'<div class="(?:p-text|p-cover)"[^>]*>'):
+        # Extract ID from the block's start tag
+        header = full_block[:full_block.index('>') + 1]
+        id_match = re.search(r'id="(calibre_link-\d+)"', header)
+        block_id = id_match.group(1) if id_match else None
+        
+        blocks.append({
+            "id": block_id,
+            "content": full_block
+        })
 
     print(f"Found {len(blocks)} content blocks.")
 
@@ -267,6 +170,37 @@ def main():
             # Append to current
             current_chapter["content_blocks"].append(block["content"])
 
+    return chapters, [block["content"] for block in blocks], body_match.start(1), toc
+
+def main():
+    if not os.path.exists(SOURCE_FILE):
+        print(f"Error: Source file not found at {SOURCE_FILE}")
+        return
+
+    print(f"Reading {SOURCE_FILE}...")
+    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    # Reuse the book IR from a previous build when neither the source nor
+    # the splitting code changed; otherwise parse the source and save it
+    code_key = code_version(split_chapters)
+    book = load_book(IR_FILE, content, code_key)
+    if book is not None:
+        print(f"Loaded {len(book.chapters)} chapters from {IR_FILE}")
+    else:
+        parsed = split_chapters(content)
+        if parsed is None:
+            return
+        chapters, blocks, body_start, toc = parsed
+        assets = list_assets(os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME), IMAGES_DIR_NAME)
+        book = save_book(IR_FILE, content, code_key, chapters, blocks, body_start, toc, assets)
+        # The book's chapters slice the source by offset; drop the parsed copies
+        del parsed, blocks
+    chapters = book.chapters
+
+    # Subdivide oversized chapters (only when EBOOK_HELPER_MAX_PAGE_KB is set)
+    chapters = split_oversized(chapters)
+
     # Generate TOC HTML for sidebar
     # We need to use the chapters list, but we should probably filter out empty ones or merge
     # Actually, relying on the TOC map order is safer for the "official" TOC, 
@@ -274,6 +208,9 @@ def main():
     
     toc_html = ""
     for ch in chapters:
+        # Sub-pages of a split chapter are reached through its first page
+        if ch.get("continuation_of"):
+            continue
         title = ch["title"]
         filename = ch["filename"]
         
@@ -281,54 +218,86 @@ def main():
         toc_html += f'<li><a href="{filename}">{title}</a></li>\n'
 
     # Prepare Output
-    if os.path.exists(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
+    # Everything is written to a staging directory that replaces
+    # OUTPUT_DIR only once the build is complete
+    with staged_output(OUTPUT_DIR) as out_dir:
     
-    # Copy Assets
-    src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
-    dst_images = os.path.join(OUTPUT_DIR, IMAGES_DIR_NAME)
-    if os.path.exists(src_images):
-        shutil.copytree(src_images, dst_images)
-        print(f"Copied images from {src_images}")
+        # Copy Assets
+        # Images are copied in the background while the pages are written
+        src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
+        dst_images = os.path.join(out_dir, IMAGES_DIR_NAME)
+        image_sync = start_asset_sync([(src_images, dst_images)])
+        try:
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(os.path.dirname(src_images), out_dir, IMAGE_CACHE_DIR)
 
-    src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
-    if os.path.exists(src_style):
-        shutil.copy(src_style, os.path.join(OUTPUT_DIR, 'style.css'))
-        print("Copied original style.css")
+            src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
+            if os.path.exists(src_style):
+                shutil.copy(src_style, os.path.join(out_dir, 'style.css'))
+                print("Copied original style.css")
         
-    theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
-    if os.path.exists(theme_src):
-        shutil.copy(theme_src, os.path.join(OUTPUT_DIR, THEME_CSS_NAME))
-        print(f"Copied {THEME_CSS_NAME}")
+            # The theme and the page scripts go into the site, or the shared asset store
+            site_files = SiteFiles(OUTPUT_DIR)
+            theme_css = THEME_CSS_NAME
+            theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
+            if os.path.exists(theme_src):
+                theme_css = site_files.add_file(out_dir, THEME_CSS_NAME, theme_src)
+                print(f"Copied {THEME_CSS_NAME}")
 
-    # Write Pages
-    print(f"Generating {len(chapters)} pages...")
-    for i, ch in enumerate(chapters):
-        # Navigation
-        prev_btn = ""
-        if i > 0:
-            prev_ch = chapters[i-1]
-            prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← 上一章</a>'
+            # Write Pages
+            print(f"Generating {len(chapters)} pages...")
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(theme_css=theme_css, toc_items=toc_html, site_scripts=site_files.site_scripts(out_dir))
+
+            # First images of every page, collected once for the prefetch hints
+            page_images = [chapter_images(ch) for ch in chapters]
+
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, ch in enumerate(chapters):
+                # Navigation
+                prev_btn = ""
+                if i > 0:
+                    prev_ch = chapters[i-1]
+                    prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← 上一章</a>'
             
-        next_btn = ""
-        if i < len(chapters) - 1:
-            next_ch = chapters[i+1]
-            next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">下一章 →</a>'
+                next_btn = ""
+                if i < len(chapters) - 1:
+                    next_ch = chapters[i+1]
+                    next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">下一章 →</a>'
 
-        content = "\n".join(ch["content_blocks"])
-        
-        html = HTML_TEMPLATE.format(
-            title=ch["title"],
-            theme_css=THEME_CSS_NAME,
-            toc_items=toc_html,
-            content=content,
-            prev_button=prev_btn,
-            next_button=next_btn
-        )
+                content = "\n".join(ch["content_blocks"])
         
-        with open(os.path.join(OUTPUT_DIR, ch["filename"]), 'w', encoding='utf-8') as f:
-            f.write(html)
+                # Let the browser fetch the next chapter (and its first images) early
+                head_links = ""
+                if i < len(chapters) - 1:
+                    head_links = prefetch_hints(chapters[i+1]["filename"], page_images[i+1], image_variants)
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                content = image_variants.rewrite(content)
+                page_lengths.append((ch["filename"], text_length(content)))
+
+                page_template.write(
+                    os.path.join(out_dir, ch["filename"]),
+                    title=ch["title"],
+                    head_links=head_links,
+                    content=content,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # The service worker hashes every file, so the images must be in place
+            image_sync.wait()
+        finally:
+            image_sync.close()
+
+        # Shared reading-position script, with the page-length table
+        write_reading_table(out_dir, page_lengths)
+
+        # Service worker for offline reading (written last: it hashes every file)
+        write_service_worker(out_dir, [ch["filename"] for ch in chapters], site_files.shared)
 
     print(f"Done. Output in {OUTPUT_DIR}")
 
@@ -3,6 +3,11 @@ import os
 import re
 import shutil
 
+from ebook_engine import (BlockCache, ContentFilter, ImageVariants, PageTemplate, SiteFiles,
+                          chapter_images, discover_toc, iter_block_spans, prefetch_hints,
+                          split_oversized, staged_output, start_asset_sync, text_length,
+                          write_reading_table, write_service_worker)
+
 # Configuration
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -13,6 +18,12 @@ SOURCE_DIR_NAME = 'si-chou-zhi-lu-shao-xu-dong'
 SOURCE_FILE = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'index.html')
 IMAGES_DIR_NAME = 'images'
 THEME_CSS_NAME = 'theme_sichou_shao.css'
+CACHE_FILE = os.path.join(PROJECT_ROOT, '.cache', 'sichou_shao.sqlite')
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
+FILTER_RULES = os.path.join(SCRIPT_DIR, 'filters', 'sichou_shao.rules')
+
+# Top-level container of each block: <div class="calibre" id="calibre_link-36">
+BLOCK_OPENER = re.compile(r'<div class="calibre" id="[^"]+">')
 
 # HTML Template
 HTML_TEMPLATE = """
@@ -25,6 +36,7 @@ HTML_TEMPLATE = """
     <!-- Local CSS only for offline access -->
     <link rel="stylesheet" href="style.css">
     <link rel="stylesheet" href="{theme_css}">
+    {head_links}
 </head>
 <body>
     <div class="app-container">
@@ -71,117 +83,11 @@ HTML_TEMPLATE = """
         </div>
     </div>
     
-    <script>
-        document.addEventListener('DOMContentLoaded', () => {{
-            // Highlight active TOC item
-            const currentObj = window.location.pathname.split('/').pop();
-            const links = document.querySelectorAll('.toc a');
-            links.forEach(link => {{
-                if (link.getAttribute('href') === currentObj) {{
-                    link.classList.add('active');
-                    link.scrollIntoView({{ block: 'center', behavior: 'smooth' }});
-                }}
-            }});
-            
-            // Mobile Menu
-            const toggleBtn = document.getElementById('menu-toggle');
-            const closeBtn = document.getElementById('menu-close');
-            const sidebar = document.getElementById('sidebar');
-            const overlay = document.getElementById('sidebar-overlay');
-            
-            function toggleMenu() {{
-                sidebar.classList.toggle('open');
-                overlay.classList.toggle('active');
-            }}
-            
-            function closeMenu() {{
-                sidebar.classList.remove('open');
-                overlay.classList.remove('active');
-            }}
-            
-            if(toggleBtn) toggleBtn.addEventListener('click', toggleMenu);
-            if(closeBtn) closeBtn.addEventListener('click', closeMenu);
-            if(overlay) overlay.addEventListener('click', closeMenu);
-
-            // Lightbox
-            const lightbox = document.getElementById('lightbox');
-            const lightboxImg = document.getElementById('lightbox-img');
-            const contentImages = document.querySelectorAll('.chapter-content img');
-
-            contentImages.forEach(img => {{
-                img.style.cursor = 'zoom-in';
-                img.addEventListener('click', (e) => {{
-                    e.stopPropagation();
-                    lightboxImg.src = img.src;
-                    lightbox.classList.add('active');
-                }});
-            }});
-
-            lightbox.addEventListener('click', () => {{
-                lightbox.classList.remove('active');
-            }});
-        }});
-    </script>
+    {site_scripts}
 </body>
 </html>
 """
-
-def remove_ads(content):
-    """
-    Remove ads and promotional content added by ebook piracy sites.
-    """
-    # Pattern for the specific ad text - match the whole paragraph
-    # 本書由"行行"整理，如果你不知道讀什麼書或者想獲得更多免費電子書...
-    ad_patterns = [
-        r'<p[^>]*>\s*本書由"行行"整理[^<]*</p>',
-        r'<p[^>]*>[^<]*行行[^<]*整理[^<]*微信[^<]*QQ[^<]*</p>',
-        r'<p[^>]*>[^<]*ireadweek\.com[^<]*</p>',
-        r'<p class="calibre_5">[^<]*本書由"行行"整理[^<]*</p>',
-        r'<p class="calibre_6">[^<]*本書由"行行"整理[^<]*</p>',
-    ]
-    
-    cleaned = content
-    for pattern in ad_patterns:
-        cleaned = re.sub(pattern, '', cleaned, flags=re.DOTALL | re.IGNORECASE)
-    
-    return cleaned
-
-def extract_toc_list(content):
-    """
-    Extracts the TOC mapping from the HTML.
-    Returns a list of tuples: [("anchor_id", "Title"), ...]
-    """
-    toc_list = []
-    
-    # Locate the TOC block
-    # It seems to be in the first block or specifically in <div class="calibre" id="calibre_link-0">
-    start_marker = '<div class="calibre" id="calibre_link-0">'
-    end_marker = '<div class="calibre" id="calibre_link-31">' # Based on file view, TOC ends before this image block
-    
-    start_idx = content.find(start_marker)
-    if start_idx == -1:
-        print("Warning: Could not find TOC block start.")
-        search_area = content[0:20000] # Look at the beginning
-    else:
-        # Just look at the first block basically
-        # Or look until the next big div
-        end_idx = content.find('<div class="calibre" id="calibre_link-31">', start_idx)
-        if end_idx == -1: 
-             end_idx = start_idx + 10000
-        search_area = content[start_idx:end_idx]
-    
-    # Extract links
-    # <a href="#calibre_link-1">前 言</a>
-    link_pattern = re.compile(r'<a href="#(calibre_link-\d+)">([^<]+)</a>', re.DOTALL)
-    
-    matches = link_pattern.findall(search_area)
-    for link_id, link_text in matches:
-        clean_text = re.sub(r'<[^>]+>', '', link_text).strip()
-        clean_text = ' '.join(clean_text.split())
-        toc_list.append((link_id, clean_text))
-        
-    print(f"Extracted {len(toc_list)} TOC entries.")
-    return toc_list
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
 
 def main():
     if not os.path.exists(SOURCE_FILE):
@@ -192,8 +98,10 @@ def main():
     with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
         content = f.read()
 
-    # Get TOC List
-    toc_list = extract_toc_list(content)
+    # Get TOC List ([("anchor_id", "Title"), ...]) from the book's contents page
+    with BlockCache(CACHE_FILE, "toc") as cache:
+        toc_list = [(entry.fragment, entry.title) for entry in discover_toc(content, cache)]
+    print(f"Extracted {len(toc_list)} TOC entries.")
     
     # Extract Body Content
     body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
@@ -201,18 +109,29 @@ def main():
         print("Could not find body tag.")
         return
     full_body_content = body_match.group(1)
+    body_start = body_match.start(1)
 
     # Split into blocks
     # Pattern: <div class="calibre" id="calibre_link-36">
-    parts = re.split(r'(<div class="calibre" id="[^"]+">)', full_body_content)
+    # (only top-level divs start a block)
+    spans = [(body_start + start, body_start + end)
+             for start, end in iter_block_spans(full_body_content, BLOCK_OPENER)]
+    block_texts = [content[start:end] for start, end in spans]
     
-    blocks = []
-    for i in range(1, len(parts), 2):
-        if i+1 < len(parts):
-            header = parts[i]
-            body = parts[i+1]
-            full_block = header + body
-            blocks.append(full_block)
+    # Remove ads and promotional content added by ebook piracy sites from each
+    # block (rules in filters/sichou_shao.rules). Cleaned blocks are cached
+    # across builds, keyed by the block text and rule set; the rest are
+    # cleaned in worker processes for large sources.
+    ad_filter = ContentFilter.from_file(FILTER_RULES)
+    
+    with BlockCache(CACHE_FILE, f"content_filter:{ad_filter.version}") as cache:
+        blocks = cache.get_or_compute_many(
+            block_texts,
+            lambda missing: ad_filter.apply_blocks(SOURCE_FILE, content, [spans[i] for i in missing]))
+        print(f"Removed ads: {cache.summary()}")
+        if cache.misses:
+            # Match counts per rule, for the blocks transformed in this build
+            print(ad_filter.report())
 
     print(f"Found {len(blocks)} content blocks.")
 
@@ -276,65 +195,101 @@ def main():
             # Continue current chapter
             current_chapter["content_blocks"].append(block)
 
+    # Subdivide oversized chapters (only when EBOOK_HELPER_MAX_PAGE_KB is set)
+    chapters = split_oversized(chapters)
+
     # Generate TOC HTML for sidebar
     toc_html = f'<li><a href="index.html">封面 / 目錄</a></li>\n'
     for i, ch in enumerate(chapters):
         if i == 0: continue # Skip cover
+        # Sub-pages of a split chapter are reached through its first page
+        if ch.get("continuation_of"):
+            continue
         title = ch["title"]
         filename = ch["filename"]
         toc_html += f'<li><a href="{filename}">{title}</a></li>\n'
 
     # Prepare Output
-    if os.path.exists(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
+    # Everything is written to a staging directory that replaces
+    # OUTPUT_DIR only once the build is complete
+    with staged_output(OUTPUT_DIR) as out_dir:
     
-    # Copy Assets
-    src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
-    dst_images = os.path.join(OUTPUT_DIR, IMAGES_DIR_NAME)
-    if os.path.exists(src_images):
-        shutil.copytree(src_images, dst_images)
-        print(f"Copied images from {src_images}")
+        # Copy Assets
+        # Images are copied in the background while the pages are written
+        src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
+        dst_images = os.path.join(out_dir, IMAGES_DIR_NAME)
+        image_sync = start_asset_sync([(src_images, dst_images)])
+        try:
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(os.path.dirname(src_images), out_dir, IMAGE_CACHE_DIR)
 
-    src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
-    if os.path.exists(src_style):
-        shutil.copy(src_style, os.path.join(OUTPUT_DIR, 'style.css'))
-        print("Copied original style.css")
+            src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
+            if os.path.exists(src_style):
+                shutil.copy(src_style, os.path.join(out_dir, 'style.css'))
+                print("Copied original style.css")
         
-    theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
-    if os.path.exists(theme_src):
-        shutil.copy(theme_src, os.path.join(OUTPUT_DIR, THEME_CSS_NAME))
-        print(f"Copied {THEME_CSS_NAME}")
+            # The theme and the page scripts go into the site, or the shared asset store
+            site_files = SiteFiles(OUTPUT_DIR)
+            theme_css = THEME_CSS_NAME
+            theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
+            if os.path.exists(theme_src):
+                theme_css = site_files.add_file(out_dir, THEME_CSS_NAME, theme_src)
+                print(f"Copied {THEME_CSS_NAME}")
 
-    # Write Pages
-    print(f"Generating {len(chapters)} pages...")
-    for i, ch in enumerate(chapters):
-        # Navigation
-        prev_btn = ""
-        if i > 0:
-            prev_ch = chapters[i-1]
-            prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← {prev_ch["title"]}</a>'
+            # Write Pages
+            print(f"Generating {len(chapters)} pages...")
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(theme_css=theme_css, toc_items=toc_html, site_scripts=site_files.site_scripts(out_dir))
+
+            # First images of every page, collected once for the prefetch hints
+            page_images = [chapter_images(ch) for ch in chapters]
+
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, ch in enumerate(chapters):
+                # Navigation
+                prev_btn = ""
+                if i > 0:
+                    prev_ch = chapters[i-1]
+                    prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← {prev_ch["title"]}</a>'
             
-        next_btn = ""
-        if i < len(chapters) - 1:
-            next_ch = chapters[i+1]
-            next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">{next_ch["title"]} →</a>'
+                next_btn = ""
+                if i < len(chapters) - 1:
+                    next_ch = chapters[i+1]
+                    next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">{next_ch["title"]} →</a>'
 
-        content = "\n".join(ch["content_blocks"])
-        # Remove ads from content
-        content = remove_ads(content)
-        
-        html = HTML_TEMPLATE.format(
-            title=ch["title"],
-            theme_css=THEME_CSS_NAME,
-            toc_items=toc_html,
-            content=content,
-            prev_button=prev_btn,
-            next_button=next_btn
-        )
+                content = "\n".join(ch["content_blocks"])
         
-        with open(os.path.join(OUTPUT_DIR, ch["filename"]), 'w', encoding='utf-8') as f:
-            f.write(html)
+                # Let the browser fetch the next chapter (and its first images) early
+                head_links = ""
+                if i < len(chapters) - 1:
+                    head_links = prefetch_hints(chapters[i+1]["filename"], page_images[i+1], image_variants)
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                content = image_variants.rewrite(content)
+                page_lengths.append((ch["filename"], text_length(content)))
+
+                page_template.write(
+                    os.path.join(out_dir, ch["filename"]),
+                    title=ch["title"],
+                    head_links=head_links,
+                    content=content,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # The service worker hashes every file, so the images must be in place
+            image_sync.wait()
+        finally:
+            image_sync.close()
+
+        # Shared reading-position script, with the page-length table
+        write_reading_table(out_dir, page_lengths)
+
+        # Service worker for offline reading (written last: it hashes every file)
+        write_service_worker(out_dir, [ch["filename"] for ch in chapters], site_files.shared)
 
     print(f"Done. Output in {OUTPUT_DIR}")
 
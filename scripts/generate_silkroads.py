@@ -1,8 +1,16 @@
 
+import hashlib
 import os
 import re
 import shutil
 
+from ebook_engine import (BlockCache, FragmentLinker, ImageVariants, PageTemplate, SiteFiles,
+                          chapter_images, code_version, discover_toc, iter_chapter_starts,
+                          list_assets, load_book, map_blocks, prefetch_hints, save_book,
+                          source_spans, split_blocks, split_oversized, staged_output,
+                          start_asset_sync, text_length, toc_title_map, write_reading_table,
+                          write_service_worker)
+
 # Configuration
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -13,6 +21,11 @@ SOURCE_DIR_NAME = 'The Silk Roads_ A New History of the World - Peter Frankopan'
 SOURCE_FILE = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'index.html')
 IMAGES_DIR_NAME = 'images'
 THEME_CSS_NAME = 'theme_silkroads.css'
+CACHE_FILE = os.path.join(PROJECT_ROOT, '.cache', 'silkroads.sqlite')
+IR_FILE = os.path.join(PROJECT_ROOT, '.cache', 'silkroads.ir.jsonl')
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
+# Bump when replace_link changes behaviour so cached blocks are not reused
+LINK_REWRITE_VERSION = 1
 
 # HTML Template
 HTML_TEMPLATE = """
@@ -25,6 +38,7 @@ HTML_TEMPLATE = """
     <!-- Local CSS only for offline access -->
     <link rel="stylesheet" href="style.css">
     <link rel="stylesheet" href="{theme_css}">
+    {head_links}
 </head>
 <body>
     <div class="app-container">
@@ -72,143 +86,41 @@ HTML_TEMPLATE = """
         </div>
     </div>
     
-    <script>
-        document.addEventListener('DOMContentLoaded', () => {{
-            // Highlight active TOC item
-            const currentObj = window.location.pathname.split('/').pop();
-            const links = document.querySelectorAll('.toc a');
-            links.forEach(link => {{
-                if (link.getAttribute('href') === currentObj) {{
-                    link.classList.add('active');
-                    link.scrollIntoView({{ block: 'center', behavior: 'smooth' }});
-                }}
-            }});
-            
-            // Mobile Menu
-            const toggleBtn = document.getElementById('menu-toggle');
-            const closeBtn = document.getElementById('menu-close');
-            const sidebar = document.getElementById('sidebar');
-            const overlay = document.getElementById('sidebar-overlay');
-            
-            function toggleMenu() {{
-                sidebar.classList.toggle('open');
-                overlay.classList.toggle('active');
-            }}
-            
-            function closeMenu() {{
-                sidebar.classList.remove('open');
-                overlay.classList.remove('active');
-            }}
-            
-            if(toggleBtn) toggleBtn.addEventListener('click', toggleMenu);
-            if(closeBtn) closeBtn.addEventListener('click', closeMenu);
-            if(overlay) overlay.addEventListener('click', closeMenu);
-
-            // Lightbox
-            const lightbox = document.getElementById('lightbox');
-            const lightboxImg = document.getElementById('lightbox-img');
-            const contentImages = document.querySelectorAll('.chapter-content img');
-
-            contentImages.forEach(img => {{
-                img.style.cursor = 'zoom-in';
-                img.addEventListener('click', (e) => {{
-                    e.stopPropagation();
-                    lightboxImg.src = img.src;
-                    lightbox.classList.add('active');
-                }});
-            }});
-
-            lightbox.addEventListener('click', () => {{
-                lightbox.classList.remove('active');
-            }});
-        }});
-    </script>
+    {site_scripts}
 </body>
 </html>
 """
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
 
-def extract_toc_map(content):
+def split_chapters(content):
     """
-    Extracts the TOC mapping from the HTML.
-    Targeting the TOC block: <div class="calibre" id="calibre_link-5">
-    Returns a dictionary: { "calibre_link-X": "Title" } where X is the anchor ID.
+    Splits the source into blocks and groups them into chapters at the
+    anchors listed in the contents page.
+    Returns (chapters, blocks, body_start, toc), or None if there is no body.
     """
-    toc_map = {}
-    
-    # Locate the TOC block
-    # Based on file inspection, it's roughly lines 72-141, id="calibre_link-5"
-    
-    start_marker = '<div class="calibre" id="calibre_link-5">'
-    # We can look for the next div class="calibre" to end the block
-    
-    start_idx = content.find(start_marker)
-    if start_idx == -1:
-        print("Warning: Could not find strict TOC block start. Using loose regex.")
-        search_area = content 
-    else:
-        # Find next div that is a sibling or subsequent block
-        # A simple way is to find the next <div class="calibre" after the start
-        # but we need to be careful about nesting.
-        # Actually, let's just grab a chunk of text or use regex to find the end div
-        end_idx = content.find('<div class="calibre"', start_idx + len(start_marker))
-        if end_idx == -1:
-             search_area = content[start_idx:]
-        else:
-             search_area = content[start_idx:end_idx]
-    
-    # Extract links
-    # <a href="#calibre_link-13" class="calibre1">Chapter 1: ...</a>
-    link_pattern = re.compile(r'<a href="#(calibre_link-\d+)"[^>]*>(.*?)</a>', re.DOTALL)
-    
-    matches = link_pattern.findall(search_area)
-    for link_id, link_inner in matches:
-        # Strip spans/tags to get clean text
-        clean_text = re.sub(r'<[^>]+>', '', link_inner).strip()
-        # Clean up whitespace
-        clean_text = ' '.join(clean_text.split())
-        toc_map[link_id] = clean_text
-        
+    # Get TOC Map ({ "calibre_link-X": "Title" }) from the book's contents page
+    with BlockCache(CACHE_FILE, "toc") as cache:
+        toc = discover_toc(content, cache)
+    toc_map = toc_title_map(toc)
     print(f"Extracted {len(toc_map)} TOC entries.")
-    return toc_map
-
-def main():
-    if not os.path.exists(SOURCE_FILE):
-        print(f"Error: Source file not found at {SOURCE_FILE}")
-        return
-
-    print(f"Reading {SOURCE_FILE}...")
-    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
-        content = f.read()
-
-    # Get TOC Map
-    toc_map = extract_toc_map(content)
     
     # Extract Body Content
     body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
     if not body_match:
         print("Could not find body tag.")
-        return
+        return None
     full_body_content = body_match.group(1)
 
     # Split into blocks
     # Pattern: <div class="calibre" id="calibre_link-36">
-    parts = re.split(r'(<div class="calibre"[^>]*>)', full_body_content)
-    
+    # (nested calibre divs stay inside their block)
     blocks = []
-    # parts[0] is usually empty or whitespace
-    # parts[1] is delim, parts[2] is content, parts[3] is delim...
-    for i in range(1, len(parts), 2):
-        if i+1 < len(parts):
-            header = parts[i]
-            body = parts[i+1]
-            
-            # Note: We don't rely on the Div ID for the chapter mapping directly, 
-            # but on the anchor ID inside the block.
-            
-            full_block = header + body
-            blocks.append({
-                "content": full_block
-            })
+    for full_block in split_blocks(full_body_content, r'<div class="calibre"[^>]*>'):
+        # Note: We don't rely on the Div ID for the chapter mapping directly, 
+        # but on the anchor ID inside the block.
+        blocks.append({
+            "content": full_block
+        })
 
     print(f"Found {len(blocks)} content blocks.")
 
@@ -222,26 +134,10 @@ def main():
     }
     chapters.append(current_chapter)
     
-    # Regex to find anchors or IDs: id="calibre_link-XXX"
-    anchor_pattern = re.compile(r'id="(calibre_link-\d+)"')
-
-    for block in blocks:
-        block_content = block["content"]
-        
-        # Check if this block contains an anchor that is in our TOC map
-        anchors = anchor_pattern.findall(block_content)
-        
-        # Determine if we need to start a new chapter
-        is_new_chapter = False
-        new_chapter_title = ""
-        
-        for anchor in anchors:
-            if anchor in toc_map:
-                is_new_chapter = True
-                new_chapter_title = toc_map[anchor]
-                break
-        
-        if is_new_chapter:
+    # Only the anchors listed in the TOC start chapters; scan for those directly
+    for block_content, new_chapter_title in iter_chapter_starts(
+            (block["content"] for block in blocks), toc_map):
+        if new_chapter_title is not None:
             print(f"Starting chapter: {new_chapter_title}")
             
             # Determine filename
@@ -267,9 +163,41 @@ def main():
             # Append to current
             current_chapter["content_blocks"].append(block_content)
 
+    return chapters, [block["content"] for block in blocks], body_match.start(1), toc
+
+def main():
+    if not os.path.exists(SOURCE_FILE):
+        print(f"Error: Source file not found at {SOURCE_FILE}")
+        return
+
+    print(f"Reading {SOURCE_FILE}...")
+    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    # Reuse the book IR from a previous build when neither the source nor
+    # the splitting code changed; otherwise parse the source and save it
+    code_key = code_version(split_chapters)
+    book = load_book(IR_FILE, content, code_key)
+    if book is not None:
+        print(f"Loaded {len(book.chapters)} chapters from {IR_FILE}")
+    else:
+        parsed = split_chapters(content)
+        if parsed is None:
+            return
+        chapters, blocks, body_start, toc = parsed
+        assets = list_assets(os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME), IMAGES_DIR_NAME)
+        book = save_book(IR_FILE, content, code_key, chapters, blocks, body_start, toc, assets)
+        # The book's chapters slice the source by offset; drop the parsed copies
+        del parsed, blocks
+    chapters = book.chapters
+
+    # Subdivide oversized chapters (only when EBOOK_HELPER_MAX_PAGE_KB is set)
+    chapters = split_oversized(chapters)
+
     # Build Anchor Map
     # Map anchor ID to filename: { 'calibre_link-123': 'chapter_01.html', ... }
     anchor_id_to_filename = {}
+    anchor_pattern = re.compile(r'id="(calibre_link-\d+)"')
     
     # Also capture generic IDs if possible, but calibre mostly uses calibre_link-XXX
     # We'll use the same anchor_pattern regex
@@ -286,34 +214,51 @@ def main():
 
     # Fix Links in Content
     # Regex to find links: href="#calibre_link-XXX"
+    # Links to an anchor on another page become href="<page>#calibre_link-XXX"
     link_replace_pattern = re.compile(r'href="#(calibre_link-\d+)"')
+    linker = FragmentLinker(anchor_id_to_filename, link_replace_pattern)
+
+    # Every block of the book with the page it is written to
+    blocks = []
+    pages = []
+    block_counts = []
+    for ch in chapters:
+        ch_blocks = ch["content_blocks"]
+        blocks.extend(ch_blocks)
+        pages.extend([ch["filename"]] * len(ch_blocks))
+        block_counts.append(len(ch_blocks))
+    # Blocks still sliced from the source can be read by offset in worker processes
+    spans = source_spans(chapters, content)
 
-    def replace_link(match, current_filename):
-        link_id = match.group(1)
-        if link_id in anchor_id_to_filename:
-            target_filename = anchor_id_to_filename[link_id]
-            # If target is different file, rewrite link
-            if target_filename != current_filename:
-                return f'href="{target_filename}#{link_id}"'
-        # Otherwise keep as is
-        return match.group(0)
+    def rewrite(missing):
+        if spans is None:
+            return [linker(blocks[i], pages[i]) for i in missing]
+        return map_blocks(linker, SOURCE_FILE, content, [spans[i] for i in missing],
+                          args=[pages[i] for i in missing])
 
     # Process all chapters to update links
-    for ch in chapters:
-        current_filename = ch["filename"]
-        new_blocks = []
-        for block in ch["content_blocks"]:
-            # Use partial/lambda to pass current context if needed, but simple iteration works
-            # We need to pass current_filename to the replacer
-            # re.sub with a function: func(match_obj)
-            
-            updated_block = link_replace_pattern.sub(lambda m: replace_link(m, current_filename), block)
-            new_blocks.append(updated_block)
-        ch["content_blocks"] = new_blocks
+    # Rewritten blocks are cached across builds; a block's result depends on
+    # the page it lands on and on where every anchor lives.
+    anchor_digest = hashlib.sha256(repr(sorted(anchor_id_to_filename.items())).encode('utf-8')).hexdigest()
+    with BlockCache(CACHE_FILE, f"rewrite_links-{LINK_REWRITE_VERSION}") as cache:
+        rewritten = cache.get_or_compute_many(blocks, rewrite, [f"{page}:{anchor_digest}" for page in pages])
+        print(f"Rewrote links: {cache.summary()}")
+
+    position = 0
+    for ch, count in zip(chapters, block_counts):
+        ch_blocks = rewritten[position:position + count]
+        # Chapters without links to other pages keep slicing the source
+        if ch_blocks != blocks[position:position + count]:
+            ch["content_blocks"] = ch_blocks
+        position += count
+    del blocks, rewritten
 
     # Generate TOC HTML for sidebar
     toc_html = ""
     for ch in chapters:
+        # Sub-pages of a split chapter are reached through its first page
+        if ch.get("continuation_of"):
+            continue
         title = ch["title"]
         filename = ch["filename"]
         # Skip empty front matter if it has no title or weird title
@@ -323,56 +268,88 @@ def main():
         toc_html += f'<li><a href="{filename}">{title}</a></li>\n'
 
     # Prepare Output
-    if os.path.exists(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
+    # Everything is written to a staging directory that replaces
+    # OUTPUT_DIR only once the build is complete
+    with staged_output(OUTPUT_DIR) as out_dir:
     
-    # Copy Assets
-    src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
-    dst_images = os.path.join(OUTPUT_DIR, IMAGES_DIR_NAME)
-    if os.path.exists(src_images):
-        shutil.copytree(src_images, dst_images)
-        print(f"Copied images from {src_images}")
-
-    src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
-    if os.path.exists(src_style):
-        shutil.copy(src_style, os.path.join(OUTPUT_DIR, 'style.css'))
-        print("Copied original style.css")
+        # Copy Assets
+        # Images are copied in the background while the pages are written
+        src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
+        dst_images = os.path.join(out_dir, IMAGES_DIR_NAME)
+        image_sync = start_asset_sync([(src_images, dst_images)])
+        try:
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(os.path.dirname(src_images), out_dir, IMAGE_CACHE_DIR)
+
+            src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
+            if os.path.exists(src_style):
+                shutil.copy(src_style, os.path.join(out_dir, 'style.css'))
+                print("Copied original style.css")
         
-    theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
-    if os.path.exists(theme_src):
-        shutil.copy(theme_src, os.path.join(OUTPUT_DIR, THEME_CSS_NAME))
-        print(f"Copied {THEME_CSS_NAME}")
-
-    # Write Pages
-    print(f"Generating {len(chapters)} pages...")
-    for i, ch in enumerate(chapters):
-        # Navigation
-        prev_btn = ""
-        if i > 0:
-            prev_ch = chapters[i-1]
-            prev_title = "Previous"
-            prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn">← {prev_title}</a>'
+            # The theme and the page scripts go into the site, or the shared asset store
+            site_files = SiteFiles(OUTPUT_DIR)
+            theme_css = THEME_CSS_NAME
+            theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
+            if os.path.exists(theme_src):
+                theme_css = site_files.add_file(out_dir, THEME_CSS_NAME, theme_src)
+                print(f"Copied {THEME_CSS_NAME}")
+
+            # Write Pages
+            print(f"Generating {len(chapters)} pages...")
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(theme_css=theme_css, toc_items=toc_html, site_scripts=site_files.site_scripts(out_dir))
+
+            # First images of every page, collected once for the prefetch hints
+            page_images = [chapter_images(ch) for ch in chapters]
+
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, ch in enumerate(chapters):
+                # Navigation
+                prev_btn = ""
+                if i > 0:
+                    prev_ch = chapters[i-1]
+                    prev_title = "Previous"
+                    prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn">← {prev_title}</a>'
             
-        next_btn = ""
-        if i < len(chapters) - 1:
-            next_ch = chapters[i+1]
-            next_title = "Next"
-            next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn">{next_title} →</a>'
+                next_btn = ""
+                if i < len(chapters) - 1:
+                    next_ch = chapters[i+1]
+                    next_title = "Next"
+                    next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn">{next_title} →</a>'
 
-        content = "\n".join(ch["content_blocks"])
-        
-        html = HTML_TEMPLATE.format(
-            title=ch["title"],
-            theme_css=THEME_CSS_NAME,
-            toc_items=toc_html,
-            content=content,
-            prev_button=prev_btn,
-            next_button=next_btn
-        )
+                content = "\n".join(ch["content_blocks"])
         
-        with open(os.path.join(OUTPUT_DIR, ch["filename"]), 'w', encoding='utf-8') as f:
-            f.write(html)
+                # Let the browser fetch the next chapter (and its first images) early
+                head_links = ""
+                if i < len(chapters) - 1:
+                    head_links = prefetch_hints(chapters[i+1]["filename"], page_images[i+1], image_variants)
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                content = image_variants.rewrite(content)
+                page_lengths.append((ch["filename"], text_length(content)))
+
+                page_template.write(
+                    os.path.join(out_dir, ch["filename"]),
+                    title=ch["title"],
+                    head_links=head_links,
+                    content=content,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # The service worker hashes every file, so the images must be in place
+            image_sync.wait()
+        finally:
+            image_sync.close()
+
+        # Shared reading-position script, with the page-length table
+        write_reading_table(out_dir, page_lengths)
+
+        # Service worker for offline reading (written last: it hashes every file)
+        write_service_worker(out_dir, [ch["filename"] for ch in chapters], site_files.shared)
 
     print(f"Done. Output in {OUTPUT_DIR}")
 
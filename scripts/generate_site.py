@@ -2,6 +2,12 @@ import os
 import re
 import shutil
 
+from ebook_engine import (BlockCache, ImageVariants, PageTemplate, SiteFiles, chapter_images,
+                          code_version, compile_anchor_scanner, discover_toc, list_assets,
+                          load_book, prefetch_hints, save_book, section_entries, split_blocks,
+                          split_oversized, staged_output, start_asset_sync, text_length,
+                          write_reading_table, write_service_worker)
+
 # Get the project root directory (parent of scripts/)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -12,6 +18,9 @@ OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'dist')
 SOURCE_FILE = os.path.join(PUBLIC_DIR, 'index.html')
 IMAGES_DIR = 'images'
 THEME_CSS = os.path.join(SCRIPT_DIR, 'theme.css')
+CACHE_FILE = os.path.join(PROJECT_ROOT, '.cache', 'site.sqlite')
+IR_FILE = os.path.join(PROJECT_ROOT, '.cache', 'site.ir.jsonl')
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
 
 # HTML Template with offline compatibility and mobile menu support
 HTML_TEMPLATE = """
@@ -23,7 +32,8 @@ HTML_TEMPLATE = """
     <title>{title} - 中國・歷史的長河</title>
     <!-- Local CSS only for offline access -->
     <link rel="stylesheet" href="style.css">
-    <link rel="stylesheet" href="theme.css">
+    <link rel="stylesheet" href="{theme_css}">
+    {head_links}
 </head>
 <body>
     <div class="app-container">
@@ -69,106 +79,36 @@ HTML_TEMPLATE = """
         </div>
     </div>
     
-    <script>
-        document.addEventListener('DOMContentLoaded', () => {{
-            // highlight active TOC item
-            const currentObj = window.location.pathname.split('/').pop();
-            const links = document.querySelectorAll('.toc a');
-            links.forEach(link => {{
-                if (link.getAttribute('href') === currentObj) {{
-                    link.classList.add('active');
-                    link.scrollIntoView({{ block: 'center', behavior: 'smooth' }});
-                }}
-            }});
-            
-            // Mobile Menu Logic
-            const toggleBtn = document.getElementById('menu-toggle');
-            const closeBtn = document.getElementById('menu-close');
-            const sidebar = document.getElementById('sidebar');
-            const overlay = document.getElementById('sidebar-overlay');
-            
-            function toggleMenu() {{
-                sidebar.classList.toggle('open');
-                overlay.classList.toggle('active');
-            }}
-            
-            function closeMenu() {{
-                sidebar.classList.remove('open');
-                overlay.classList.remove('active');
-            }}
-            
-            if(toggleBtn) toggleBtn.addEventListener('click', toggleMenu);
-            if(closeBtn) closeBtn.addEventListener('click', closeMenu);
-            if(overlay) overlay.addEventListener('click', closeMenu);
-
-            // Lightbox Logic
-            const lightbox = document.getElementById('lightbox');
-            const lightboxImg = document.getElementById('lightbox-img');
-            const contentImages = document.querySelectorAll('.chapter-content img');
-
-            contentImages.forEach(img => {{
-                img.addEventListener('click', (e) => {{
-                    e.stopPropagation();
-                    lightboxImg.src = img.src;
-                    lightbox.classList.add('active');
-                }});
-            }});
-
-            lightbox.addEventListener('click', () => {{
-                lightbox.classList.remove('active');
-            }});
-        }});
-    </script>
+    {site_scripts}
 </body>
 </html>
 """
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
 
-def main():
-    # Check if source file exists
-    if not os.path.exists(SOURCE_FILE):
-        print(f"Error: Source file not found at {SOURCE_FILE}")
-        print(f"Please place your Calibre-exported index.html in the public/ directory.")
-        return
-    
-    print(f"Reading {SOURCE_FILE}...")
-    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
-        content = f.read()
-
+def split_chapters(content):
+    """
+    Splits the source into blocks and groups them into chapters at the
+    chapter headings.
+    Returns (chapters, blocks, body_start, toc), or None if there is no body.
+    """
     # Extract Body Content
     body_match = re.search(r'<body[^>]*>(.*?)</body>', content, re.DOTALL | re.IGNORECASE)
     if not body_match:
         print("Could not find body tag.")
-        return
+        return None
     
     full_body_content = body_match.group(1)
     
     # Split into blocks based on top-level divs with class 'calibre'
-    parts = re.split(r'(<div class="calibre"[^>]*>)', full_body_content)
-    
-    blocks = []
-    current_block = parts[0]
-    for i in range(1, len(parts), 2):
-        if i+1 < len(parts):
-            block = parts[i] + parts[i+1]
-            blocks.append(block)
+    # (nested calibre divs stay inside their block)
+    blocks = split_blocks(full_body_content, r'<div class="calibre"[^>]*>')
     
     print(f"Found {len(blocks)} content blocks.")
     
-    # Book Title Mapping (Filename -> Title)
-    BOOK_MAP = {
-        "index.html": "第一卷：從神話到歷史：神話時代與夏王朝",
-        "chapter_11.html": "第二卷：從城市國家到中華：殷商與春秋戰國時代",
-        "chapter_22.html": "第三卷：始皇帝的遺產：秦漢帝國",
-        "chapter_33.html": "第四卷：三國志的世界：東漢與三國時代",
-        "chapter_44.html": "第五卷：中華的崩潰與擴大：魏晉南北朝",
-        "chapter_54.html": "第六卷：絢爛的世界帝國：隋唐時代",
-        "chapter_66.html": "第七卷：中國思想與宗教的奔流：宋朝",
-        "chapter_76.html": "第八卷：疾馳的草原征服者：遼、西夏、金、元",
-        "chapter_83.html": "第九卷：海與帝國：明清時代",
-        "chapter_93.html": "第十卷：末代王朝與近代中國：晚清與中華民國",
-        "chapter_104.html": "第十一卷：巨龍的胎動：毛澤東、鄧小平與中華人民共和國",
-        "chapter_114.html": "第十二卷：日本人眼中的中國：過去與現在"
-    }
+    # Volume titles come from the book's own contents page
+    with BlockCache(CACHE_FILE, "toc") as cache:
+        toc = discover_toc(full_body_content, cache)
+    print(f"Extracted {len(toc)} TOC entries.")
 
     chapters = []
     current_chapter = {
@@ -227,64 +167,153 @@ def main():
     # Add last chapter
     if current_chapter:
         chapters.append(current_chapter)
+
+    return chapters, blocks, body_match.start(1), toc
+
+def main():
+    # Check if source file exists
+    if not os.path.exists(SOURCE_FILE):
+        print(f"Error: Source file not found at {SOURCE_FILE}")
+        print(f"Please place your Calibre-exported index.html in the public/ directory.")
+        return
     
-    # Prepare Output Directory
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+    print(f"Reading {SOURCE_FILE}...")
+    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    # Reuse the book IR from a previous build when neither the source nor
+    # the splitting code changed; otherwise parse the source and save it
+    code_key = code_version(split_chapters)
+    book = load_book(IR_FILE, content, code_key)
+    if book is not None:
+        print(f"Loaded {len(book.chapters)} chapters from {IR_FILE}")
+    else:
+        parsed = split_chapters(content)
+        if parsed is None:
+            return
+        chapters, blocks, body_start, toc = parsed
+        assets = list_assets(PUBLIC_DIR, IMAGES_DIR)
+        book = save_book(IR_FILE, content, code_key, chapters, blocks, body_start, toc, assets)
+        # The book's chapters slice the source by offset; drop the parsed copies
+        del parsed, blocks
+    chapters = book.chapters
+    toc = book.toc
+
+    # Subdivide oversized chapters (only when EBOOK_HELPER_MAX_PAGE_KB is set)
+    chapters = split_oversized(chapters)
+
+    # Volume headers (Filename -> Title)
+    # A volume's own anchor is usually its title page, which sits at the end
+    # of the previous volume's last chapter, so the header goes before the
+    # chapter holding the volume's first TOC child. The first volume opens
+    # the book.
+    section_headers = {}
+    sections = section_entries(toc)
+    if sections:
+        anchor_pages = {}
+        scanner = compile_anchor_scanner([entry.fragment for entry in toc])
+        for ch in chapters:
+            for block in ch["content_blocks"]:
+                for match in scanner.finditer(block):
+                    anchor_pages.setdefault(match.group(1), ch["filename"])
+        section_headers[chapters[0]["filename"]] = sections[0].title
+        for entry in sections[1:]:
+            child = toc[toc.index(entry) + 1]
+            filename = anchor_pages.get(child.fragment) or anchor_pages.get(entry.fragment)
+            if filename:
+                section_headers.setdefault(filename, entry.title)
+
+    # Prepare Output
+    # Everything is written to a staging directory that replaces
+    # OUTPUT_DIR only once the build is complete
+    with staged_output(OUTPUT_DIR) as out_dir:
         
-    # Copy Images from public/
-    src_images = os.path.join(PUBLIC_DIR, IMAGES_DIR)
-    dst_images = os.path.join(OUTPUT_DIR, IMAGES_DIR)
-    if os.path.exists(src_images):
-        if os.path.exists(dst_images):
-            shutil.rmtree(dst_images)
-        shutil.copytree(src_images, dst_images)
-        print("Images copied.")
+        # Copy Images from public/
+        # Images are copied in the background while the pages are written
+        src_images = os.path.join(PUBLIC_DIR, IMAGES_DIR)
+        dst_images = os.path.join(out_dir, IMAGES_DIR)
+        image_sync = start_asset_sync([(src_images, dst_images)])
+        try:
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(os.path.dirname(src_images), out_dir, IMAGE_CACHE_DIR)
 
-    # Copy Style.css from public/ if exists
-    src_style = os.path.join(PUBLIC_DIR, 'style.css')
-    if os.path.exists(src_style):
-        shutil.copy(src_style, os.path.join(OUTPUT_DIR, 'style.css'))
+            # Copy Style.css from public/ if exists
+            src_style = os.path.join(PUBLIC_DIR, 'style.css')
+            if os.path.exists(src_style):
+                shutil.copy(src_style, os.path.join(out_dir, 'style.css'))
     
-    # Copy theme.css from scripts/
-    if os.path.exists(THEME_CSS):
-        shutil.copy(THEME_CSS, os.path.join(OUTPUT_DIR, 'theme.css'))
-        print("Theme CSS copied.")
+            # Copy theme.css from scripts/
+            # The theme and the page scripts go into the site, or the shared asset store
+            site_files = SiteFiles(OUTPUT_DIR)
+            theme_css = 'theme.css'
+            if os.path.exists(THEME_CSS):
+                theme_css = site_files.add_file(out_dir, 'theme.css', THEME_CSS)
+                print("Theme CSS copied.")
     
-    # Generate TOC HTML with Book Headers
-    toc_html = ""
-    for ch in chapters:
-        fname = ch["filename"]
-        if fname in BOOK_MAP:
-            toc_html += f'<li class="book-section-header">{BOOK_MAP[fname]}</li>\n'
-        toc_html += f'<li><a href="{fname}">{ch["title"]}</a></li>\n'
+            # Generate TOC HTML with Book Headers
+            toc_html = ""
+            for ch in chapters:
+                # Sub-pages of a split chapter are reached through its first page
+                if ch.get("continuation_of"):
+                    continue
+                fname = ch["filename"]
+                if fname in section_headers:
+                    toc_html += f'<li class="book-section-header">{section_headers[fname]}</li>\n'
+                toc_html += f'<li><a href="{fname}">{ch["title"]}</a></li>\n'
     
-    # Write Chapters
-    for i, ch in enumerate(chapters):
-        # Nav buttons
-        prev_btn = ""
-        if i > 0:
-            prev_ch = chapters[i-1]
-            prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← {prev_ch["title"]}</a>'
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(theme_css=theme_css, toc_items=toc_html, site_scripts=site_files.site_scripts(out_dir))
+
+            # Write Chapters
+            # First images of every page, collected once for the prefetch hints
+            page_images = [chapter_images(ch) for ch in chapters]
+
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, ch in enumerate(chapters):
+                # Nav buttons
+                prev_btn = ""
+                if i > 0:
+                    prev_ch = chapters[i-1]
+                    prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← {prev_ch["title"]}</a>'
             
-        next_btn = ""
-        if i < len(chapters) - 1:
-            next_ch = chapters[i+1]
-            next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">{next_ch["title"]} →</a>'
-        
-        full_content = "\n".join(ch["content_blocks"])
+                next_btn = ""
+                if i < len(chapters) - 1:
+                    next_ch = chapters[i+1]
+                    next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">{next_ch["title"]} →</a>'
         
-        final_html = HTML_TEMPLATE.format(
-            title=ch["title"],
-            toc_items=toc_html,
-            content=full_content,
-            prev_button=prev_btn,
-            next_button=next_btn
-        )
+                full_content = "\n".join(ch["content_blocks"])
         
-        out_path = os.path.join(OUTPUT_DIR, ch["filename"])
-        with open(out_path, 'w', encoding='utf-8') as f:
-            f.write(final_html)
+                # Let the browser fetch the next chapter (and its first images) early
+                head_links = ""
+                if i < len(chapters) - 1:
+                    head_links = prefetch_hints(chapters[i+1]["filename"], page_images[i+1], image_variants)
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                full_content = image_variants.rewrite(full_content)
+                page_lengths.append((ch["filename"], text_length(full_content)))
+
+                page_template.write(
+                    os.path.join(out_dir, ch["filename"]),
+                    title=ch["title"],
+                    head_links=head_links,
+                    content=full_content,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # The service worker hashes every file, so the images must be in place
+            image_sync.wait()
+        finally:
+            image_sync.close()
+
+        # Shared reading-position script, with the page-length table
+        write_reading_table(out_dir, page_lengths)
+
+        # Service worker for offline reading (written last: it hashes every file)
+        write_service_worker(out_dir, [ch["filename"] for ch in chapters], site_files.shared)
             
     print(f"Generated {len(chapters)} pages in {OUTPUT_DIR}/")
 
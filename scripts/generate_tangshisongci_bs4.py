@@ -1,13 +1,20 @@
+import argparse
+import html
 import os
 import re
 import shutil
-from bs4 import BeautifulSoup, Tag, NavigableString
+from html.parser import HTMLParser
+
+from ebook_engine import (Chapter, ImageVariants, PageTemplate, SiteFiles, image_refs,
+                          prefetch_hints, staged_output, start_asset_sync, text_length,
+                          write_reading_table, write_service_worker)
 
 # Configuration
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 OUTPUT_DIR_NAME = 'dist_tangshisongci'
 OUTPUT_DIR = os.path.join(PROJECT_ROOT, OUTPUT_DIR_NAME)
+IMAGE_CACHE_DIR = os.path.join(PROJECT_ROOT, '.cache', 'images')
 
 # Book Specific Config
 SOURCE_DIR_NAME = 'Tang Shi Song Ci Yuan Qu Gu Wen (Gong 6Ce - Shang Hai Ci Shu Chu Ban She Wen Xue Jian '
@@ -26,6 +33,7 @@ HTML_TEMPLATE = """
     <!-- Local CSS only for offline access -->
     <link rel="stylesheet" href="style.css">
     <link rel="stylesheet" href="{theme_css}">
+    {head_links}
 </head>
 <body>
     <div class="app-container">
@@ -210,9 +218,11 @@ HTML_TEMPLATE = """
             }});
         }});
     </script>
+    {site_scripts}
 </body>
 </html>
 """
+PAGE_TEMPLATE = PageTemplate(HTML_TEMPLATE)
 
 def clean_title(title_text):
     if not title_text:
@@ -221,58 +231,241 @@ def clean_title(title_text):
     title = re.sub(r'\s+', ' ', title_text).strip()
     return title
 
+# Tag name -> classes that mark a chapter start
+HEADER_CLASSES = {
+    'h1': {'calibre5', 'calibre8', 'calibre26', 'kindle-cn-heading'},
+    'h2': {'calibre18', 'biaoti', 'calibre3', 'kindle-cn-heading1'},
+    'h3': {'kindle-cn-heading2'},
+    # Div (TOC)
+    'div': {'sgc-toc-title', 'kindle-cn-toc-title'},
+    # P (Poems - specifically requested)
+    'p': {'title-poem-k-zhong'},
+}
+
 def is_header(tag):
-    if not isinstance(tag, Tag):
+    # Text nodes (and comments) have no name
+    if tag.name is None:
         return False
     
     # We only care about specific headers
+    # Source uses classes heavily.
     classes = tag.get('class', [])
-    if not classes:
-        # Check if it's an H1 or H2 without class? 
-        # Source uses classes heavily.
-        return False
-    
-    # H1
-    if tag.name == 'h1': 
-        if 'calibre5' in classes: return True
-        if 'calibre8' in classes: return True
-        if 'calibre26' in classes: return True
-        if 'kindle-cn-heading' in classes: return True
-    
-    # H2
-    if tag.name == 'h2':
-        if 'calibre18' in classes: return True
-        if 'biaoti' in classes: return True
-        if 'calibre3' in classes: return True
-        if 'kindle-cn-heading1' in classes: return True
-
-    # H3
-    if tag.name == 'h3':
-        if 'kindle-cn-heading2' in classes: return True
+    return not HEADER_CLASSES.get(tag.name, set()).isdisjoint(classes)
+
+# Elements that never have content or an end tag
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+                 'meta', 'param', 'source', 'track', 'wbr'}
+
+TAG_PATTERN = re.compile(r'<[^>]*>')
+
+class SourceNode:
+    """
+    A top-level element of <body>, a child of a top-level <div>, or a text
+    run between such children (name None), kept as offsets into the source.
+    Answers the few BeautifulSoup calls split_chapters() makes (.name,
+    .get('class'), .children, str() and get_text()), so both parsers share
+    the splitting code; str() is the element exactly as written in the source.
+    """
+    __slots__ = ('name', 'classes', 'source', 'start', 'inner_start', 'inner_end', 'end', 'elements')
+
+    def __init__(self, name, classes, source, start, inner_start):
+        self.name = name
+        self.classes = classes
+        self.source = source
+        self.start = start
+        self.inner_start = inner_start
+        # Until an end tag is seen the element is just its start tag
+        self.inner_end = inner_start
+        self.end = inner_start
+        self.elements = []
+
+    def get(self, key, default=None):
+        return self.classes if key == 'class' and self.classes else default
+
+    @property
+    def children(self):
+        """Child elements, with the text between them as nameless nodes."""
+        nodes = []
+        position = self.inner_start
+        for element in self.elements + [None]:
+            text_end = element.start if element is not None else self.inner_end
+            if text_end > position:
+                text = SourceNode(None, [], self.source, position, position)
+                text.inner_end = text.end = text_end
+                nodes.append(text)
+            if element is not None:
+                nodes.append(element)
+                position = element.end
+        return nodes
+
+    def get_text(self):
+        return html.unescape(TAG_PATTERN.sub('', self.source[self.inner_start:self.inner_end]))
+
+    def __str__(self):
+        return self.source[self.start:self.end]
+
+class SourceParser(HTMLParser):
+    """
+    Single pass over the source with html.parser callbacks, tracking tag
+    depth inside <body>. Records every element directly inside <body> and
+    the children of the top-level <div>s -- the only levels split_chapters()
+    looks at -- without building a document tree.
+    """
+
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+        # Offset of the first character of each line, for getpos()
+        self.line_starts = [0] + [m.end() for m in re.finditer('\n', source)]
+        self.top_elements = None  # None until <body> is seen
+        self.open_tags = []  # (tag, SourceNode or None) for elements open inside <body>
+        self.body_done = False
+
+    def source_offset(self):
+        line, column = self.getpos()
+        return self.line_starts[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        if self.body_done:
+            return
+        if self.top_elements is None:
+            if tag == 'body':
+                self.top_elements = []
+            return
+
+        node = None
+        depth = len(self.open_tags)
+        parent = self.open_tags[0][1] if depth == 1 else None
+        if depth == 0 or (parent is not None and parent.name == 'div'):
+            start = self.source_offset()
+            classes = (dict(attrs).get('class') or '').split()
+            node = SourceNode(tag, classes, self.source, start, start + len(self.get_starttag_text()))
+            (self.top_elements if depth == 0 else parent.elements).append(node)
+
+        if tag not in VOID_ELEMENTS:
+            self.open_tags.append((tag, node))
+
+    def handle_startendtag(self, tag, attrs):
+        # <br/>, <div/>: an element with no content
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS and self.open_tags and self.open_tags[-1][0] == tag:
+            self.open_tags.pop()
+
+    def handle_endtag(self, tag):
+        if self.top_elements is None or self.body_done:
+            return
+        start = self.source_offset()
+        if tag in ('body', 'html'):
+            # Anything still open ends here
+            self.close_open(0, start, start)
+            self.body_done = True
+            return
+        # Like BeautifulSoup, an end tag closes everything opened after its
+        # start tag; a stray end tag is ignored
+        for i in range(len(self.open_tags) - 1, -1, -1):
+            if self.open_tags[i][0] == tag:
+                self.close_open(i + 1, start, start)
+                self.close_open(i, start, self.source.index('>', start) + 1)
+                return
+
+    def close_open(self, depth, inner_end, end):
+        """Closes the open elements deeper than depth at the given offsets."""
+        while len(self.open_tags) > depth:
+            _, node = self.open_tags.pop()
+            if node is not None:
+                node.inner_end = inner_end
+                node.end = end
+
+def parse_body(html_content):
+    """
+    Top-level elements of <body> found by SourceParser, or None if there
+    is no <body>.
+    """
+    parser = SourceParser(html_content)
+    parser.feed(html_content)
+    parser.close()
+    if not parser.body_done:
+        # No </body>: elements still open run to the end of the file
+        parser.close_open(0, len(html_content), len(html_content))
+    return parser.top_elements
+
+def parse_body_bs4(html_content):
+    """
+    Top-level elements of <body> as parsed by BeautifulSoup (the old path,
+    kept for comparison), or None if there is no <body>.
+    """
+    from bs4 import BeautifulSoup
 
-    # Div (TOC)
-    if tag.name == 'div':
-        if 'sgc-toc-title' in classes: return True
-        if 'kindle-cn-toc-title' in classes: return True
-        
-    # P (Poems - specifically requested)
-    if tag.name == 'p':
-        if 'title-poem-k-zhong' in classes: return True
-        
-    return False
-
-def main():
-    if not os.path.exists(SOURCE_FILE):
-        print(f"Error: Source file not found at {SOURCE_FILE}")
-        return
-
-    print(f"Reading {SOURCE_FILE}...")
-    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
-        html_content = f.read()
-
-    print("Parsing HTML with BeautifulSoup...")
     soup = BeautifulSoup(html_content, 'html.parser')
-    
+    body = soup.find('body')
+    if not body:
+        return None
+    # We use find_all recursive=False to get top level elements
+    return body.find_all(recursive=False)
+
+def merge_works(final_chapters, volumes):
+    """
+    Folds each author's works into the author's page, one after another,
+    each wrapped in a <div id="work-XXXX"> so it can be linked to.
+    Returns (pages, merged): the pages left to write, and for each page
+    that took works (by id()) its [(work id, work chapter)], which
+    page_blocks() renders; merged works keep a filename of the form
+    "chapter_0012.html#work-0013" for the TOC.
+    Only works that directly follow their author (or the author's previous
+    work) are merged, so reading order never changes.
+    """
+    author_of = {}
+    for vol in volumes:
+        for author in vol['authors']:
+            for work in author['works']:
+                author_of[id(work)] = author['chapter']
+
+    pages = []
+    merged = {}
+    for ch in final_chapters:
+        # pages[-1] is the page the previous chapter ended up on
+        if pages and author_of.get(id(ch)) is pages[-1]:
+            author_ch = pages[-1]
+            # The work's id comes from the page number it would have had
+            work_id = "work-" + ch['filename'][len("chapter_"):-len(".html")]
+            merged.setdefault(id(author_ch), []).append((work_id, ch))
+            ch['filename'] = f"{author_ch['filename']}#{work_id}"
+        else:
+            pages.append(ch)
+    return pages, merged
+
+def page_blocks(ch, merged):
+    """A page's blocks: its own, then those of the works merged into it."""
+    # A copy: records holding markup (--bs4) return their own list
+    blocks = list(ch['content_blocks'])
+    for work_id, work in merged.get(id(ch), ()):
+        blocks.append(f'<div class="work" id="{work_id}">')
+        blocks.extend(work['content_blocks'])
+        blocks.append('</div>')
+    return blocks
+
+def chapter_record(chapter):
+    """
+    The Chapter record for a chapter's elements: offsets into the source for
+    SourceNode elements, or the elements' markup for BeautifulSoup ones
+    (which are re-serialized, not slices of the source).
+    """
+    elements = chapter['elements']
+    if all(isinstance(element, SourceNode) for element in elements):
+        source = elements[0].source if elements else None
+        return Chapter.from_ranges(chapter['title'], None, source,
+                                   [(element.start, element.end) for element in elements],
+                                   is_part_header=chapter['is_header'])
+    record = Chapter(chapter['title'], None, None, is_part_header=chapter['is_header'])
+    record['content_blocks'] = [str(element) for element in elements]
+    return record
+
+def split_chapters(top_elements):
+    """
+    Splits the top-level elements of <body> (from parse_body() or
+    parse_body_bs4()) into chapters at header elements. Returns Chapter
+    records (is_part_header marks author and other major headers).
+    """
     chapters = []
     
     # Initialize first chapter (Cover/Preface)
@@ -282,28 +475,17 @@ def main():
         "is_header": False
     }
     
-    body = soup.find('body')
-    if not body:
-        print("No body tag found")
-        return
-
-    print("Processing content...")
-    
     # Heuristic: The ebook seems to use top-level divs with id="calibre_link-X" as containers.
     # Inside these divs, we have the content.
     # We will iterate through these top-level divs, and then iterate through their children.
     # If we find a header, we split.
     
-    # Find all direct children of body
-    # We use find_all recursive=False to get top level elements
-    top_elements = body.find_all(recursive=False)
-    
     for element in top_elements:
-        # If it's a NavigableString (just text between divs), add it to current
-        if isinstance(element, NavigableString):
+        # If it's a text node (just text between divs), add it to current
+        if element.name is None:
             txt = str(element).strip()
             if txt:
-                current_chapter['elements'].append(str(element))
+                current_chapter['elements'].append(element)
             continue
             
         # If it's a div (likely calibre_link wrapper), iterate ITS children
@@ -315,7 +497,7 @@ def main():
                  title = clean_title(element.get_text())
                  current_chapter = {
                     "title": title,
-                    "elements": [str(element)],
+                    "elements": [element],
                     "is_header": True # TOC divs are usually structural
                  }
                  continue
@@ -324,9 +506,9 @@ def main():
             # Note: If the div has NO ID or specific class, it might just be wrapper.
             # We treat it as a container.
             for child in element.children:
-                if isinstance(child, NavigableString):
+                if child.name is None:
                     if str(child).strip():
-                        current_chapter['elements'].append(str(child))
+                        current_chapter['elements'].append(child)
                     continue
                 
                 if is_header(child):
@@ -347,12 +529,12 @@ def main():
                         
                     current_chapter = {
                         "title": title,
-                        "elements": [str(child)],
+                        "elements": [child],
                         "is_header": is_major
                     }
                 else:
                     # Regular content
-                    current_chapter['elements'].append(str(child))
+                    current_chapter['elements'].append(child)
         else:
             # element is not a div (maybe h1 directly in body?)
             if is_header(element):
@@ -361,27 +543,60 @@ def main():
                 is_major = (element.name == 'h1')
                 current_chapter = {
                     "title": title,
-                    "elements": [str(element)],
+                    "elements": [element],
                     "is_header": is_major
                 }
             else:
-                current_chapter['elements'].append(str(element))
+                current_chapter['elements'].append(element)
 
     # Add the last chapter
     chapters.append(current_chapter)
+
+    return [chapter_record(ch) for ch in chapters]
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the 唐诗宋词元曲古文 static site.")
+    parser.add_argument('--merge-works', action='store_true',
+                        help="write each author's works on the author's page instead of one page per work")
+    parser.add_argument('--bs4', action='store_true',
+                        help="parse with BeautifulSoup (needs bs4) instead of the built-in html.parser splitter")
+    args = parser.parse_args()
+
+    if not os.path.exists(SOURCE_FILE):
+        print(f"Error: Source file not found at {SOURCE_FILE}")
+        return
+
+    print(f"Reading {SOURCE_FILE}...")
+    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
+        html_content = f.read()
+
+    if args.bs4:
+        print("Parsing HTML with BeautifulSoup...")
+        top_elements = parse_body_bs4(html_content)
+    else:
+        print("Parsing HTML...")
+        top_elements = parse_body(html_content)
+    if top_elements is None:
+        print("No body tag found")
+        return
+
+    print("Processing content...")
+    chapters = split_chapters(top_elements)
+    # The chapters keep offsets into html_content; the parsed elements can go
+    del top_elements
     
     # Remove empty chapters if any (except maybe the first one or valid ones)
     final_chapters = []
     for ch in chapters:
         # If title is empty/Unknown or content is empty, maybe skip?
         # But allow "Untitled" if it has content.
-        if not ch['elements'] and ch['title'] == 'Untitled':
+        if not ch.block_count() and ch['title'] == 'Untitled':
             continue
         # Dedupe titles? No, poems can have same title.
         
         # Override untitled if logical
         if ch['title'] == 'Untitled' or ch['title'] == 'Unknown':
-             if "封面" in str(ch['elements']):
+             if any("封面" in block for block in ch['content_blocks']):
                  ch['title'] = "封面"
         
         # Assign filename
@@ -396,29 +611,6 @@ def main():
 
     print(f"Identified {len(final_chapters)} chapters.")
 
-    # Generate Output
-    if os.path.exists(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
-
-    # Copy Assets
-    src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
-    dst_images = os.path.join(OUTPUT_DIR, IMAGES_DIR_NAME)
-    if os.path.exists(src_images):
-        shutil.copytree(src_images, dst_images)
-        print("Copied images.")
-
-    src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
-    if os.path.exists(src_style):
-        shutil.copy(src_style, os.path.join(OUTPUT_DIR, 'style.css'))
-        print("Copied style.css")
-
-    # Create theme file (assuming it exists in dist or scripts, copying from scripts)
-    theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
-    if os.path.exists(theme_src):
-         shutil.copy(theme_src, os.path.join(OUTPUT_DIR, THEME_CSS_NAME))
-         print("Copied theme css.")
-
     # Generate TOC HTML with THREE-LEVEL nesting: Volume → Author → Works
     # Volume markers are specific chapters for each major dictionary
     
@@ -473,7 +665,7 @@ def main():
         if not current_volume:
             # First few items before first volume - create 唐诗鉴赏辞典 as default
             current_volume = {
-                'chapter': {'title': '唐诗鉴赏辞典', 'filename': 'index.html', 'is_header': True},
+                'chapter': {'title': '唐诗鉴赏辞典', 'filename': 'index.html', 'is_part_header': True},
                 'authors': [],
                 'aux_items': []
             }
@@ -483,8 +675,8 @@ def main():
             current_volume['aux_items'].append(ch)
             continue
         
-        # Check if this is an author header (is_header=True)
-        if ch['is_header']:
+        # Check if this is an author header (is_part_header=True)
+        if ch['is_part_header']:
             # Save previous author
             if current_author:
                 current_volume['authors'].append(current_author)
@@ -507,6 +699,14 @@ def main():
     if current_volume:
         volumes.append(current_volume)
     
+    # With --merge-works, thousands of one-poem pages become one page per
+    # author; TOC links to works then point at page.html#work-XXXX
+    pages = final_chapters
+    merged = {}
+    if args.merge_works:
+        pages, merged = merge_works(final_chapters, volumes)
+        print(f"Merged works into author pages: {len(final_chapters)} -> {len(pages)} pages.")
+
     # Generate TOC HTML
     toc_html = ""
     
@@ -559,35 +759,91 @@ def main():
             toc_html += f'</li>\n'
         else:
             # Volume without content (standalone)
-            cls = "book-section-header" if vol_ch.get("is_header", False) else ""
+            cls = "book-section-header" if vol_ch.get("is_part_header", False) else ""
             toc_html += f'<li class="{cls}"><a href="{vol_file}">{vol_title}</a></li>\n'
 
-    # Write Pages
-    print(f"Writing {len(final_chapters)} pages...")
-    for i, ch in enumerate(final_chapters):
-        prev_btn = ""
-        if i > 0:
-            prev_ch = final_chapters[i-1]
-            prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← {prev_ch["title"][:10]}</a>'
+    # Prepare Output
+    # Everything is written to a staging directory that replaces
+    # OUTPUT_DIR only once the build is complete
+    with staged_output(OUTPUT_DIR) as out_dir:
+
+        # Copy Assets
+        # Images are copied in the background while the pages are written
+        src_images = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, IMAGES_DIR_NAME)
+        dst_images = os.path.join(out_dir, IMAGES_DIR_NAME)
+        image_sync = start_asset_sync([(src_images, dst_images)])
+        try:
+            # WebP/AVIF variants of the images pages use (with EBOOK_HELPER_IMAGE_FORMATS set)
+            image_variants = ImageVariants(os.path.dirname(src_images), out_dir, IMAGE_CACHE_DIR)
+
+            src_style = os.path.join(PROJECT_ROOT, SOURCE_DIR_NAME, 'style.css')
+            if os.path.exists(src_style):
+                shutil.copy(src_style, os.path.join(out_dir, 'style.css'))
+                print("Copied style.css")
+
+            # Create theme file (assuming it exists in dist or scripts, copying from scripts)
+            # It goes into the site, or the shared asset store, with the reading script
+            site_files = SiteFiles(OUTPUT_DIR)
+            theme_css = THEME_CSS_NAME
+            theme_src = os.path.join(SCRIPT_DIR, THEME_CSS_NAME)
+            if os.path.exists(theme_src):
+                theme_css = site_files.add_file(out_dir, THEME_CSS_NAME, theme_src)
+                print("Copied theme css.")
+
+            # Write Pages
+            print(f"Writing {len(pages)} pages...")
+            # Shared fragments are encoded once for all pages
+            page_template = PAGE_TEMPLATE.bind(theme_css=theme_css, toc_items=toc_html, site_scripts=site_files.site_scripts(out_dir, page_script=False))
+
+            # First images of every page, collected once for the prefetch hints
+            page_images = [image_refs(page_blocks(page, merged)) for page in pages]
+
+            # Text length of every page, for reading progress
+            page_lengths = []
+            for i, ch in enumerate(pages):
+                prev_btn = ""
+                if i > 0:
+                    prev_ch = pages[i-1]
+                    prev_btn = f'<a href="{prev_ch["filename"]}" class="nav-btn prev">← {prev_ch["title"][:10]}</a>'
             
-        next_btn = ""
-        if i < len(final_chapters) - 1:
-            next_ch = final_chapters[i+1]
-            next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">{next_ch["title"][:10]} →</a>'
-        
-        content_str = "\n".join(ch['elements'])
+                next_btn = ""
+                if i < len(pages) - 1:
+                    next_ch = pages[i+1]
+                    next_btn = f'<a href="{next_ch["filename"]}" class="nav-btn next">{next_ch["title"][:10]} →</a>'
         
-        html = HTML_TEMPLATE.format(
-            title=ch["title"],
-            theme_css=THEME_CSS_NAME,
-            toc_items=toc_html,
-            content=content_str,
-            prev_button=prev_btn,
-            next_button=next_btn
-        )
+                # Sliced from the source only while the page is written
+                content_str = "\n".join(page_blocks(ch, merged))
         
-        with open(os.path.join(OUTPUT_DIR, ch["filename"]), 'w', encoding='utf-8') as f:
-            f.write(html)
+                # Let the browser fetch the next chapter (and its first images) early
+                head_links = ""
+                if i < len(pages) - 1:
+                    head_links = prefetch_hints(pages[i+1]["filename"], page_images[i+1], image_variants)
+
+                # Images with smaller WebP/AVIF variants become <picture> elements
+                content_str = image_variants.rewrite(content_str)
+                page_lengths.append((ch["filename"], text_length(content_str)))
+
+                page_template.write(
+                    os.path.join(out_dir, ch["filename"]),
+                    title=ch["title"],
+                    head_links=head_links,
+                    content=content_str,
+                    prev_button=prev_btn,
+                    next_button=next_btn
+                )
+
+            image_variants.report()
+
+            # The service worker hashes every file, so the images must be in place
+            image_sync.wait()
+        finally:
+            image_sync.close()
+
+        # Shared reading-position script, with the page-length table
+        write_reading_table(out_dir, page_lengths)
+
+        # Service worker for offline reading (written last: it hashes every file)
+        write_service_worker(out_dir, [ch["filename"] for ch in pages], site_files.shared)
 
     print("Done.")
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Measure the memory held by a book's chapters, dicts vs Chapter records.
+
+Runs a generator's split_chapters() under tracemalloc and compares
+    dicts      the chapter dicts it returns (block strings copied out of the source)
+    parsed     the Chapter records save_book() hands back after that parse
+    loaded     the Chapter records load_book() rebuilds from the saved IR
+Each row reports the memory still held once the chapters are built
+(excluding the source text itself) and the peak while building them and
+rendering every page's content once. Uses the largest book source present
+(renlei or sapiens), otherwise a synthetic renlei-style book.
+
+Usage:
+    python3 scripts/measure_memory.py [--book renlei|sapiens] [--blocks N]
+"""
+
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+
+import benchmark_headers
+import generate_renlei
+import generate_sapiens
+from ebook_engine import load_book, save_book
+
+BOOKS = {'renlei': generate_renlei, 'sapiens': generate_sapiens}
+
+
+def synthetic_source(count):
+    return '<html><body>\n' + ''.join(benchmark_headers.synthetic_blocks(count)) + '</body></html>\n'
+
+
+def render_all(chapters):
+    """Builds every page's content once, as the page loop does."""
+    for ch in chapters:
+        "\n".join(ch["content_blocks"])
+
+
+def measure(label, build):
+    gc.collect()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    chapters = build()
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    render_all(chapters)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    print(f"  {label:<8} {len(chapters):6d} chapters  held {held / 1024 / 1024:8.2f} MB  peak {peak / 1024 / 1024:8.2f} MB")
+    return held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--book', choices=sorted(BOOKS), help="book to measure (default: largest source present)")
+    parser.add_argument('--blocks', type=int, default=2000, help="synthetic block count")
+    args = parser.parse_args()
+
+    present = [name for name, module in BOOKS.items() if os.path.exists(module.SOURCE_FILE)]
+    if args.book:
+        name = args.book
+    elif present:
+        name = max(present, key=lambda n: os.path.getsize(BOOKS[n].SOURCE_FILE))
+    else:
+        name = 'renlei'
+    module = BOOKS[name]
+
+    if os.path.exists(module.SOURCE_FILE):
+        print(f"Using source {module.SOURCE_FILE}")
+        with open(module.SOURCE_FILE, 'r', encoding='utf-8') as f:
+            content = f.read()
+    elif name == 'renlei':
+        print(f"Source not found, using {args.blocks} synthetic blocks")
+        content = synthetic_source(args.blocks)
+    else:
+        print(f"Error: Source file not found at {module.SOURCE_FILE}")
+        return
+    print(f"Source: {len(content.encode('utf-8')) / 1024 / 1024:.1f} MB")
+
+    # Parse once outside the measurements: sapiens caches its TOC on the first run
+    module.split_chapters(content)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ir_path = os.path.join(tmp, f'{name}.ir.jsonl')
+        tracemalloc.start()
+
+        def parse_dicts():
+            return module.split_chapters(content)[0]
+
+        def parse_records():
+            return save_book(ir_path, content, 'measure', *module.split_chapters(content)).chapters
+
+        def load_records():
+            return load_book(ir_path, content, 'measure').chapters
+
+        before = measure("dicts", parse_dicts)
+        measure("parsed", parse_records)
+        after = measure("loaded", load_records)
+        tracemalloc.stop()
+
+    if after:
+        print(f"Held memory: {before / after:.0f}x smaller with Chapter records")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Pack a built site into a single archive for offline distribution.
+
+Writes <site>.bundle/ containing site.zip (the whole site), sw.js (a service
+worker that serves pages straight out of the archive) and a loader
+index.html. Copying a book to a reader's device is then one large file
+instead of thousands of small ones.
+
+Usage:
+    python3 scripts/pack_site.py dist_silkroads [--output dist_silkroads.bundle]
+
+Serve the bundle over HTTP (service workers need http:// or https://):
+    python3 -m http.server -d dist_silkroads.bundle 8000
+"""
+
+import argparse
+import os
+
+from ebook_engine import write_bundle
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a built site into one archive plus a service worker.")
+    parser.add_argument('site', help="built site directory, e.g. dist_silkroads")
+    parser.add_argument('--output', help="bundle directory (default: <site>.bundle)")
+    args = parser.parse_args()
+
+    site_dir = os.path.abspath(args.site)
+    if not os.path.isfile(os.path.join(site_dir, 'index.html')):
+        print(f"Error: {site_dir} does not look like a built site (no index.html)")
+        return
+
+    bundle_dir = os.path.abspath(args.output) if args.output else site_dir.rstrip(os.sep) + '.bundle'
+    try:
+        count, size = write_bundle(site_dir, bundle_dir)
+    except ValueError as err:
+        print(f"Error: {err}")
+        return
+    print(f"Packed {count} files into {os.path.join(bundle_dir, 'site.zip')} ({size / 1024 / 1024:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()